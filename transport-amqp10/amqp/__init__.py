@@ -17,3 +17,4 @@ from zaqar.queues.transport.amqp import driver
 
 # Hoist into package namespace
 Driver = driver.Driver
+AsyncioDriver = driver.AsyncioDriver
@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Limits on the client connections a process accepts."""
+
+
+class Admission(object):
+    """Connection limits of one event loop.
+
+    `max_connections` bounds the open connections of the process and
+    `max_per_host` those coming from a single client address. `rate` is
+    the number of connections accepted per second, a token bucket
+    allowing bursts of up to `burst`. 0 disables a limit.
+
+    Once the total or the rate limit is reached the loop stops accepting,
+    leaving new connections in the listen backlog until there is room
+    again. Connections over the per host limit are closed right away,
+    since they can't be told apart while in the backlog.
+    """
+
+    def __init__(self, max_connections=0, max_per_host=0, rate=0, burst=1):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.open = 0
+        # open connections per client address
+        self.hosts = {}
+        self.tokens = float(self.burst)
+        self.updated = None
+        # set after accept() ran out of descriptors
+        self.paused_until = None
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now, limit):
+        """How many of `limit` connections may be accepted now."""
+        if self.paused_until is not None:
+            if now < self.paused_until:
+                return 0
+            self.paused_until = None
+        if self.max_connections:
+            limit = min(limit, self.max_connections - self.open)
+        if self.rate:
+            self._refill(now)
+            limit = min(limit, int(self.tokens))
+        return max(limit, 0)
+
+    def deadline(self):
+        """When accepting can resume, if waiting is all it takes.
+
+        None while the process is at max_connections: accepting resumes
+        as connections close.
+        """
+        if self.paused_until is not None:
+            return self.paused_until
+        if self.max_connections and self.open >= self.max_connections:
+            return None
+        if self.rate and self.tokens < 1:
+            return self.updated + (1 - self.tokens) / self.rate
+        return None
+
+    def admit(self, host, now):
+        """Account for a connection accepted from `host`.
+
+        Returns None, or the name of the limit the connection is over if
+        it must be closed instead.
+        """
+        if self.rate:
+            self._refill(now)
+            if self.tokens < 1:
+                return 'rate'
+            self.tokens -= 1
+        count = self.hosts.get(host, 0)
+        if self.max_per_host and count >= self.max_per_host:
+            return 'host'
+        if self.max_connections and self.open >= self.max_connections:
+            return 'total'
+        self.hosts[host] = count + 1
+        self.open += 1
+        return None
+
+    def release(self, host):
+        """A connection admitted from `host` closed."""
+        self.open -= 1
+        count = self.hosts.pop(host) - 1
+        if count:
+            self.hosts[host] = count
+
+    def backoff(self, now, delay):
+        """Stop accepting for `delay` seconds."""
+        self.paused_until = now + delay
@@ -0,0 +1,361 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve the pyngus Container from an asyncio event loop.
+
+The asyncio Protocol of each connection feeds its input to pyngus from
+buffer_updated() (data_received() before Python 3.7) and output is handed
+to transport.writelines(), so there is no per-tick select() rebuild.
+Pyngus deadlines are scheduled as loop timers. Requires Python 3.4+ (or
+uvloop).
+"""
+
+import asyncio
+import functools
+import socket
+import time
+
+import pyngus
+
+import zaqar.openstack.common.log as logging
+from zaqar.queues.transport.amqp import admission
+from zaqar.queues.transport.amqp import buffers
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import executor
+from zaqar.queues.transport.amqp import flow
+from zaqar.queues.transport.amqp import notify
+from zaqar.queues.transport.amqp import stats
+from zaqar.queues.transport.amqp import timers
+from zaqar.queues.transport.amqp import utils
+
+LOG = logging.getLogger(__name__)
+
+# reads into the server's ReadBuffer where available
+_Protocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+class ProtocolConnection(eventloop.Connection):
+    """A Connection whose I/O goes through an asyncio transport."""
+
+    def __init__(self, server, transport, name, host):
+        super(ProtocolConnection, self).__init__(
+            server.container, name, server.conn_properties,
+            server.controllers, credit_policy=server.credit_policy)
+        self.server = server
+        self.transport = transport
+        self.host = host
+        self._pending_input = b''
+        self._flush_scheduled = False
+        self._timer = None
+        self._timer_deadline = None
+
+        server.connections.add(self)
+        if server.reaper is not None:
+            server.reaper.schedule(self,
+                                   self.last_input + server.idle_timeout)
+
+    def data_received(self, data):
+        eventloop._BYTES_READ.inc(amount=len(data))
+        self.last_input = time.time()
+        if self._pending_input:
+            data = self._pending_input + bytes(data)
+        self._pending_input = b''
+
+        connection = self.connection
+        while data:
+            count = connection.process_input(data)
+            if count <= 0:
+                break
+            data = data[count:]
+
+        if data and count == 0:
+            # the engine can't take more right now, hold it and stop
+            # reading until it can. It may be a view of the read buffer.
+            self._pending_input = bytes(data)
+            self.transport.pause_reading()
+        self.flush()
+
+    def eof_received(self):
+        self.connection.close_input()
+        self.flush()
+
+    def connection_lost(self):
+        if self.connection is not None:
+            self.connection.close_input()
+            self.connection.close_output()
+            self.flush()
+        self.destroy()
+
+    def wakeup(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.server.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Run pyngus processing, write output and rearm the timer."""
+        self._flush_scheduled = False
+        connection = self.connection
+        if connection is None:
+            return
+
+        self.process(time.time())
+        if connection.has_output > 0:
+            buffers = []
+            while connection.has_output > 0:
+                data = connection.output_data()
+                buffers.append(data)
+                eventloop._BYTES_WRITTEN.inc(amount=len(data))
+                connection.output_written(len(data))
+            # a single write, or sendmsg() where asyncio supports it
+            self.transport.writelines(buffers)
+
+        if self._pending_input and connection.needs_input > 0:
+            pending, self._pending_input = self._pending_input, b''
+            self.transport.resume_reading()
+            self.data_received(pending)
+            return
+
+        if self.closed:
+            self.destroy()
+            return
+
+        self._schedule(connection.next_tick)
+        self.server.schedule_posts()
+        self.server.schedule_dispatch()
+
+    def _schedule(self, deadline):
+        if deadline == self._timer_deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_deadline = deadline
+        if deadline:
+            delay = max(0, deadline - time.time())
+            self._timer = self.server.loop.call_later(delay, self._expired)
+
+    def _expired(self):
+        self._timer = None
+        self._timer_deadline = None
+        self.flush()
+
+    def destroy(self):
+        self.server.connections.discard(self)
+        if self.host is not None:
+            self.server.limits.release(self.host)
+            self.host = None
+        if self.server.reaper is not None:
+            self.server.reaper.cancel(self)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        super(ProtocolConnection, self).destroy()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class ConnectionProtocol(_Protocol):
+    """Hands the events of an asyncio transport to its connection."""
+
+    def __init__(self, server):
+        self.server = server
+        self.conn = None
+        self._wanted = 0
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info('peername')
+        limit = self.server.limits.admit(peername[0], time.time())
+        if limit is not None:
+            eventloop._REJECTED.inc((limit,))
+            transport.abort()
+            return
+        if not self.server.tcp_nodelay:
+            # asyncio sets TCP_NODELAY on its own
+            sock = transport.get_extra_info('socket')
+            if sock is not None and sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+        name = str(peername)
+        self.conn = ProtocolConnection(self.server, transport, name,
+                                       peername[0])
+        LOG.debug("new connection created name=%s", name)
+        self.conn.flush()
+
+    def get_buffer(self, sizehint):
+        wanted = 0
+        if self.conn is not None and self.conn.connection is not None:
+            wanted = self.conn.connection.needs_input
+        self._wanted = max(wanted, 1)
+        return self.server.read_buffer.get(self._wanted)
+
+    def buffer_updated(self, nbytes):
+        read_buffer = self.server.read_buffer
+        data = read_buffer.view[:nbytes]
+        read_buffer.update(self._wanted, nbytes)
+        if not buffers.PUSH_VIEWS:
+            data = data.tobytes()
+        self.conn.data_received(data)
+
+    def data_received(self, data):
+        self.conn.data_received(data)
+
+    def eof_received(self):
+        self.conn.eof_received()
+        # let asyncio close the transport once output is written
+        return False
+
+    def connection_lost(self, exc):
+        if self.conn is not None:
+            self.conn.connection_lost()
+            self.conn = None
+
+
+class Server(object):
+    """Per-loop state shared by all the protocol connections."""
+
+    def __init__(self, loop, controllers, conf):
+        self.loop = loop
+        self.controllers = controllers
+        self.container = pyngus.Container("Marconi")
+        self.credit_policy = flow.CreditPolicy(conf.receiver_credit,
+                                               conf.receiver_credit_min,
+                                               conf.receiver_credit_max,
+                                               conf.receiver_credit_budget,
+                                               conf.max_message_size,
+                                               conf.spool_threshold)
+        self._posts_timer = None
+        self._posts_deadline = None
+        self._dispatch_scheduled = False
+        self.connections = set()
+        self.read_buffer = buffers.ReadBuffer()
+        # asyncio accepts whatever is pending, so connections over any
+        # of the limits are closed instead of left in the backlog
+        self.limits = admission.Admission(conf.max_connections,
+                                          conf.max_connections_per_host,
+                                          conf.accept_rate,
+                                          conf.accept_batch)
+
+        self.tcp_nodelay = conf.tcp_nodelay
+        self.idle_timeout = conf.idle_timeout
+        self.conn_properties = {'max-frame-size': conf.max_frame_size}
+        self.reaper = None
+        if conf.idle_timeout > 0:
+            self.conn_properties['idle-time-out'] = conf.idle_timeout
+            self.reaper = timers.TimerWheel(1, conf.idle_timeout)
+            loop.call_later(self.reaper.resolution, self._reap)
+
+        if conf.storage_pool_size > 0:
+            pool = executor.StoragePool(conf.storage_pool_size)
+            controllers.executor = pool
+            loop.add_reader(pool.fileno(), self._resume,
+                            pool.run_completions)
+
+        notifier = notify.get_notifier(conf.notifier_url)
+        if notifier is not None:
+            controllers.bus.notifier = notifier
+            loop.add_reader(notifier.fileno(), self._resume,
+                            controllers.bus.receive)
+
+        interval = controllers.bus.poll_interval
+        if interval:
+            loop.call_later(interval, self._expire_waiters)
+
+        self.stats_file = None
+        if conf.stats_file:
+            self.stats_file = stats.StatsFile(conf.stats_file,
+                                              conf.stats_interval,
+                                              worker=conf.workers > 1)
+            stats.REGISTRY.on_collect(
+                functools.partial(eventloop.collect_stats, self.connections,
+                                  self.credit_policy))
+            loop.call_soon(self._write_stats)
+
+    def protocol(self):
+        return ConnectionProtocol(self)
+
+    def schedule_posts(self):
+        """Arm a timer for the earliest post window deadline."""
+        deadline = self.controllers.post_deadline()
+        if deadline is None or deadline == self._posts_deadline:
+            return
+        if self._posts_timer is not None:
+            if self._posts_deadline <= deadline:
+                return
+            self._posts_timer.cancel()
+        self._posts_deadline = deadline
+        delay = max(0, deadline - time.time())
+        self._posts_timer = self.loop.call_later(delay, self._flush_posts)
+
+    def _flush_posts(self):
+        self._posts_timer = None
+        self._posts_deadline = None
+        self.controllers.flush_posts(time.time())
+        self.schedule_posts()
+
+    def schedule_dispatch(self):
+        """Run a round of deliveries soon if queues wait for their turn."""
+        if (self.controllers.prefetch.backlogged and
+                not self._dispatch_scheduled):
+            self._dispatch_scheduled = True
+            self.loop.call_soon(self._dispatch)
+
+    def _resume(self, func, *args):
+        """Call `func`, then schedule the deliveries it left waiting.
+
+        For callbacks that hand messages to the consumers without going
+        through a connection flush, e.g. completed claims.
+        """
+        func(*args)
+        self.schedule_dispatch()
+
+    def _dispatch(self):
+        # after the I/O callbacks that were ready, like an iteration of
+        # the select() loop
+        self._dispatch_scheduled = False
+        self.controllers.prefetch.run()
+        self.schedule_dispatch()
+
+    def _expire_waiters(self):
+        # cheaper than a timer per subscription, waiters are woken up at
+        # most one interval late
+        self._resume(self.controllers.bus.expire, time.time())
+        self.loop.call_later(self.controllers.bus.poll_interval,
+                             self._expire_waiters)
+
+    def _reap(self):
+        for protocol in eventloop.reap(self.reaper, self.idle_timeout,
+                                       time.time()):
+            protocol.destroy()
+        self.loop.call_later(self.reaper.resolution, self._reap)
+
+    def _write_stats(self):
+        self.stats_file.write(time.time())
+        self.loop.call_later(self.stats_file.interval, self._write_stats)
+
+
+def run(opts, controllers, conf):
+    if conf.uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+
+    host, port = utils.get_host_port(opts)
+    s = utils.server_socket(host, port, backlog=conf.backlog,
+                            reuse_port=conf.workers > 1)
+
+    eventloop.TRACER.configure(conf.trace_sample)
+    server = Server(loop, controllers, conf)
+    loop.run_until_complete(loop.create_server(server.protocol, sock=s,
+                                               backlog=conf.backlog))
+    loop.run_forever()
+    return 0
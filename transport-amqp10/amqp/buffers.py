@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Receive buffers reused across socket reads."""
+
+import proton
+
+from zaqar.queues.transport.amqp import stats
+
+_BUFFER_BYTES = stats.Gauge('amqp_read_buffer_bytes',
+                            'Bytes allocated to receive buffers.')
+_ALLOCATIONS = stats.Counter('amqp_read_buffer_allocations_total',
+                             'Receive buffers allocated, including every '
+                             'resize.')
+
+
+def _pushes_views():
+    try:
+        proton.Transport().push(memoryview(bytearray(1))[:0])
+    except TypeError:
+        return False
+    return True
+
+
+# older proton bindings only take bytes, the data read is then copied
+# out of the buffer once
+PUSH_VIEWS = _pushes_views()
+
+
+class ReadBuffer(object):
+    """A bytearray sockets are read into with recv_into().
+
+    Proton copies the input pushed to a transport, so the buffer is free
+    again once the data read is handed to pyngus, and a single one serves
+    all the connections of an event loop. Its size follows the reads:
+    doubled when one fills it, halved when the last `window` reads all
+    used less than a quarter of it, between `minimum` and `maximum`.
+    """
+
+    def __init__(self, minimum=4096, maximum=256 * 1024, window=64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.size = 0
+        self.buffer = None
+        self.view = None
+        self._small = 0
+        self._resize(minimum)
+
+    def _resize(self, size):
+        _BUFFER_BYTES.inc(amount=size - self.size)
+        _ALLOCATIONS.inc()
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self._small = 0
+
+    def get(self, limit):
+        """A view of at most `limit` bytes of the buffer to read into."""
+        if limit >= self.size:
+            return self.view
+        return self.view[:limit]
+
+    def update(self, wanted, count):
+        """Adapt the size after a read of `count` of `wanted` bytes."""
+        if count >= self.size:
+            if wanted > self.size and self.size < self.maximum:
+                self._resize(min(self.size * 2, self.maximum))
+            return
+        if count < self.size // 4 and self.size > self.minimum:
+            self._small += 1
+            if self._small >= self.window:
+                self._resize(max(self.size // 2, self.minimum))
+        else:
+            self._small = 0
+
+    def release(self):
+        """Free the buffer, it isn't used anymore."""
+        _BUFFER_BYTES.dec(amount=self.size)
+        self.size = 0
+        self.buffer = self.view = None
@@ -26,6 +26,7 @@ from zaqar.queues.transport import validation
 from zaqar.queues.transport.amqp import utils
 from zaqar.queues.transport.amqp import messages
 from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import workers
 
 _AMQP_OPTIONS = (
     cfg.StrOpt('bind',
@@ -33,7 +34,173 @@ _AMQP_OPTIONS = (
                 help='Address on which the self-hosting server will listen.'),
     cfg.IntOpt('port',
                 default='8888',
-                help='Port on which the self-hosting server will listen.')
+                help='Port on which the self-hosting server will listen.'),
+    cfg.StrOpt('reactor',
+                default='select',
+                help='I/O multiplexing used by the event loop. "select" '
+                     'rebuilds the descriptor sets on every iteration and '
+                     'is limited to FD_SETSIZE connections, "selectors" '
+                     'keeps connections registered with epoll/kqueue.'),
+    cfg.IntOpt('workers',
+                default=1,
+                help='Number of event loop processes. When greater than 1, '
+                     'every worker binds the port with SO_REUSEPORT and '
+                     'the kernel spreads new connections across them.'),
+    cfg.IntOpt('backlog',
+                default=128,
+                help='Length of the listen queue of pending connections. '
+                     'The kernel caps it at net.core.somaxconn.'),
+    cfg.IntOpt('accept_batch',
+                default=64,
+                help='Maximum number of pending connections accepted per '
+                     'event loop iteration.'),
+    cfg.IntOpt('max_connections',
+                default=0,
+                help='Maximum number of open client connections per '
+                     'process. New ones wait in the listen queue while '
+                     'the limit is reached. 0 means no limit.'),
+    cfg.IntOpt('max_connections_per_host',
+                default=0,
+                help='Maximum number of open connections per client '
+                     'address and process, connections over it are '
+                     'closed once accepted. 0 means no limit.'),
+    cfg.IntOpt('accept_rate',
+                default=0,
+                help='Connections accepted per second and process, in '
+                     'bursts of up to accept_batch. 0 means no limit.'),
+    cfg.BoolOpt('tcp_nodelay',
+                default=True,
+                help='Disable Nagle\'s algorithm on client connections. '
+                     'Output is written once per event loop iteration, so '
+                     'there is little left for the kernel to coalesce and '
+                     'delaying it only adds latency.'),
+    cfg.IntOpt('idle_timeout',
+                default=60,
+                help='Seconds without any input after which a client '
+                     'connection is closed. Advertised to clients as the '
+                     'AMQP idle timeout, so they send heartbeats when '
+                     'they have nothing else to send. 0 disables it.'),
+    cfg.IntOpt('claim_ttl',
+                default=60,
+                help='Seconds a batch of messages claimed for a consumer '
+                     'link stays invisible to other consumers.'),
+    cfg.IntOpt('claim_grace',
+                default=60,
+                help='Seconds claimed messages are kept alive past their '
+                     'own TTL while the claim is active.'),
+    cfg.IntOpt('ingest_batch_size',
+                default=20,
+                help='Maximum number of received messages written to a '
+                     'queue with a single storage call.'),
+    cfg.IntOpt('ingest_window_ms',
+                default=5,
+                help='Milliseconds received messages may wait for more '
+                     'messages to the same queue before being written.'),
+    cfg.IntOpt('ingest_batch_bytes',
+                default=1024 * 1024,
+                help='Bytes of received message bodies to the same queue '
+                     'after which they are written without waiting for '
+                     'ingest_window_ms, so large messages aren\'t held in '
+                     'memory any longer than needed. 0 means no limit.'),
+    cfg.IntOpt('receiver_credit',
+                default=10,
+                help='Credit initially granted to a producer link.'),
+    cfg.IntOpt('receiver_credit_min',
+                default=1,
+                help='Smallest credit window a producer link is shrunk '
+                     'to under backpressure.'),
+    cfg.IntOpt('receiver_credit_max',
+                default=1000,
+                help='Largest credit window a producer link can grow to '
+                     'while storage keeps up.'),
+    cfg.IntOpt('receiver_credit_budget',
+                default=64 * 1024 * 1024,
+                help='Bytes of received messages that may be waiting for '
+                     'storage across all links before no more credit is '
+                     'granted. 0 means no limit.'),
+    cfg.IntOpt('max_message_size',
+                default=1024 * 1024,
+                help='Largest message accepted from producers, in bytes. '
+                     'Links sending larger ones are closed with an '
+                     'amqp:link:message-size-exceeded error as soon as the '
+                     'limit is crossed. 0 means no limit.'),
+    cfg.IntOpt('max_frame_size',
+                default=32 * 1024,
+                help='Largest AMQP frame accepted from clients, in bytes. '
+                     'Larger messages are split over several frames.'),
+    cfg.IntOpt('spool_threshold',
+                default=256 * 1024,
+                help='Bytes of a message received over several frames '
+                     'kept in memory until its last frame is in, the rest '
+                     'goes to a temporary file. 0 leaves incomplete '
+                     'messages in the AMQP engine\'s buffers.'),
+    cfg.IntOpt('prefetch_size',
+                default=20,
+                help='Messages claimed ahead of the consumers of a queue, '
+                     'shared by all its consumer links of the process.'),
+    cfg.IntOpt('prefetch_bytes',
+                default=1024 * 1024,
+                help='Bytes of message bodies claimed ahead of the '
+                     'consumers of a queue.'),
+    cfg.IntOpt('dispatch_quantum',
+                default=64 * 1024,
+                help='Bytes of messages a queue delivers to its consumers '
+                     'per event loop iteration, times its weight, while '
+                     'other queues have messages to deliver too. Each '
+                     'message counts for its body plus 512 bytes. 0 '
+                     'delivers whatever the consumers have credit for.'),
+    cfg.DictOpt('queue_weights',
+                default={},
+                help='Share of the delivery work of queues relative to '
+                     'the others, as name:weight pairs, e.g. '
+                     'bulk:0.25,alerts:2. Weights must be greater than '
+                     '0, queues not listed weigh 1. '
+                     'Only matters while several queues have more to '
+                     'deliver than dispatch_quantum.'),
+    cfg.IntOpt('queue_cache_ttl',
+                default=60,
+                help='Seconds a queue name is remembered as existing, '
+                     'skipping the existence check when posting to it.'),
+    cfg.IntOpt('queue_cache_size',
+                default=1000,
+                help='Maximum number of queue names remembered as '
+                     'existing, least recently used are evicted first.'),
+    cfg.IntOpt('storage_pool_size',
+                default=4,
+                help='Number of threads running storage calls off the '
+                     'event loop. 0 runs them inline on the loop.'),
+    cfg.StrOpt('notifier_url',
+                default='',
+                help='Where writes to a queue are announced to the other '
+                     'transport processes, so their consumers waiting on '
+                     'the queue are woken up. udp://<group>:<port> uses '
+                     'multicast, redis://<host>:<port>/<db> Redis pub/sub. '
+                     'Empty only notifies consumers of the same process.'),
+    cfg.IntOpt('idle_poll_interval',
+                default=5,
+                help='Seconds after which consumers waiting on an empty '
+                     'queue check storage again even if no write was '
+                     'announced. 0 disables it.'),
+    cfg.StrOpt('stats_file',
+                default='',
+                help='Path of a file the transport metrics are written '
+                     'to, in Prometheus text format, e.g. in the node '
+                     'exporter textfile directory. With several workers '
+                     'each writes its own file, named after its pid. '
+                     'Empty disables metrics output.'),
+    cfg.IntOpt('stats_interval',
+                default=10,
+                help='Seconds between two writes of stats_file.'),
+    cfg.IntOpt('trace_sample',
+                default=0,
+                help='Log one in N deliveries and storage requests of the '
+                     'links, at debug level on the '
+                     'zaqar.queues.transport.amqp.trace logger. 0 '
+                     'disables delivery tracing.'),
+    cfg.BoolOpt('uvloop',
+                default=False,
+                help='Run the asyncio driver on uvloop instead of the '
+                     'default asyncio event loop.')
 )
 
 _AMQP_GROUP = 'drivers:transport:amqp'
@@ -57,8 +224,24 @@ class Driver(transport.DriverBase):
 
         message_controller = self._storage.message_controller
         queue_controller = self._storage.queue_controller
+        claim_controller = self._storage.claim_controller
 
-        self.controllers = messages.CollectionResource(message_controller, queue_controller)
+        self.controllers = messages.CollectionResource(
+            message_controller,
+            queue_controller,
+            claim_controller,
+            claim_ttl=self._amqp_conf.claim_ttl,
+            claim_grace=self._amqp_conf.claim_grace,
+            batch_size=self._amqp_conf.ingest_batch_size,
+            batch_window=self._amqp_conf.ingest_window_ms / 1000.0,
+            batch_bytes=self._amqp_conf.ingest_batch_bytes,
+            queue_cache_ttl=self._amqp_conf.queue_cache_ttl,
+            queue_cache_size=self._amqp_conf.queue_cache_size,
+            idle_poll_interval=self._amqp_conf.idle_poll_interval,
+            prefetch_size=self._amqp_conf.prefetch_size,
+            prefetch_bytes=self._amqp_conf.prefetch_bytes,
+            dispatch_quantum=self._amqp_conf.dispatch_quantum,
+            queue_weights=self._amqp_conf.queue_weights)
 
     def listen(self):
         """Self-host using 'bind' and 'port' from the AMQP config group."""
@@ -70,4 +253,26 @@ class Driver(transport.DriverBase):
         # I know this is ugly
         opts = self._amqp_conf.bind + ':' + str(self._amqp_conf.port)
 
-        eventloop.run(opts, self.controllers)
+        if self._amqp_conf.workers > 1:
+            # NOTE: storage connections were opened before forking, drivers
+            # that aren't fork safe have to reconnect in the workers.
+            def serve():
+                self._serve(opts)
+
+            supervisor = workers.Supervisor(self._amqp_conf.workers, serve)
+            supervisor.run()
+        else:
+            self._serve(opts)
+
+    def _serve(self, opts):
+        eventloop.run(opts, self.controllers, self._amqp_conf)
+
+
+class AsyncioDriver(Driver):
+    """Serve AMQP from an asyncio event loop instead of select()."""
+
+    def _serve(self, opts):
+        # asyncio is Python 3 only, don't require it for the default driver
+        from zaqar.queues.transport.amqp import asyncloop
+
+        asyncloop.run(opts, self.controllers, self._amqp_conf)
@@ -17,23 +17,130 @@
 #
 """A simple server that consumes and produces messages."""
 
+import collections
+import errno
+import functools
+import itertools
 import select
+import socket
 import time
-import utils
-from proton import Message
+
+import proton
 import pyngus
 
 import zaqar.openstack.common.log as logging
+from zaqar.queues.transport.amqp import admission
+from zaqar.queues.transport.amqp import buffers
+from zaqar.queues.transport.amqp import executor
+from zaqar.queues.transport.amqp import flow
+from zaqar.queues.transport.amqp import notify
+from zaqar.queues.transport.amqp import spool
+from zaqar.queues.transport.amqp import stats
+from zaqar.queues.transport.amqp import timers
+from zaqar.queues.transport.amqp import tracing
+from zaqar.queues.transport.amqp import utils
+
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors
+    except ImportError:
+        selectors = None
 
 LOG = logging.getLogger(__name__)
+TRACER = tracing.TRACER
 
+_CONNECTIONS = stats.Gauge('amqp_connections', 'Open AMQP connections.')
+_REJECTED = stats.Counter('amqp_connections_rejected_total',
+                          'Connections closed once accepted, by the limit '
+                          'they were over.', ('limit',))
+_REAPED = stats.Counter('amqp_connections_reaped_total',
+                        'Connections closed after idle_timeout without '
+                        'input, by what noticed it: the AMQP idle timeout '
+                        'or the reaper.', ('by',))
+_LINKS = stats.Gauge('amqp_links', 'Open links, by role.', ('role',))
+_CONNECTION_LINKS = stats.Histogram(
+    'amqp_connection_links', 'Links per open connection.',
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256))
+_RECEIVED = stats.Counter('amqp_messages_received_total',
+                          'Messages received from producers, by queue.',
+                          ('queue',))
+_OVERSIZED = stats.Counter('amqp_messages_oversized_total',
+                           'Receiver links closed for sending a message '
+                           'over max_message_size.')
+_SENT = stats.Counter('amqp_messages_sent_total',
+                      'Messages sent to consumers, by queue.', ('queue',))
+_BYTES_READ = stats.Counter('amqp_bytes_read_total',
+                            'Bytes read from client sockets.')
+_BYTES_WRITTEN = stats.Counter('amqp_bytes_written_total',
+                               'Bytes written to client sockets.')
+_CREDIT = stats.Gauge('amqp_receiver_credit',
+                      'Credit granted to producers and not used yet.')
+_UNSETTLED = stats.Gauge('amqp_receiver_unsettled',
+                         'Received messages waiting to be stored.')
+_UNSETTLED_BYTES = stats.Gauge('amqp_receiver_unsettled_bytes',
+                               'Bytes of received messages waiting to be '
+                               'stored.')
+_ITERATION = stats.Histogram('amqp_loop_iteration_seconds',
+                             'Time spent handling the events returned by '
+                             'one poll.')
 
-class SocketConnection(pyngus.ConnectionEventHandler):
-    """Associates a pyngus Connection with a python network socket"""
 
-    def __init__(self, container, socket_, name, properties, controllers):
-        """Create a Connection using socket_."""
-        self.socket = socket_
+# bytes taken from pyngus ahead of the socket, per connection
+_MAX_UNSENT = 256 * 1024
+# buffers per sendmsg(), under any platform's IOV_MAX
+_MAX_BUFFERS = 512
+
+
+def _sendmsg(sock, buffers):
+    return sock.sendmsg(buffers)
+
+
+def _send_joined(sock, buffers):
+    # python 2, whose join() takes no memoryviews: the remainder of a
+    # partially written buffer is one
+    return sock.send(b''.join(
+        b.tobytes() if isinstance(b, memoryview) else b
+        for b in buffers))
+
+
+if hasattr(socket.socket, 'sendmsg'):
+    _send_buffers = _sendmsg
+else:
+    _send_buffers = _send_joined
+
+
+def collect_stats(connections, credit_policy):
+    """Refresh the gauges derived from the open connections."""
+    senders = receivers = credit = unsettled = 0
+    _CONNECTION_LINKS.clear()
+    for sconn in connections:
+        links = len(sconn.sender_links) + len(sconn.receiver_links)
+        _CONNECTION_LINKS.observe(links)
+        senders += len(sconn.sender_links)
+        receivers += len(sconn.receiver_links)
+        for link in sconn.receiver_links:
+            credit += link.receiver_link.capacity
+            unsettled += link.credit.unsettled
+
+    _CONNECTIONS.set(len(connections))
+    _LINKS.set(senders, ('sender',))
+    _LINKS.set(receivers, ('receiver',))
+    _CREDIT.set(credit)
+    _UNSETTLED.set(unsettled)
+    _UNSETTLED_BYTES.set(credit_policy.used)
+
+
+class Connection(pyngus.ConnectionEventHandler):
+    """A pyngus Connection and its links, whatever carries its bytes.
+
+    Subclasses move the bytes between the pyngus Connection and the
+    client, and destroy the connection once `closed`.
+    """
+
+    def __init__(self, container, name, properties, controllers,
+                 wakeups=None, credit_policy=None):
         self.connection = container.create_connection(name,
                                                       self,  # handler
                                                       properties)
@@ -42,11 +149,25 @@ class SocketConnection(pyngus.ConnectionEventHandler):
         self.connection.pn_sasl.server()
         self.connection.open()
         self.closed = False
+        self.last_input = time.time()
 
         self.sender_links = set()
         self.receiver_links = set()
+        # links closed during the current process() pass
+        self.closed_links = []
 
         self.controllers = controllers
+        self.wakeups = wakeups
+        self.credit_policy = credit_policy or flow.CreditPolicy()
+
+    def wakeup(self):
+        """Ask the main loop to look at this connection again.
+
+        Needed when the connection's state changes from outside of its own
+        I/O processing, e.g. a delivery settled by a deferred storage write.
+        """
+        if self.wakeups is not None:
+            self.wakeups.add(self)
 
     def destroy(self):
         self.closed = True
@@ -57,36 +178,15 @@ class SocketConnection(pyngus.ConnectionEventHandler):
         if self.connection:
             self.connection.destroy()
             self.connection = None
-        if self.socket:
-            self.socket.close()
-            self.socket = None
 
-    def fileno(self):
-        """Allows use of a SocketConnection in a select() call."""
-        return self.socket.fileno()
+    def process(self, now):
+        """Run pyngus, then destroy the links that closed meanwhile.
 
-    def process_input(self):
-        """Called when socket is read-ready"""
-        try:
-            pyngus.read_socket_input(self.connection, self.socket)
-        except Exception as e:
-            LOG.error("Exception on socket read: %s", str(e))
-            # may be redundant if closed cleanly:
-            self.connection_closed(self.connection)
-            return
-        self.connection.process(time.time())
-
-    def send_output(self):
-        """Called when socket is write-ready"""
-        try:
-            pyngus.write_socket_output(self.connection,
-                                       self.socket)
-        except Exception as e:
-            LOG.error("Exception on socket write: %s", str(e))
-            # may be redundant if closed cleanly:
-            self.connection_closed(self.connection)
-            return
-        self.connection.process(time.time())
+        Pyngus doesn't allow destroying a link from its own callbacks.
+        """
+        self.connection.process(now)
+        while self.closed_links:
+            self.closed_links.pop().destroy()
 
     # ConnectionEventHandler callbacks:
 
@@ -102,9 +202,17 @@ class SocketConnection(pyngus.ConnectionEventHandler):
         self.closed = True
 
     def connection_failed(self, connection, error):
-        LOG.error("Connection failed! error = %s", str(error))
-        # No special recovery - just close it:
-        self.connection.close()
+        if self.closed:
+            # pyngus reports the failure on every process() until the
+            # connection is destroyed
+            return
+        if 'idle-timeout' in str(error):
+            LOG.info("Connection %s timed out", connection.name)
+            _REAPED.inc(('heartbeat',))
+        else:
+            LOG.error("Connection failed! error = %s", error)
+        # No special recovery - main loop will destroy it
+        self.closed = True
 
     def sender_requested(self, connection, link_handle,
                          name, requested_source, properties):
@@ -113,7 +221,14 @@ class SocketConnection(pyngus.ConnectionEventHandler):
             # the peer has requested us to create a source node.
             # select general queue
             requested_source = 'uncategorized'
-        sender = SenderLink(self, link_handle, requested_source, self.controllers)
+        properties = properties or {}
+        # "copy" is a browsing consumer, it reads without removing
+        browse = properties.get('distribution-mode') == 'copy'
+        # the consumer asked for at-most-once delivery
+        presettled = properties.get('snd-settle-mode') == 'settled'
+        sender = SenderLink(self, link_handle, requested_source,
+                            self.controllers, browse=browse,
+                            presettled=presettled)
         self.sender_links.add(sender)
 
     def receiver_requested(self, connection, link_handle,
@@ -123,7 +238,10 @@ class SocketConnection(pyngus.ConnectionEventHandler):
             # the peer has requested us to create a target node.
             # select general queue
             requested_target = 'uncategorized'
-        receiver = ReceiverLink(self, link_handle, requested_target, self.controllers)
+        # the producer sends at-most-once, it won't wait for outcomes
+        presettled = (properties or {}).get('snd-settle-mode') == 'settled'
+        receiver = ReceiverLink(self, link_handle, requested_target,
+                                self.controllers, presettled=presettled)
         self.receiver_links.add(receiver)
 
     # SASL callbacks:
@@ -134,45 +252,286 @@ class SocketConnection(pyngus.ConnectionEventHandler):
         pn_sasl.done(pn_sasl.OK)
 
     def sasl_done(self, connection, pn_sasl, result):
-        LOG.debug("SASL done callback, result = %s", str(result))
+        LOG.debug("SASL done callback, result = %s", result)
+
+
+class SocketConnection(Connection):
+    """Associates a pyngus Connection with a python network socket"""
+
+    def __init__(self, container, socket_, name, properties, controllers,
+                 wakeups=None, credit_policy=None, read_buffer=None):
+        """Create a Connection using socket_.
+
+        `read_buffer` is the buffers.ReadBuffer of the event loop, the
+        connection gets its own when None.
+        """
+        super(SocketConnection, self).__init__(container, name, properties,
+                                               controllers, wakeups,
+                                               credit_policy)
+        self.socket = socket_
+        # output taken from pyngus that the socket didn't accept yet
+        self._unsent = collections.deque()
+        self._unsent_bytes = 0
+        self._owns_buffer = read_buffer is None
+        self.read_buffer = read_buffer or buffers.ReadBuffer()
+
+    def destroy(self):
+        super(SocketConnection, self).destroy()
+        if self.socket:
+            if self._unsent:
+                # best effort, likely the close frame
+                try:
+                    _send_buffers(self.socket, list(self._unsent))
+                except socket.error:
+                    pass
+                self._unsent.clear()
+            self.socket.close()
+            self.socket = None
+        if self._owns_buffer and self.read_buffer.size:
+            self.read_buffer.release()
+
+    def fileno(self):
+        """Allows use of a SocketConnection in a select() call."""
+        return self.socket.fileno()
+
+    @property
+    def output_pending(self):
+        """True while there is output to write, pyngus' or unsent."""
+        return bool(self._unsent) or self.connection.has_output > 0
+
+    def read_input(self, now=None):
+        """Hand what the socket has to pyngus, without processing it.
+
+        The socket is read into the loop's read buffer, which proton's
+        transport copies from, so no bytes object is created per read.
+        Returns the number of bytes read.
+        """
+        connection = self.connection
+        wanted = connection.needs_input
+        if wanted <= 0:
+            return 0
+        read_buffer = self.read_buffer
+        view = read_buffer.get(wanted)
+        try:
+            count = self.socket.recv_into(view)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            LOG.error("Exception on socket read: %s", e)
+            # may be redundant if closed cleanly:
+            self.connection_closed(connection)
+            return 0
+        read_buffer.update(wanted, count)
+
+        if count == 0:
+            LOG.debug("Socket closed")
+            connection.close_input()
+            connection.close_output()
+            return 0
+        data = view[:count]
+        if not buffers.PUSH_VIEWS:
+            data = data.tobytes()
+        connection.process_input(data)
+        _BYTES_READ.inc(amount=count)
+        self.last_input = now or time.time()
+        return count
+
+    def write_output(self):
+        """Write pending output to the socket with a single call.
+
+        All of pyngus' output is taken at once, up to _MAX_UNSENT bytes,
+        and what the socket doesn't accept is kept for the next call.
+        """
+        unsent = self._unsent
+        connection = self.connection
+        while (self._unsent_bytes < _MAX_UNSENT and
+               connection.has_output > 0):
+            data = connection.output_data()
+            connection.output_written(len(data))
+            unsent.append(data)
+            self._unsent_bytes += len(data)
+        if not unsent:
+            return
+
+        try:
+            count = _send_buffers(self.socket,
+                                  list(itertools.islice(unsent,
+                                                        _MAX_BUFFERS)))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            LOG.error("Exception on socket write: %s", e)
+            # may be redundant if closed cleanly:
+            self.connection_closed(self.connection)
+            return
+
+        if count > 0:
+            _BYTES_WRITTEN.inc(amount=count)
+            self._unsent_bytes -= count
+            while count:
+                data = unsent[0]
+                if len(data) > count:
+                    unsent[0] = memoryview(data)[count:]
+                    break
+                count -= len(data)
+                unsent.popleft()
+
+    def flush(self, now=None, write=True):
+        """Process the connection and write out what it has to send.
+
+        The main loop calls it once per iteration for each connection
+        that had input, timers or wakeups, so the frames its links
+        produced meanwhile go out with one pass and one write. Without
+        `write` the output is left for the next iteration, when the
+        socket is reported writable, with whatever it adds.
+        """
+        now = now or time.time()
+        self.process(now)
+        if write:
+            self.write_output()
+        if not self._unsent and self.connection.has_output < 0:
+            # all written, pyngus reports the close on the next pass
+            self.process(now)
+
+    def process_input(self, now=None):
+        """Called when socket is read-ready"""
+        now = now or time.time()
+        self.read_input(now)
+        if not self.closed:
+            self.process(now)
+
+    def send_output(self, now=None):
+        """Called when socket is write-ready"""
+        self.write_output()
+        if not self.closed:
+            self.process(now or time.time())
 
 
 class SenderLink(pyngus.SenderEventHandler):
-    """Send messages until credit runs out."""
-    def __init__(self, socket_conn, handle, src_addr, controllers):
+    """Send messages until credit runs out.
+
+    Consuming links take their messages from the queue's shared buffer of
+    claimed messages, browsing links read the queue through a cursor.
+
+    Presettled links deliver at-most-once: messages are sent settled,
+    without waiting for an outcome, and deleted from storage in bulk as
+    they are sent. Other links deliver at-least-once, deleting a message
+    when the consumer accepts it.
+    """
+    def __init__(self, socket_conn, handle, src_addr, controllers,
+                 browse=False, presettled=False):
         self.socket_conn = socket_conn
+        properties = None
+        if browse or presettled:
+            properties = {}
+            if browse:
+                properties['distribution-mode'] = 'copy'
+            if presettled:
+                properties['snd-settle-mode'] = 'settled'
         sl = socket_conn.connection.accept_sender(handle,
                                                   source_override=src_addr,
-                                                  event_handler=self)
+                                                  event_handler=self,
+                                                  properties=properties)
         self.sender_link = sl
         self.sender_link.open()
-        print("New sender link created, name = %s" % sl.name)
+        LOG.debug("New sender link created, name = %s", sl.name)
 
         self.controllers = controllers
+        self.queue = sl.source_address
+        self.stats_key = (self.queue,)
+
+        # (claim, message id) of the deliveries not settled yet
+        self.in_flight = set()
+        # in the buffer's round-robin of links waiting for messages
+        self.queued = False
+        self.presettled = presettled
+        self.buffer = None
+        self.cursor = None
+        if browse:
+            self.cursor = controllers.cursor(self.queue)
+        else:
+            self.buffer = controllers.prefetch.buffer(self.queue)
+            self.buffer.attach()
+
+        # a browse read is on its way to storage
+        self.fetching = False
+        # subscribed to the bus, waiting for the queue to get messages
+        self.waiting = False
+
+    @property
+    def credit(self):
+        return self.sender_link.credit
 
     def destroy(self):
-        print("Sender link destroyed, name = %s" % self.sender_link.name)
+        LOG.debug("Sender link destroyed, name = %s", self.sender_link.name)
+        if self.waiting:
+            self.controllers.bus.unsubscribe(self.queue, self.wake)
+        if self.buffer is not None:
+            # whatever is in flight was never acknowledged
+            in_flight, self.in_flight = self.in_flight, set()
+            self.buffer.detach(self, in_flight)
         self.socket_conn.sender_links.discard(self)
         self.socket_conn = None
         self.sender_link.destroy()
         self.sender_link = None
 
+    def fetch_messages(self):
+        """Read a batch sized to the link credit past the cursor."""
+        if TRACER.enabled and TRACER.sample():
+            TRACER.log("Sender %s: reading %d messages",
+                       self.sender_link.name, self.sender_link.credit)
+        self.fetching = True
+        self.controllers.on_get(self.cursor, self.sender_link.credit,
+                                self.browsed)
+
+    def browsed(self, messages):
+        """Storage answered a read past the cursor."""
+        self.fetching = False
+        if self.sender_link is None:
+            return
+
+        sent = 0
+        callback = None if self.presettled else self
+        for message in messages:
+            # no handle, browsed messages are never settled in storage
+            self.sender_link.send(message, callback)
+            sent += 1
+        if sent:
+            _SENT.inc(self.stats_key, sent)
+        if not sent and self.sender_link.credit > 0:
+            self.wait()
+        self.socket_conn.wakeup()
+
+    def wait(self):
+        self.waiting = True
+        self.controllers.bus.subscribe(self.queue, self.wake)
+
+    def wake(self):
+        """The queue got new messages."""
+        self.waiting = False
+        if self.sender_link is None:
+            return
+        if self.sender_link.credit > 0:
+            self.send_message()
+            self.socket_conn.wakeup()
+
     def send_message(self):
-        queue = self.sender_link.source_address
-        LOG.debug("Sender: Sending messages...")
-        message = self.controllers.on_get(queue)
-
-        # if there was a message in the queue
-        # destroy the message once consumed
-        # else return an empty message
-        if message:
-            self.controllers.on_delete(queue)
-        else:
-            message.append(Message())
+        if self.buffer is not None:
+            self.buffer.want(self)
+        elif not self.fetching and not self.waiting:
+            self.fetch_messages()
 
-        # NOTE(vkmc) We return the first message on the list
-        # but the idea is to return every message in the queue
-        self.sender_link.send(message[0], self)
+    def deliver(self, claim, message_id, message):
+        """Send a message the buffer handed to this link."""
+        if self.presettled:
+            # no callback, pyngus settles it as soon as it's written
+            self.sender_link.send(message)
+        else:
+            handle = (claim, message_id)
+            self.in_flight.add(handle)
+            self.sender_link.send(message, self, handle=handle)
+        _SENT.inc(self.stats_key)
+        self.socket_conn.wakeup()
 
     # SenderEventHandler callbacks:
 
@@ -188,40 +547,81 @@ class SenderLink(pyngus.SenderEventHandler):
     def sender_closed(self, sender_link):
         LOG.debug("Sender: Closed")
         # Done with this sender:
-        self.destroy()
+        self.socket_conn.closed_links.append(self)
 
     def credit_granted(self, sender_link):
-        LOG.debug("Sender: Credit granted")
-        # Send a single message:
+        # Fill the granted window:
         if sender_link.credit > 0:
             self.send_message()
 
     # 'message sent' callback:
     def __call__(self, sender, handle, status, error=None):
-        print("Message sent on sender link %s, status = %s" %
-              (self.sender_link.name, status))
+        if self.sender_link is None:
+            return
+        if TRACER.enabled and TRACER.sample():
+            TRACER.log("Message sent on sender link %s, status = %s",
+                       self.sender_link.name, status)
+        if handle in self.in_flight:
+            self.in_flight.remove(handle)
+            claim, message_id = handle
+            self.buffer.settle(claim, message_id, status)
         if self.sender_link.credit > 0:
             # send another message:
             self.send_message()
 
 
 class ReceiverLink(pyngus.ReceiverEventHandler):
-    """Receive messages, and drop them."""
-    def __init__(self, socket_conn, handle, rx_addr, controllers):
+    """Receive messages and post them to storage.
+
+    Deliveries are accepted once stored, or rejected if the write failed.
+    Presettled deliveries have no outcome to send, they are only tracked
+    for flow control until stored.
+
+    Pyngus only reads a delivery once its last frame is in, until then the
+    engine buffers all of it. Those spanning several frames are read as
+    their frames come in instead, into a spool.DeliverySpool, and are
+    settled here rather than through pyngus.
+
+    Pyngus has no hook for the frames of a delivery, so the link's private
+    _process_delivery() is replaced by process_delivery(). It is the same
+    in the pyngus releases requirements.txt allows, later ones need
+    checking.
+    """
+    def __init__(self, socket_conn, handle, rx_addr, controllers,
+                 presettled=False):
         self.socket_conn = socket_conn
+        properties = None
+        if presettled:
+            properties = {'snd-settle-mode': 'settled'}
         rl = socket_conn.connection.accept_receiver(handle,
                                                     target_override=rx_addr,
-                                                    event_handler=self)
+                                                    event_handler=self,
+                                                    properties=properties)
         self.receiver_link = rl
+        policy = socket_conn.credit_policy
+        self.max_message_size = policy.max_message_size
+        self.spool_threshold = policy.spool_threshold
+        # the delivery being received, if it spans several frames
+        self.spool = None
+        self.oversized = False
+        self._process_delivery = rl._process_delivery
+        rl._process_delivery = self.process_delivery
         self.receiver_link.open()
-        self.receiver_link.add_capacity(1)
 
-        print("New receiver link created, name = %s" % rl.name)
+        LOG.debug("New receiver link created, name = %s", rl.name)
 
         self.controllers = controllers
+        self.presettled = presettled
+        self.credit = socket_conn.credit_policy.link(self.top_up)
+        self.top_up()
 
     def destroy(self):
-        print("Receiver link destroyed, name = %s" % self.receiver_link.name)
+        LOG.debug("Receiver link destroyed, name = %s",
+                  self.receiver_link.name)
+        self.credit.discard()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
         self.socket_conn.receiver_links.discard(self)
         self.socket_conn = None
         self.receiver_link.destroy()
@@ -239,93 +639,534 @@ class ReceiverLink(pyngus.ReceiverEventHandler):
     def receiver_closed(self, receiver_link):
         LOG.debug("Receiver: Closed")
         # Done with this Receiver:
-        self.destroy()
+        self.socket_conn.closed_links.append(self)
+
+    def process_delivery(self, pn_delivery):
+        """Called by pyngus when a frame of a delivery came in."""
+        if not pn_delivery.readable:
+            return self._process_delivery(pn_delivery)
+        if self.oversized:
+            # until the peer sees the link closed
+            pn_delivery.link.recv(pn_delivery.pending)
+            if not pn_delivery.partial:
+                pn_delivery.settle()
+            return
+
+        size = pn_delivery.pending
+        if self.spool is not None:
+            size += self.spool.size
+        if self.max_message_size and size > self.max_message_size:
+            self.refuse(pn_delivery)
+            return
+        if self.spool is None:
+            if not (pn_delivery.partial and self.spool_threshold):
+                return self._process_delivery(pn_delivery)
+            self.spool = spool.DeliverySpool(self.spool_threshold)
+
+        link = pn_delivery.link
+        self.spool.write(link.recv(pn_delivery.pending))
+        if pn_delivery.partial:
+            return
+        data = self.spool.read()
+        self.spool = None
+        message = proton.Message()
+        message.decode(data)
+        del data
+        link.advance()
+        self.message_received(self.receiver_link, message, pn_delivery)
+
+    def refuse(self, pn_delivery):
+        """Close the link, it sent a message over max_message_size."""
+        LOG.warning("Message over %d bytes on receiver link %s, closing it",
+                    self.max_message_size, self.receiver_link.name)
+        _OVERSIZED.inc()
+        self.oversized = True
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        pn_delivery.link.recv(pn_delivery.pending)
+        if not pn_delivery.partial:
+            pn_delivery.settle()
+        condition = proton.Condition('amqp:link:message-size-exceeded',
+                                     'Messages are limited to %d bytes' %
+                                     self.max_message_size)
+        self.receiver_link.close(condition)
+        self.socket_conn.wakeup()
+
+    def top_up(self):
+        """Grant whatever credit the adaptive window allows."""
+        if self.receiver_link is None:
+            return
+        amount = self.credit.grant(self.receiver_link.capacity)
+        if amount:
+            self.receiver_link.add_capacity(amount)
+            self.socket_conn.wakeup()
 
     def message_received(self, receiver_link, message, handle):
-        self.receiver_link.message_accepted(handle)
-        print("Message received on receiver link %s, message = %s"
-              % (self.receiver_link.name, str(message)))
-        if receiver_link.capacity < 1:
-            receiver_link.add_capacity(1)
+        if TRACER.enabled and TRACER.sample():
+            TRACER.log("Message received on receiver link %s, message = %s",
+                       self.receiver_link.name, message)
+        size = flow.message_size(message)
+        self.credit.received(size)
         queue = receiver_link.target_address
-        self.controllers.on_post(message, queue)
+        _RECEIVED.inc((queue,))
+
+        if self.presettled:
+            # nothing to answer, drop pyngus' record of the delivery now
+            self.dispose(handle, True)
+            handle = None
+
+        # The delivery is settled once storage has the message:
+        self.controllers.on_post(message, queue,
+                                 functools.partial(self.settle, handle, size),
+                                 size)
+        self.top_up()
+
+    def settle(self, handle, size, success):
+        self.credit.settled(size, success)
+        if self.receiver_link is None:
+            # link went away before the write completed
+            return
+        if handle is None:
+            # presettled, only the credit window cares
+            self.top_up()
+            return
+        self.dispose(handle, success)
+        self.socket_conn.wakeup()
+        self.top_up()
+
+    def dispose(self, handle, accepted):
+        """Settle a delivery, by its pyngus handle or itself if spooled."""
+        if isinstance(handle, proton.Delivery):
+            handle.update(proton.Delivery.ACCEPTED if accepted else
+                          proton.Delivery.REJECTED)
+            handle.settle()
+        elif accepted:
+            self.receiver_link.message_accepted(handle)
+        else:
+            self.receiver_link.message_rejected(handle)
+
+
+class ConnectionTimers(object):
+    """The pyngus deadlines of the connections, in a timer wheel.
+
+    Moving a deadline is O(1) and leaves nothing behind, and a tick only
+    looks at the connections that are due, so thousands of connections
+    with heartbeat timers cost nothing while idle. Deadlines are rounded
+    up to `resolution` seconds.
+    """
+
+    def __init__(self, resolution=0.01, span=30):
+        self._wheel = timers.TimerWheel(resolution, span)
+        self._deadlines = {}
+
+    def update(self, sconn):
+        deadline = sconn.connection.next_tick
+        if deadline != self._deadlines.get(sconn):
+            if deadline:
+                self._deadlines[sconn] = deadline
+                self._wheel.schedule(sconn, deadline)
+            else:
+                self.remove(sconn)
+
+    def remove(self, sconn):
+        self._deadlines.pop(sconn, None)
+        self._wheel.cancel(sconn)
+
+    def deadline(self):
+        return self._wheel.deadline()
+
+    def expired(self, now):
+        for sconn in self._wheel.advance(now):
+            deadline = self._deadlines[sconn]
+            if deadline > now:
+                # further away than the wheel spans
+                self._wheel.schedule(sconn, deadline)
+            else:
+                del self._deadlines[sconn]
+                yield sconn
+
+
+class SelectPoller(object):
+    """Rebuild the select() fd sets from the connections on every tick.
+
+    This is O(n) in the number of connections per tick and is limited to
+    FD_SETSIZE descriptors, but needs nothing beyond the select module.
+    """
+
+    def __init__(self, container, listener):
+        self.container = container
+        self.listener = listener
+        self._extra = [listener]
+        self._connections = set()
+        self._timers = ConnectionTimers()
+        self._readers = []
+        self._writers = []
+
+    def add_reader(self, fileobj):
+        """Also watch fileobj, which isn't a connection, for input."""
+        self._extra.append(fileobj)
+
+    def remove_reader(self, fileobj):
+        self._extra.remove(fileobj)
+
+    def register(self, sconn):
+        self._connections.add(sconn)
+        self._timers.update(sconn)
+
+    def unregister(self, sconn):
+        self._connections.discard(sconn)
+        self._timers.remove(sconn)
+
+    def update(self, sconn):
+        if sconn in self._connections:
+            self._timers.update(sconn)
+
+    def prepare(self):
+        """Snapshot the connections that need work, return next deadline."""
+        readers = list(self._extra)
+        writers = []
+        for sconn in self._connections:
+            connection = sconn.connection
+            if connection.needs_input > 0:
+                readers.append(sconn)
+            if sconn.output_pending:
+                writers.append(sconn)
+        self._readers = readers
+        self._writers = writers
+        return self._timers.deadline()
+
+    def poll(self, timeout):
+        readable, writable, ignore = select.select(self._readers,
+                                                   self._writers,
+                                                   [], timeout)
+        return readable, writable
 
+    def expired(self, now):
+        return self._timers.expired(now)
 
-def run(opts, controllers):
+
+class SelectorsPoller(object):
+    """Keep every connection registered with a selectors (epoll) selector.
+
+    Connections are registered once and their interest set is modified only
+    when needs_input/has_output actually changes, so a tick costs O(active)
+    instead of O(n).
+    """
+
+    def __init__(self, container, listener):
+        self.container = container
+        self.listener = listener
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listener, selectors.EVENT_READ)
+        self._events = {}
+        self._timers = ConnectionTimers()
+
+    def add_reader(self, fileobj):
+        self._selector.register(fileobj, selectors.EVENT_READ)
+
+    def remove_reader(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def register(self, sconn):
+        self._events[sconn] = 0
+        self.update(sconn)
+
+    def unregister(self, sconn):
+        if self._events.pop(sconn, 0):
+            self._selector.unregister(sconn)
+        self._timers.remove(sconn)
+
+    def update(self, sconn):
+        """Resync interest and deadline of sconn with its pyngus state."""
+        if sconn not in self._events:
+            return
+        connection = sconn.connection
+        events = 0
+        if connection.needs_input > 0:
+            events |= selectors.EVENT_READ
+        if sconn.output_pending:
+            events |= selectors.EVENT_WRITE
+
+        current = self._events[sconn]
+        if events != current:
+            if not events:
+                self._selector.unregister(sconn)
+            elif not current:
+                self._selector.register(sconn, events, sconn)
+            else:
+                self._selector.modify(sconn, events, sconn)
+            self._events[sconn] = events
+
+        self._timers.update(sconn)
+
+    def prepare(self):
+        return self._timers.deadline()
+
+    def poll(self, timeout):
+        readable = []
+        writable = []
+        for key, mask in self._selector.select(timeout):
+            if mask & selectors.EVENT_READ:
+                readable.append(key.fileobj)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(key.fileobj)
+        return readable, writable
+
+    def expired(self, now):
+        return self._timers.expired(now)
+
+
+_POLLERS = {
+    'select': SelectPoller,
+    'selectors': SelectorsPoller,
+}
+
+
+def get_poller(reactor, container, listener):
+    """Return the poller implementing the configured reactor mode."""
+    try:
+        poller = _POLLERS[reactor]
+    except KeyError:
+        raise ValueError("Unknown reactor: %s" % reactor)
+    if poller is SelectorsPoller and selectors is None:
+        LOG.warning("selectors module not available, falling back to "
+                    "select()")
+        poller = SelectPoller
+    return poller(container, listener)
+
+
+def reap(wheel, timeout, now):
+    """Yield the connections in `wheel` without input for `timeout`.
+
+    This catches the clients that never completed the AMQP open, whose
+    idle timeout isn't running yet. Connections that got input since
+    they were scheduled are scheduled again.
+    """
+    for sconn in wheel.advance(now):
+        deadline = sconn.last_input + timeout
+        if deadline > now:
+            wheel.schedule(sconn, deadline)
+        elif not sconn.closed:
+            LOG.info("Closing connection %s, idle for %.0f seconds",
+                     sconn.connection.name, now - sconn.last_input)
+            _REAPED.inc(('reaper',))
+            yield sconn
+
+
+def accept(listener, limits, count, now):
+    """Accept up to `count` pending connections within `limits`.
+
+    Yields the (socket, address) of the connections to serve, those over
+    a limit are closed.
+    """
+    for i in range(limits.available(now, count)):
+        try:
+            client_socket, client_address = listener.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            if e.errno == errno.ECONNABORTED:
+                continue
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                           errno.ENOMEM):
+                # the backlog would keep the listener readable, give
+                # closing connections some time to free descriptors
+                LOG.error("Cannot accept connections: %s", e)
+                limits.backoff(now, 1)
+                break
+            raise
+        limit = limits.admit(client_address[0], now)
+        if limit is not None:
+            _REJECTED.inc((limit,))
+            client_socket.close()
+            continue
+        yield client_socket, client_address
+
+
+def run(opts, controllers, conf):
 
     # Create a socket for inbound connections
     # For now the address is the only opt
     host, port = utils.get_host_port(opts)
-    s = utils.server_socket(host, port)
+    s = utils.server_socket(host, port, backlog=conf.backlog,
+                            reuse_port=conf.workers > 1)
+    limits = admission.Admission(conf.max_connections,
+                                 conf.max_connections_per_host,
+                                 conf.accept_rate, conf.accept_batch)
+    accepting = True
+
+    # Proton sends heartbeats and times out connections idle past the
+    # idle timeout, the reaper handles those that never opened
+    conn_properties = {'max-frame-size': conf.max_frame_size}
+    reaper = None
+    if conf.idle_timeout > 0:
+        conn_properties['idle-time-out'] = conf.idle_timeout
+        reaper = timers.TimerWheel(1, conf.idle_timeout)
 
     # Create an AMQP container that will provide the server service
     container = pyngus.Container("Marconi")
     socket_connections = set()
+    # the loop reads one socket at a time, they can share a buffer
+    read_buffer = buffers.ReadBuffer()
+    poller = get_poller(conf.reactor, container, s)
+    wakeups = set()
+    credit_policy = flow.CreditPolicy(conf.receiver_credit,
+                                      conf.receiver_credit_min,
+                                      conf.receiver_credit_max,
+                                      conf.receiver_credit_budget,
+                                      conf.max_message_size,
+                                      conf.spool_threshold)
 
-    # Main loop: process I/O and timer events
-    while True:
-        readers, writers, timers = container.need_processing()
+    # Storage calls run on worker threads that wake the loop up through
+    # a pipe when they complete.
+    pool = None
+    if conf.storage_pool_size > 0:
+        pool = executor.StoragePool(conf.storage_pool_size)
+        controllers.executor = pool
+        poller.add_reader(pool)
+
+    # Writes are announced to the other transport processes, if any
+    notifier = notify.get_notifier(conf.notifier_url)
+    if notifier is not None:
+        controllers.bus.notifier = notifier
+        poller.add_reader(notifier)
+
+    TRACER.configure(conf.trace_sample)
 
-        # Map pyngus Connections back to my SocketConnections:
-        readfd = [c.user_context for c in readers]
-        writefd = [c.user_context for c in writers]
+    stats_file = None
+    if conf.stats_file:
+        stats_file = stats.StatsFile(conf.stats_file, conf.stats_interval,
+                                     worker=conf.workers > 1)
+        stats.REGISTRY.on_collect(
+            functools.partial(collect_stats, socket_connections,
+                              credit_policy))
+
+    # Main loop: process I/O and timer events. The clock is read once
+    # after poll() returns and that time is used for the whole iteration.
+    now = time.time()
+    while True:
+        # leave new connections in the backlog while over the limits
+        if accepting != bool(limits.available(now, 1)):
+            accepting = not accepting
+            if accepting:
+                poller.add_reader(s)
+            else:
+                poller.remove_reader(s)
 
         timeout = None
-        if timers:
-            deadline = timers[0].next_tick  # [0] == next expiring timer
-            now = time.time()
+        deadlines = [poller.prepare(),
+                     controllers.post_deadline(),
+                     controllers.bus.poll_deadline()]
+        if not accepting:
+            deadlines.append(limits.deadline())
+        if reaper is not None:
+            deadlines.append(reaper.deadline())
+        if stats_file is not None:
+            deadlines.append(stats_file.deadline())
+        deadline = min([d for d in deadlines if d] or [None])
+        if wakeups or controllers.prefetch.backlogged:
+            # woken up while flushing the last iteration, or queues
+            # waiting for their turn to deliver
+            timeout = 0
+        elif deadline:
             timeout = 0 if deadline <= now else deadline - now
 
-        LOG.debug("select() start (t=%s)", str(timeout))
-        readfd.append(s)
-        readable, writable, ignore = select.select(readfd, writefd,
-                                                   [], timeout)
-        LOG.debug("select() returned")
+        readable, writable = poller.poll(timeout)
+        now = time.time()
 
+        # connections to process and flush at the end of the iteration
         worked = set()
         for r in readable:
             if r is s:
-                # new inbound connection request received
-                # create a new SocketConnection for it:
-                client_socket, client_address = s.accept()
-                name = str(client_address)
-                conn_properties = {}
-                sconn = SocketConnection(container,
-                                         client_socket,
-                                         name,
-                                         conn_properties,
-                                         controllers)
-                socket_connections.add(sconn)
-                LOG.debug("new connection created name=%s", name)
+                # new inbound connection requests received
+                # create a new SocketConnection for each:
+                for client_socket, client_address in accept(
+                        s, limits, conf.accept_batch, now):
+                    name = str(client_address)
+                    sconn = SocketConnection(container,
+                                             client_socket,
+                                             name,
+                                             conn_properties,
+                                             controllers,
+                                             wakeups,
+                                             credit_policy,
+                                             read_buffer)
+                    sconn.host = client_address[0]
+                    if conf.tcp_nodelay:
+                        client_socket.setsockopt(socket.IPPROTO_TCP,
+                                                 socket.TCP_NODELAY, 1)
+                    socket_connections.add(sconn)
+                    poller.register(sconn)
+                    if reaper is not None:
+                        reaper.schedule(sconn,
+                                        sconn.last_input + conf.idle_timeout)
+                    worked.add(sconn)
+                    LOG.debug("new connection created name=%s", name)
+
+            elif r is pool:
+                pool.run_completions()
+
+            elif r is notifier:
+                controllers.bus.receive()
 
             else:
                 assert isinstance(r, SocketConnection)
-                r.process_input()
+                r.read_input(now)
                 worked.add(r)
 
-        for t in timers:
-            now = time.time()
-            if t.next_tick > now:
-                break
-            t.process(now)
-            sc = t.user_context
+        for sc in poller.expired(now):
             assert isinstance(sc, SocketConnection)
             worked.add(sc)
 
+        if reaper is not None:
+            for sc in reap(reaper, conf.idle_timeout, now):
+                sc.closed = True
+                worked.add(sc)
+
+        # write out the posts whose batching window closed
+        controllers.flush_posts(now)
+        # let consumers that waited long enough look at storage again
+        controllers.bus.expire(now)
+        # one round of deliveries from the queues left with some
+        controllers.prefetch.run()
+
         for w in writable:
             assert isinstance(w, SocketConnection)
-            w.send_output()
             worked.add(w)
+        writable = set(writable)
 
-        # nuke any completed connections:
+        # process each connection once, nuke any completed connections,
+        # and resync the poller with the ones still alive. Output is
+        # only written to the sockets reported writable: what the others
+        # produced waits for the next poll, which returns right away,
+        # and goes out in one write with the output of that iteration.
+        # Connections woken up by these flushes are handled by the next
+        # iteration too.
+        worked.update(wakeups)
+        wakeups.clear()
         closed = False
         while worked:
             sc = worked.pop()
+            if not sc.closed:
+                sc.flush(now, sc in writable)
             if sc.closed:
                 socket_connections.discard(sc)
+                poller.unregister(sc)
                 sc.destroy()
+                limits.release(sc.host)
+                if reaper is not None:
+                    reaper.cancel(sc)
                 closed = True
+            else:
+                poller.update(sc)
         if closed:
             LOG.debug("%d active connections present", len(socket_connections))
 
+        finished = time.time()
+        _ITERATION.observe(finished - now)
+        if stats_file is not None:
+            stats_file.write(finished)
+        now = finished
+
     return 0
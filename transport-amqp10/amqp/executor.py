@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Executors for the storage calls made on behalf of AMQP links."""
+
+import collections
+import errno
+import fcntl
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import zaqar.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def _call(func, args):
+    try:
+        return func(*args), None
+    except Exception as ex:
+        return None, ex
+
+
+class InlineExecutor(object):
+    """Run storage calls right away on the calling thread."""
+
+    def submit(self, key, func, args, callback=None):
+        result, error = _call(func, args)
+        if callback:
+            callback(result, error)
+
+
+class StoragePool(object):
+    """Run storage calls on a bounded set of worker threads.
+
+    Calls submitted with the same key (a queue name) run one at a time and
+    in submission order. Completion callbacks are queued and the read end
+    of a pipe becomes readable; the event loop watches fileno() and calls
+    run_completions(), so callbacks always run on the event loop thread.
+    """
+
+    def __init__(self, size):
+        self._ready = queue.Queue()
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._completions = collections.deque()
+        self._wakeup = Wakeup()
+
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._work,
+                                 name='amqp-storage-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def fileno(self):
+        return self._wakeup.fileno()
+
+    def submit(self, key, func, args, callback=None):
+        job = (func, args, callback)
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is not None:
+                # something for this key is queued or running already
+                lane.append(job)
+                return
+            self._lanes[key] = collections.deque()
+        self._ready.put((key, job))
+
+    def _work(self):
+        while True:
+            key, (func, args, callback) = self._ready.get()
+            result, error = _call(func, args)
+            if callback:
+                self._completions.append((callback, result, error))
+                self._wakeup.set()
+
+            # hand the lane's next call back to the pool so a busy queue
+            # doesn't keep this thread to itself
+            with self._lock:
+                lane = self._lanes[key]
+                if lane:
+                    self._ready.put((key, lane.popleft()))
+                else:
+                    del self._lanes[key]
+
+    def run_completions(self):
+        """Drain the wakeup pipe and run the pending callbacks."""
+        self._wakeup.clear()
+
+        completions = self._completions
+        while completions:
+            callback, result, error = completions.popleft()
+            try:
+                callback(result, error)
+            except Exception as ex:
+                LOG.exception(ex)
+
+
+class Wakeup(object):
+    """Pipe that makes the event loop's poll return from another thread."""
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            _set_nonblocking(fd)
+
+    def fileno(self):
+        return self._r
+
+    def set(self):
+        try:
+            os.write(self._w, b'x')
+        except OSError as e:
+            # a full pipe already guarantees a wakeup
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive credit for receiver links."""
+
+
+def message_size(message):
+    """Best effort size of a Proton Message body, in bytes."""
+    try:
+        return len(message.body)
+    except TypeError:
+        return 0
+
+
+class CreditPolicy(object):
+    """Credit settings and memory budget shared by all receiver links.
+
+    `budget` bounds the bytes received process wide but not stored yet.
+    Links stop being granted credit while the budget is exhausted and are
+    woken up again as writes complete.
+
+    `max_message_size` bounds the size of a single delivery, 0 means no
+    limit. Deliveries spanning several frames are spooled as they come
+    in, to a temporary file past `spool_threshold` bytes; 0 leaves them
+    to the AMQP engine until complete.
+    """
+
+    def __init__(self, initial=1, minimum=1, maximum=1, budget=0,
+                 max_message_size=0, spool_threshold=0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.budget = budget
+        self.max_message_size = max_message_size
+        self.spool_threshold = spool_threshold
+        self.used = 0
+        self.starved = set()
+
+    @property
+    def exhausted(self):
+        return self.budget and self.used >= self.budget
+
+    @property
+    def pressure(self):
+        """True once three quarters of the budget are in use."""
+        return self.budget and self.used * 4 >= self.budget * 3
+
+    def reserve(self, size):
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+        if self.starved and not self.exhausted:
+            starved, self.starved = self.starved, set()
+            for callback in starved:
+                callback()
+
+    def link(self, top_up):
+        return LinkCredit(self, top_up)
+
+
+class LinkCredit(object):
+    """AIMD credit window of a single receiver link.
+
+    The window grows by one for every message stored while the process is
+    under its memory budget, and is halved whenever a write fails or the
+    budget comes under pressure. Credit is topped up in bulk once half of
+    the window has been used, so flow frames don't go out per message.
+    """
+
+    def __init__(self, policy, top_up):
+        self.policy = policy
+        self.window = policy.initial
+        self.unsettled = 0
+        # called to grant credit again once the budget frees up
+        self.top_up = top_up
+
+    def received(self, size):
+        self.unsettled += 1
+        self.policy.reserve(size)
+
+    def settled(self, size, success):
+        self.unsettled -= 1
+        if success and not self.policy.pressure:
+            self.window = min(self.policy.maximum, self.window + 1)
+        else:
+            self.window = max(self.policy.minimum, self.window // 2)
+        self.policy.release(size)
+
+    def grant(self, capacity):
+        """Return how much credit to add to a link holding `capacity`."""
+        if self.policy.exhausted:
+            self.policy.starved.add(self.top_up)
+            return 0
+        missing = self.window - self.unsettled - capacity
+        if missing > 0 and capacity <= self.window // 2:
+            return missing
+        return 0
+
+    def discard(self):
+        self.policy.starved.discard(self.top_up)
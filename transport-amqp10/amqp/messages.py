@@ -11,64 +11,377 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import functools
+import threading
+import time
 import uuid
 
 import zaqar.openstack.common.log as logging
+from zaqar.openstack.common.gettextutils import _
+from zaqar.queues.storage import errors as storage_errors
+from zaqar.queues.transport.amqp import executor as executors
+from zaqar.queues.transport.amqp import notify
+from zaqar.queues.transport.amqp import prefetch
+from zaqar.queues.transport.amqp import schedule
+from zaqar.queues.transport.amqp import stats
 from zaqar.queues.transport.amqp import utils
 
 LOG = logging.getLogger(__name__)
 
+_STORAGE_SECONDS = stats.Histogram('amqp_storage_seconds',
+                                   'Duration of storage calls, by '
+                                   'operation.', labels=('op',))
+
+
+def _timed(op):
+    """Observe the duration of the decorated storage call."""
+    key = (op,)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _STORAGE_SECONDS.observe(time.time() - start, key)
+        return timed
+    return decorator
+
+
+class PostWindow(object):
+    """Messages received for a queue that haven't been written yet."""
+
+    __slots__ = ('deadline', 'messages', 'callbacks', 'size')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.messages = []
+        self.callbacks = []
+        self.size = 0
+
+
+class QueueCache(object):
+    """Names of queues known to exist, with TTL and LRU eviction.
+
+    Used from the storage worker threads, hence the lock.
+    """
+
+    __slots__ = ('ttl', 'size', 'entries', 'lock')
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, queue_name):
+        with self.lock:
+            expires = self.entries.pop(queue_name, None)
+            if expires is None:
+                return False
+            if expires < time.time():
+                return False
+            # re-insert as most recently used
+            self.entries[queue_name] = expires
+            return True
+
+    def add(self, queue_name):
+        with self.lock:
+            self.entries.pop(queue_name, None)
+            self.entries[queue_name] = time.time() + self.ttl
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, queue_name):
+        with self.lock:
+            self.entries.pop(queue_name, None)
+
+
+class QueueCursor(object):
+    """Position of a browsing consumer in a queue.
+
+    Holds the storage page being read and the marker of the next one, so
+    each read resumes where the previous one stopped instead of listing
+    the queue from its head again.
+    """
+
+    __slots__ = ('message_controller', 'queue_name', 'marker', '_results',
+                 '_page', '_page_limit', '_page_read')
+
+    def __init__(self, message_controller, queue_name):
+        self.message_controller = message_controller
+        self.queue_name = queue_name
+        self.marker = None
+        self._results = None
+        self._page = None
+        self._page_limit = 0
+        self._page_read = 0
+
+    @_timed('list')
+    def read(self, limit):
+        """Pull up to `limit` stored messages. Runs on the executor."""
+        messages = []
+        while len(messages) < limit:
+            if self._page is None:
+                results = self.message_controller.list(
+                    self.queue_name, marker=self.marker, limit=limit)
+                self._page = next(results)
+                self._results = results
+                self._page_limit = limit
+                self._page_read = 0
+
+            message = next(self._page, None)
+            if message is not None:
+                self._page_read += 1
+                messages.append(message)
+                continue
+
+            # page done, forget it first so a failure below doesn't leave
+            # the cursor on an exhausted generator
+            results = self._results
+            self._page = None
+            self._results = None
+
+            # storage only knows the marker of the next page if this one
+            # had messages, otherwise the old marker is still right
+            if self._page_read > 0:
+                self.marker = next(results)
+            if self._page_read < self._page_limit:
+                # short page, that's the tail of the queue for now
+                break
+
+        return messages
+
 
 class CollectionResource(object):
+    """Storage operations requested by the AMQP links.
+
+    The on_* methods are called from the event loop. They hand the actual
+    storage calls to `executor` and report back through callbacks, which
+    the executor runs on the event loop thread. Calls for the same queue
+    are executed in the order they were made.
+    """
 
-    __slots__ = ('message_controller', 'queue_controller')
+    __slots__ = ('message_controller', 'queue_controller',
+                 'claim_controller', 'claim_metadata',
+                 'batch_size', 'batch_window', 'batch_bytes', 'windows',
+                 'known_queues', 'executor', 'bus', 'prefetch')
 
-    def __init__(self, message_controller, queue_controller):
+    def __init__(self, message_controller, queue_controller,
+                 claim_controller, claim_ttl=60, claim_grace=60,
+                 batch_size=1, batch_window=0, queue_cache_ttl=60,
+                 queue_cache_size=1000, idle_poll_interval=0,
+                 prefetch_size=20, prefetch_bytes=1024 * 1024,
+                 batch_bytes=0, dispatch_quantum=0, queue_weights=None):
         self.message_controller = message_controller
         self.queue_controller = queue_controller
+        self.claim_controller = claim_controller
+        self.claim_metadata = {'ttl': claim_ttl, 'grace': claim_grace}
+
+        # Posts to the same queue are coalesced until either batch_size
+        # messages or batch_bytes of bodies are waiting, or batch_window
+        # seconds have passed.
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.batch_bytes = batch_bytes
+        self.windows = {}
+
+        self.known_queues = QueueCache(queue_cache_ttl, queue_cache_size)
+        self.executor = executors.InlineExecutor()
+        self.bus = notify.Bus(idle_poll_interval)
+        # claimed messages are handed out to the consumers well before
+        # their claim expires, each queue delivering dispatch_quantum
+        # bytes times its weight per round
+        scheduler = None
+        if dispatch_quantum > 0:
+            scheduler = schedule.Scheduler(dispatch_quantum, queue_weights)
+        self.prefetch = prefetch.Prefetch(self, prefetch_size,
+                                          prefetch_bytes, claim_ttl / 2.0,
+                                          scheduler)
+
+    def on_post(self, message, queue_name, callback, size=0):
+        """Queue a message for the next write to `queue_name`.
+
+        callback(success) is invoked once the window holding the message
+        has been written to storage, or the write failed. Links waiting on
+        `bus` for the queue are woken up after a successful write. `size`
+        is the size of the message body.
+        """
 
-    def on_post(self, message, queue_name):
+        window = self.windows.get(queue_name)
+        if window is None:
+            window = PostWindow(time.time() + self.batch_window)
+            self.windows[queue_name] = window
+        window.messages.append(message)
+        window.callbacks.append(callback)
+        window.size += size
+
+        if (len(window.messages) >= self.batch_size or
+                self.batch_bytes and window.size >= self.batch_bytes):
+            self.flush_window(queue_name)
+
+    def post_deadline(self):
+        """Return when the oldest open window must be written, or None."""
+        if not self.windows:
+            return None
+        return min(w.deadline for w in self.windows.values())
+
+    def flush_posts(self, now):
+        """Write every window whose deadline has passed."""
+        for queue_name, window in list(self.windows.items()):
+            if window.deadline <= now:
+                self.flush_window(queue_name)
+
+    def flush_window(self, queue_name):
+        window = self.windows.pop(queue_name)
+
+        def written(result, error):
+            if error is not None:
+                LOG.error(_(u'Writing messages to %(queue)s failed: '
+                            u'%(error)s'),
+                          {'queue': queue_name, 'error': error})
+            success = error is None
+            for callback in window.callbacks:
+                callback(success)
+            if success:
+                # only now can a claim find the messages
+                self.bus.publish(queue_name)
+
+        self.executor.submit(queue_name, self.post,
+                             (window.messages, queue_name), written)
+
+    @_timed('post')
+    def post(self, messages, queue_name):
+        """Write a list of Proton Messages with a single storage call."""
 
         client_id = uuid.uuid4()
-        zaqar_message = utils.proton_to_zaqar(message)
+        zaqar_messages = [utils.proton_to_zaqar(m) for m in messages]
+
+        if queue_name not in self.known_queues:
+            self.ensure_queue(queue_name)
+
+        try:
+            self.message_controller.post(
+                queue_name,
+                messages=zaqar_messages,
+                client_uuid=client_id)
+        except storage_errors.QueueDoesNotExist:
+            # deleted behind our back, recreate it and try once more
+            self.ensure_queue(queue_name)
+            self.message_controller.post(
+                queue_name,
+                messages=zaqar_messages,
+                client_uuid=client_id)
+
+    def ensure_queue(self, queue_name):
+        """Create the queue unless it's there already and remember it."""
+
+        # create() is a no-op returning False for existing queues, so it
+        # replaces the deprecated exists() check.
+        self.queue_controller.create(queue_name)
+        self.known_queues.add(queue_name)
+
+    def cursor(self, queue_name):
+        """Return a QueueCursor for browsing `queue_name` from its head."""
+        return QueueCursor(self.message_controller, queue_name)
+
+    def on_get(self, cursor, limit, callback):
+        """Read the next `limit` messages after `cursor`, leaving them queued.
+
+        callback(messages) receives an iterator that wraps each stored
+        message for delivery only as it's consumed.
+        """
+
+        def read(result, error):
+            if error is not None:
+                LOG.error(_(u'Reading messages from %(queue)s failed: '
+                            u'%(error)s'),
+                          {'queue': cursor.queue_name, 'error': error})
+                result = []
+            callback(utils.zaqar_to_proton(m) for m in result)
 
-        # NOTE(vkmc): This control has to be removed since exists()
-        # is deprecated
-        if not self.queue_controller.exists(queue_name):
-            self.queue_controller.create(queue_name)
+        self.executor.submit(cursor.queue_name, cursor.read, (limit,), read)
 
-        self.message_controller.post(
-            queue_name,
-            messages=zaqar_message,
-            client_uuid=client_id)
+    def on_claim(self, queue_name, limit, callback):
+        """Claim up to `limit` messages for delivery.
 
-    def on_get(self, queue_name):
+        callback(claim_id, messages) receives the claim id and a list of
+        (message id, Proton Message) pairs. The messages stay invisible to
+        other consumers until they are deleted, the claim is released or
+        it expires.
+        """
+
+        def claimed(result, error):
+            if error is not None:
+                LOG.error(_(u'Claiming messages from %(queue)s failed: '
+                            u'%(error)s'),
+                          {'queue': queue_name, 'error': error})
+                result = None, []
+            callback(*result)
+
+        self.executor.submit(queue_name, self.claim, (queue_name, limit),
+                             claimed)
+
+    def on_delete(self, queue_name, message_id, claim_id):
+        """Remove a delivered message, under the claim that holds it."""
+        self.executor.submit(queue_name, self.delete,
+                             (queue_name, message_id, claim_id))
+
+    def on_bulk_delete(self, queue_name, message_ids):
+        """Remove messages sent presettled, with a single storage call."""
+        self.executor.submit(queue_name, self.bulk_delete,
+                             (queue_name, message_ids))
+
+    def on_release(self, queue_name, claim_id):
+        """Release a claim so its remaining messages can be redelivered."""
+        self.executor.submit(queue_name, self.release,
+                             (queue_name, claim_id))
+
+    @_timed('claim')
+    def claim(self, queue_name, limit):
 
         try:
-            results = self.message_controller.list(queue_name)
+            claim_id, messages = self.claim_controller.create(
+                queue_name,
+                self.claim_metadata,
+                limit=limit)
+        except storage_errors.QueueDoesNotExist:
+            self.known_queues.invalidate(queue_name)
+            return None, []
+        except Exception as ex:
+            LOG.exception(ex)
+            return None, []
 
-            # Buffer messages
-            cursor = next(results)
-            messages = list(cursor)
+        claimed = []
+        for each_message in messages:
+            msg = utils.zaqar_to_proton(each_message)
+            claimed.append((each_message['id'], msg))
+
+        return claim_id, claimed
+
+    @_timed('delete')
+    def delete(self, queue_name, message_id, claim_id):
+
+        try:
+            self.message_controller.delete(queue_name, message_id,
+                                           claim=claim_id)
         except Exception as ex:
             LOG.exception(ex)
 
-        if not messages:
-            proton_messages = []
-        else:
-            # Found some messages, so convert them to Proton Messages
-            proton_messages = []
-            for each_message in messages:
-                msg = utils.zaqar_to_proton(each_message)
-                proton_messages.append(msg)
+    @_timed('bulk_delete')
+    def bulk_delete(self, queue_name, message_ids):
 
-        return proton_messages
+        try:
+            self.message_controller.bulk_delete(queue_name, message_ids)
+        except Exception as ex:
+            LOG.exception(ex)
 
-    def on_delete(self, queue_name):
+    @_timed('release')
+    def release(self, queue_name, claim_id):
 
-        # NOTE(vkmc) Cannot keep the message id
-        # I directly remove the queue
         try:
-            self.queue_controller.delete(queue_name)
+            self.claim_controller.delete(queue_name, claim_id)
         except Exception as ex:
-            LOG.exception(ex)
\ No newline at end of file
+            LOG.exception(ex)
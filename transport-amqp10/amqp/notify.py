@@ -0,0 +1,327 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Notifications of new messages in a queue."""
+
+import abc
+import collections
+import errno
+import socket
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib import parse as urlparse
+except ImportError:
+    import urlparse
+
+import six
+
+import zaqar.openstack.common.log as logging
+from zaqar.queues.transport.amqp import executor
+
+LOG = logging.getLogger(__name__)
+
+_REDIS_CHANNEL = 'zaqar-amqp-notify'
+
+
+class Bus(object):
+    """New message notifications for the links of this process.
+
+    Consumer links that found their queue empty subscribe a callback
+    instead of polling storage, and are called once the next write to
+    that queue completes. Subscriptions are one-shot. Everything runs on
+    the event loop thread.
+
+    With a `notifier`, writes are also announced to the other transport
+    processes and their announcements wake up local links. Notifiers are
+    best effort, so when `poll_interval` is set waiting links are woken
+    up that often regardless and check storage again.
+    """
+
+    def __init__(self, poll_interval=0):
+        # queue name -> set of callbacks
+        self.waiters = {}
+        self.notifier = None
+        self.poll_interval = poll_interval
+        self.next_poll = None
+
+    def subscribe(self, queue_name, callback):
+        if not self.waiters and self.poll_interval:
+            self.next_poll = time.time() + self.poll_interval
+        self.waiters.setdefault(queue_name, set()).add(callback)
+
+    def unsubscribe(self, queue_name, callback):
+        waiters = self.waiters.get(queue_name)
+        if waiters is not None:
+            waiters.discard(callback)
+            if not waiters:
+                del self.waiters[queue_name]
+
+    def publish(self, queue_name):
+        """Wake up every link waiting on `queue_name`, here and remotely."""
+        self._wake(queue_name)
+        if self.notifier is not None:
+            self.notifier.publish(queue_name)
+
+    def receive(self):
+        """Wake up the links of queues announced by other processes."""
+        for queue_name in self.notifier.receive():
+            self._wake(queue_name)
+
+    def poll_deadline(self):
+        """Return when waiting links must check storage again, or None."""
+        if self.waiters and self.poll_interval:
+            return self.next_poll
+        return None
+
+    def expire(self, now):
+        deadline = self.poll_deadline()
+        if deadline is None or deadline > now:
+            return
+        waiters, self.waiters = self.waiters, {}
+        for callbacks in waiters.values():
+            for callback in callbacks:
+                callback()
+
+    def _wake(self, queue_name):
+        waiters = self.waiters.pop(queue_name, None)
+        if waiters:
+            for callback in waiters:
+                callback()
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Notifier(object):
+    """Announce queue names to, and hear them from, other processes.
+
+    receive() runs on the event loop thread once fileno() is readable.
+    Announcements made by this notifier are not delivered back to it.
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+
+    @abc.abstractmethod
+    def fileno(self):
+        """Return a descriptor that's readable once announcements arrived."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def publish(self, queue_name):
+        """Announce a write to `queue_name` to the other processes."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def receive(self):
+        """Yield the queue names announced since the last call."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+    def _encode(self, queue_name):
+        return (u'%s %s' % (self.origin, queue_name)).encode('utf-8')
+
+    def _decode(self, data):
+        """Return the queue name in `data`, or None if it's our own."""
+        if not isinstance(data, type(u'')):
+            data = data.decode('utf-8')
+        origin, _sep, queue_name = data.partition(u' ')
+        if origin == self.origin or not queue_name:
+            return None
+        return queue_name
+
+
+class InboxNotifier(Notifier):
+    """Base for notifiers that hear announcements on another thread.
+
+    Announcements are queued with _deliver() and a Wakeup pipe makes the
+    notifier readable for the event loop.
+    """
+
+    def __init__(self):
+        super(InboxNotifier, self).__init__()
+        self._inbox = collections.deque()
+        self._wakeup = executor.Wakeup()
+
+    def fileno(self):
+        return self._wakeup.fileno()
+
+    def receive(self):
+        self._wakeup.clear()
+        inbox = self._inbox
+        while inbox:
+            yield inbox.popleft()
+
+    def close(self):
+        self._wakeup.close()
+
+    def _deliver(self, queue_name):
+        self._inbox.append(queue_name)
+        self._wakeup.set()
+
+
+class MemoryNotifier(InboxNotifier):
+    """Notifiers created with the same hub name hear each other.
+
+    Only reaches the event loops of this process, which is enough to run
+    several loops against one storage in tests.
+    """
+
+    _hubs = collections.defaultdict(list)
+
+    def __init__(self, hub):
+        super(MemoryNotifier, self).__init__()
+        self._members = self._hubs[hub]
+        self._members.append(self)
+
+    def publish(self, queue_name):
+        for member in self._members:
+            if member is not self:
+                member._deliver(queue_name)
+
+    def close(self):
+        self._members.remove(self)
+        super(MemoryNotifier, self).close()
+
+
+class MulticastNotifier(Notifier):
+    """Announce over UDP multicast to the processes of the local network.
+
+    Every process joins `group` on `port`, including the workers sharing a
+    host, which see each other through multicast loopback.
+    """
+
+    def __init__(self, group, port, ttl=1):
+        super(MulticastNotifier, self).__init__()
+        self._address = (group, port)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                          socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('', port))
+        membership = socket.inet_aton(group) + socket.inet_aton('0.0.0.0')
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        s.setblocking(0)
+        self._socket = s
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def publish(self, queue_name):
+        try:
+            self._socket.sendto(self._encode(queue_name), self._address)
+        except socket.error as e:
+            LOG.warning("Multicast notification for %s dropped: %s",
+                        queue_name, e)
+
+    def receive(self):
+        while True:
+            try:
+                data = self._socket.recv(4096)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    LOG.warning("Multicast receive failed: %s", e)
+                return
+            queue_name = self._decode(data)
+            if queue_name is not None:
+                yield queue_name
+
+    def close(self):
+        self._socket.close()
+
+
+class RedisNotifier(InboxNotifier):
+    """Announce through a Redis pub/sub channel.
+
+    Publishing and listening happen on their own threads so the event
+    loop never waits on Redis. Announcements queued while a publish is in
+    flight are coalesced per queue.
+    """
+
+    def __init__(self, url, channel=_REDIS_CHANNEL):
+        # optional dependency, only needed with a redis:// notifier
+        import redis
+
+        super(RedisNotifier, self).__init__()
+        self._channel = channel
+        self._client = redis.StrictRedis.from_url(url)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(channel)
+        self._outbox = queue.Queue()
+
+        for target in (self._listen, self._send):
+            t = threading.Thread(target=target,
+                                 name='amqp-notify-' + target.__name__[1:])
+            t.daemon = True
+            t.start()
+
+    def publish(self, queue_name):
+        self._outbox.put(queue_name)
+
+    def _send(self):
+        while True:
+            pending = set([self._outbox.get()])
+            try:
+                while True:
+                    pending.add(self._outbox.get_nowait())
+            except queue.Empty:
+                pass
+
+            for queue_name in pending:
+                try:
+                    self._client.publish(self._channel,
+                                         self._encode(queue_name))
+                except Exception as ex:
+                    LOG.warning("Redis notification for %s dropped: %s",
+                                queue_name, ex)
+
+    def _listen(self):
+        while True:
+            try:
+                for message in self._pubsub.listen():
+                    queue_name = self._decode(message['data'])
+                    if queue_name is not None:
+                        self._deliver(queue_name)
+            except Exception as ex:
+                LOG.warning("Redis notifications interrupted: %s", ex)
+                time.sleep(1)
+
+
+def get_notifier(url):
+    """Return the Notifier for `url`, or None when it's empty.
+
+    udp://<group>:<port> announces over multicast, redis://... through
+    Redis pub/sub and memory://<hub> within this process only.
+    """
+    if not url:
+        return None
+
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'udp':
+        return MulticastNotifier(parsed.hostname, parsed.port)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisNotifier(url)
+    if parsed.scheme == 'memory':
+        return MemoryNotifier(parsed.netloc)
+    raise ValueError("Unknown notifier: %s" % url)
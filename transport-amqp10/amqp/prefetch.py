@@ -0,0 +1,386 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Claimed messages buffered per queue for the consumer links."""
+
+import collections
+import time
+
+import pyngus
+
+from zaqar.queues.transport.amqp import flow
+from zaqar.queues.transport.amqp import schedule
+
+# AMQP priorities 0 to 9 are told apart, higher ones are delivered as 9
+PRIORITY_LEVELS = 10
+
+
+def priority_level(message):
+    """Priority level of a claimed utils.Envelope."""
+    priority = message.get('priority')
+    if priority is None:
+        # stored without, as the AMQP default
+        return 4
+    return min(priority, PRIORITY_LEVELS - 1)
+
+
+class Claim(object):
+    """Messages of a storage claim that are not settled yet."""
+
+    __slots__ = ('claim_id', 'outstanding', 'release', 'claimed_at')
+
+    def __init__(self, claim_id, outstanding):
+        self.claim_id = claim_id
+        self.outstanding = outstanding
+        # set when any message of the claim wasn't accepted
+        self.release = False
+        self.claimed_at = time.time()
+
+
+class PriorityEntries(object):
+    """Buffered messages by priority, each level in queue order.
+
+    Offers the deque operations the buffer uses: popleft() returns the
+    oldest entry of the highest priority, and pop() the newest of the
+    lowest, the first to give back. Entries are tuples ending with their
+    priority level.
+    """
+
+    __slots__ = ('levels', 'top', 'count')
+
+    def __init__(self):
+        self.levels = [collections.deque() for i in range(PRIORITY_LEVELS)]
+        # no entries above this level
+        self.top = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, entry):
+        level = entry[-1]
+        self.levels[level].append(entry)
+        self.count += 1
+        if level > self.top:
+            self.top = level
+
+    def appendleft(self, entry):
+        level = entry[-1]
+        self.levels[level].appendleft(entry)
+        self.count += 1
+        if level > self.top:
+            self.top = level
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError('pop from empty PriorityEntries')
+        levels = self.levels
+        top = self.top
+        while not levels[top]:
+            top -= 1
+        self.top = top
+        self.count -= 1
+        return levels[top].popleft()
+
+    def pop(self):
+        if not self.count:
+            raise IndexError('pop from empty PriorityEntries')
+        for level in self.levels:
+            if level:
+                self.count -= 1
+                return level.pop()
+
+
+class QueueBuffer(object):
+    """Claimed messages of one queue, shared by its consumer links.
+
+    Messages are claimed in bulk and handed out one at a time to the links
+    holding credit, in round-robin order, so every claimed message goes to
+    exactly one consumer. A claim is released once each of its messages
+    was either accepted (and deleted) or given back: not accepted by the
+    consumer, evicted from the buffer, or never settled because its link
+    went away. Releasing earlier would make messages still in flight
+    visible to other consumers.
+
+    Messages sent to presettled links count as accepted right away and
+    are deleted in bulk once per dispatch.
+
+    Buffered messages go out by AMQP priority, then in queue order. Only
+    what was claimed is ordered, a more urgent message further down the
+    queue waits for its claim.
+
+    With a schedule.Scheduler, dispatches are bounded to the queue's
+    share of a round and the rest waits for its next turn.
+
+    However much credit the consumers hold, the buffer keeps at most the
+    prefetch size and bytes claimed. While they have credit left, it
+    claims more once it is down to half of either.
+
+    Consumer links provide `credit`, `presettled`, `queued` (managed by
+    the buffer) and deliver(claim, message_id, message).
+    """
+
+    def __init__(self, prefetch, queue_name):
+        self.prefetch = prefetch
+        self.controllers = prefetch.controllers
+        self.queue_name = queue_name
+        # (claim, message id, message, size, priority level)
+        self.entries = PriorityEntries()
+        self.bytes = 0
+        # links with credit waiting for messages, round-robin order
+        self.consumers = collections.deque()
+        self.links = 0
+        self.fetching = False
+        self.waiting = False
+        self.dispatching = False
+        # body size of the last claim's messages, on average
+        self.average = None
+        # managed by the scheduler
+        self.deficit = 0
+        self.scheduled = False
+
+    @property
+    def backlogged(self):
+        """True while messages and credit are left for another turn."""
+        return bool(self.consumers and self.entries)
+
+    def attach(self):
+        self.links += 1
+
+    def detach(self, link, in_flight):
+        """Forget `link`, giving back the deliveries it never settled."""
+        self.links -= 1
+        if link.queued:
+            link.queued = False
+            self.consumers.remove(link)
+        for claim, message_id in in_flight:
+            self._give_back(claim)
+
+        if not self.links:
+            while self.entries:
+                self._evict(self.entries.pop())
+            if self.waiting:
+                self.waiting = False
+                self.controllers.bus.unsubscribe(self.queue_name, self.wake)
+            self.prefetch.discard(self)
+
+    def want(self, link):
+        """`link` has credit, hand it messages now or once claimed."""
+        if not link.queued:
+            link.queued = True
+            self.consumers.append(link)
+        self.prefetch.dispatch(self)
+
+    def dispatch(self, budget=None):
+        """Hand out messages, up to `budget` if any, and return the rest.
+
+        Each message costs its size plus schedule.MESSAGE_COST.
+        """
+        if self.dispatching:
+            # a claim completed inline, the running dispatch goes on
+            # with its messages
+            return budget
+        self.dispatching = True
+        try:
+            while True:
+                budget = self._hand_out(budget)
+                if not self._needs_fetch():
+                    break
+                count = len(self.entries)
+                self.fetch()
+                if len(self.entries) == count:
+                    # claiming in the background, or nothing was claimed
+                    break
+        finally:
+            self.dispatching = False
+        return budget
+
+    def _hand_out(self, budget):
+        consumers = self.consumers
+        entries = self.entries
+        max_age = self.prefetch.max_age
+        now = time.time()
+        # (claim, message id) sent presettled
+        sent = []
+
+        while consumers and entries:
+            link = consumers.popleft()
+            if link.credit <= 0:
+                link.queued = False
+                continue
+
+            entry = entries.popleft()
+            claim, message_id, message, size, level = entry
+            if now - claim.claimed_at > max_age:
+                # the claim could expire before the consumer settles
+                self.bytes -= size
+                self._give_back(claim)
+                consumers.appendleft(link)
+                continue
+            if budget is not None:
+                cost = size + schedule.MESSAGE_COST
+                if cost > budget:
+                    # the rest waits for the queue's next turn
+                    entries.appendleft(entry)
+                    consumers.appendleft(link)
+                    break
+                budget -= cost
+            self.bytes -= size
+
+            link.deliver(claim, message_id, message)
+            if link.presettled:
+                sent.append((claim, message_id))
+            if link.credit > 0:
+                consumers.append(link)
+            else:
+                link.queued = False
+
+        if sent:
+            # delete before any release of their claims is submitted
+            self.controllers.on_bulk_delete(
+                self.queue_name, [message_id for claim, message_id in sent])
+            for claim, message_id in sent:
+                self._settled(claim)
+
+        return budget
+
+    def _needs_fetch(self):
+        if not self.consumers or self.fetching or self.waiting:
+            return False
+        # refill before the consumers run out
+        return (len(self.entries) <= self.prefetch.size // 2 and
+                self.bytes <= self.prefetch.max_bytes // 2)
+
+    def fetch(self):
+        """Claim what the buffer has room for."""
+        limit = self.prefetch.size - len(self.entries)
+        if self.average:
+            room = (self.prefetch.max_bytes - self.bytes) // self.average
+            limit = min(limit, room)
+        if not self.entries:
+            # messages bigger than prefetch_bytes go out one at a time
+            limit = max(limit, 1)
+        if limit <= 0:
+            return
+        self.fetching = True
+        self.controllers.on_claim(self.queue_name, limit, self.claimed)
+
+    def claimed(self, claim_id, messages):
+        """Storage answered a claim request."""
+        self.fetching = False
+        if not self.links:
+            # every link went away while claiming
+            if messages:
+                self.controllers.on_release(self.queue_name, claim_id)
+            return
+
+        if not messages:
+            if self.consumers and not self.waiting:
+                # hold on to the credit until a post lands
+                self.waiting = True
+                self.controllers.bus.subscribe(self.queue_name, self.wake)
+            return
+
+        claim = Claim(claim_id, len(messages))
+        total = 0
+        for message_id, message in messages:
+            size = flow.message_size(message)
+            self.entries.append((claim, message_id, message, size,
+                                 priority_level(message)))
+            total += size
+        self.bytes += total
+        self.average = max(1, total // len(messages))
+
+        # keep within bounds should the messages be bigger than the last
+        # ones, giving back the newest of the lowest priority so each
+        # level stays in queue order
+        entries = self.entries
+        while len(entries) > 1 and (
+                len(entries) > self.prefetch.size or
+                self.bytes > self.prefetch.max_bytes):
+            self._evict(entries.pop())
+        self.prefetch.dispatch(self)
+
+    def wake(self):
+        """The queue got new messages."""
+        self.waiting = False
+        self.prefetch.dispatch(self)
+
+    def settle(self, claim, message_id, status):
+        """Apply the consumer's outcome for one delivery to storage."""
+        if status == pyngus.SenderLink.ACCEPTED:
+            self.controllers.on_delete(self.queue_name, message_id,
+                                       claim.claim_id)
+            self._settled(claim)
+        else:
+            self._give_back(claim)
+
+    def _evict(self, entry):
+        self.bytes -= entry[3]
+        self._give_back(entry[0])
+
+    def _give_back(self, claim):
+        claim.release = True
+        self._settled(claim)
+
+    def _settled(self, claim):
+        claim.outstanding -= 1
+        if claim.outstanding == 0 and claim.release:
+            self.controllers.on_release(self.queue_name, claim.claim_id)
+
+
+class Prefetch(object):
+    """The QueueBuffers of the queues that have consumer links.
+
+    `size` and `max_bytes` bound what each buffer keeps claimed ahead of
+    the consumers. Messages claimed more than `max_age` seconds ago are
+    given back instead of delivered, so a claim doesn't expire while its
+    messages are in flight. `scheduler` shares the delivery work between
+    the buffers, when set.
+    """
+
+    def __init__(self, controllers, size, max_bytes, max_age,
+                 scheduler=None):
+        self.controllers = controllers
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.scheduler = scheduler
+        self.buffers = {}
+
+    @property
+    def backlogged(self):
+        """True while buffers are waiting for their turn to deliver."""
+        return self.scheduler is not None and self.scheduler.backlogged
+
+    def dispatch(self, buf):
+        if self.scheduler is None:
+            buf.dispatch()
+        else:
+            self.scheduler.dispatch(buf)
+
+    def run(self):
+        """Give the buffers waiting for their turn one."""
+        if self.scheduler is not None:
+            self.scheduler.run()
+
+    def buffer(self, queue_name):
+        buf = self.buffers.get(queue_name)
+        if buf is None:
+            buf = QueueBuffer(self, queue_name)
+            self.buffers[queue_name] = buf
+        return buf
+
+    def discard(self, buf):
+        if self.buffers.get(buf.queue_name) is buf:
+            del self.buffers[buf.queue_name]
@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fair share of the delivery work between queues."""
+
+import collections
+
+from zaqar.queues.transport.amqp import stats
+
+_DEFERRED = stats.Counter('amqp_dispatch_deferred_total',
+                          'Deliveries of a queue left for its next turn '
+                          'once it used up its quantum, by queue.',
+                          ('queue',))
+
+# charged per message on top of its body, for encoding and framing it
+MESSAGE_COST = 512
+
+
+class Scheduler(object):
+    """Deficit round-robin between the queues delivering to consumers.
+
+    On each turn a queue may deliver `quantum` bytes times its weight,
+    counting MESSAGE_COST per message on top of the bodies. A queue whose
+    consumers have credit for more is left for the next round, keeping
+    what it didn't spend, while the other queues take their turns. The
+    main loop runs one round per iteration, so however much credit the
+    consumers of a busy queue hold, the messages of quiet ones go out in
+    the same iteration.
+
+    Queues that aren't waiting for their turn deliver right away, with a
+    full quantum. `weights` maps queue names to their weight, a number
+    greater than 0, others weigh 1. Giving a busy queue less than 1
+    shortens the rounds, and so the wait of the others, at the expense
+    of its own throughput.
+
+    The queues are prefetch.QueueBuffers, they provide `queue_name`,
+    `backlogged`, dispatch(budget) returning what's left of the budget,
+    and `deficit` and `scheduled` managed by the scheduler.
+    """
+
+    def __init__(self, quantum, weights=None):
+        self.quantum = quantum
+        self.weights = {}
+        for name, weight in (weights or {}).items():
+            try:
+                weight = float(weight)
+            except (TypeError, ValueError):
+                weight = None
+            # a queue weighing nothing would never get to deliver and
+            # keep the loop polling for its next turn
+            if weight is None or not weight > 0:
+                raise ValueError('weight of queue %s must be a number '
+                                 'greater than 0, not %r'
+                                 % (name, weights[name]))
+            self.weights[name] = weight
+        # queues waiting for their turn, in round order
+        self.active = collections.deque()
+
+    @property
+    def backlogged(self):
+        return bool(self.active)
+
+    def weight(self, queue_name):
+        return self.weights.get(queue_name, 1)
+
+    def dispatch(self, buf):
+        """`buf` has something to deliver, unless it's waiting its turn."""
+        if not buf.scheduled:
+            self._turn(buf, self.quantum * self.weight(buf.queue_name))
+
+    def run(self):
+        """Give every queue waiting for its turn one, in order."""
+        for i in range(len(self.active)):
+            buf = self.active.popleft()
+            self._turn(buf, buf.deficit +
+                       self.quantum * self.weight(buf.queue_name))
+
+    def _turn(self, buf, budget):
+        # claims completing inline while delivering wait for the next
+        # turn instead of starting another one
+        buf.scheduled = True
+        left = buf.dispatch(budget)
+        if buf.backlogged:
+            buf.deficit = left
+            self.active.append(buf)
+            _DEFERRED.inc((buf.queue_name,))
+        else:
+            buf.deficit = 0
+            buf.scheduled = False
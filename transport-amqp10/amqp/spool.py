@@ -0,0 +1,52 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage for deliveries received over several frames."""
+
+import tempfile
+
+from zaqar.queues.transport.amqp import stats
+
+_SPOOLED = stats.Counter('amqp_deliveries_spooled_total',
+                         'Multi-frame deliveries received, by where their '
+                         'frames were kept until complete.', ('to',))
+
+
+class DeliverySpool(object):
+    """The frames of a delivery received so far.
+
+    Kept in memory up to `threshold` bytes and in an anonymous temporary
+    file past it, so a large message doesn't take up memory while its
+    frames trickle in. Once complete it is read back whole to be decoded,
+    which takes about twice its size for a moment.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=threshold)
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def read(self):
+        """Return the whole delivery and free the spool."""
+        _SPOOLED.inc(('file' if self.size > self.threshold else 'memory',))
+        self._file.seek(0)
+        data = self._file.read()
+        self.close()
+        return data
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counters and histograms of the transport, in Prometheus text format.
+
+Metrics are module level objects registered with REGISTRY. Counters and
+gauges are only updated from the event loop thread, histograms may also
+be observed from the storage threads.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+import zaqar.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# seconds, from 100us to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        # called before rendering to refresh gauges derived from live state
+        self.collectors = []
+        # added to every sample, e.g. the pid of a worker process
+        self.constant_labels = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def on_collect(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as ex:
+                LOG.exception(ex)
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            metric.render(lines, self.constant_labels)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values, constant, extra=()):
+    pairs = list(constant.items())
+    pairs.extend(zip(names, values))
+    pairs.extend(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonically increasing value, per combination of labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> value
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self, lines, constant):
+        for key, value in sorted(self.values.copy().items()):
+            lines.append('%s%s %s' % (self.name,
+                                      _labels(self.labels, key, constant),
+                                      _number(value)))
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, key=()):
+        self.values[key] = value
+
+    def dec(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) - amount
+
+    def clear(self):
+        self.values = {}
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., +Inf count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, key=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 2)
+                self.values[key] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self, lines, constant):
+        with self.lock:
+            values = [(key, list(counts))
+                      for key, counts in sorted(self.values.items())]
+
+        bounds = self.buckets + (float('inf'),)
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _labels(self.labels, key, constant,
+                                 (('le', _number(bound)),))
+                lines.append('%s_bucket%s %d' % (self.name, labels,
+                                                 cumulative))
+            labels = _labels(self.labels, key, constant)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          _number(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+
+class StatsFile(object):
+    """Periodically write REGISTRY to a file, for the node exporter's
+    textfile collector or any scraper that reads Prometheus text.
+
+    The file is replaced atomically. When several workers serve the same
+    port each one writes its own file, named after its pid, and labels
+    its samples with it.
+    """
+
+    def __init__(self, path, interval, worker=False, registry=REGISTRY):
+        if worker:
+            pid = str(os.getpid())
+            root, ext = os.path.splitext(path)
+            path = '%s.%s%s' % (root, pid, ext)
+            registry.constant_labels['pid'] = pid
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.next_write = time.time()
+
+    def deadline(self):
+        return self.next_write
+
+    def write(self, now):
+        if now < self.next_write:
+            return
+        self.next_write = now + self.interval
+
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.registry.render())
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning("Writing stats to %s failed: %s", self.path, e)
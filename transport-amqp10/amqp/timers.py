@@ -0,0 +1,90 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coarse timers for large numbers of connections."""
+
+import math
+import time
+
+
+class TimerWheel(object):
+    """Deadlines rounded up to `resolution` seconds in a ring of buckets.
+
+    Scheduling and cancelling are O(1) and advancing only looks at the
+    buckets that went by, so the cost doesn't grow with the number of
+    timers that aren't due. Deadlines further than `span` seconds away
+    come out early, at the end of the span, and are expected to be
+    scheduled again by the caller.
+    """
+
+    def __init__(self, resolution, span, now=None):
+        self.resolution = float(resolution)
+        count = int(math.ceil(span / self.resolution)) + 1
+        self.buckets = [set() for i in range(count)]
+        # item -> its bucket
+        self.scheduled = {}
+        # last tick advance() went through
+        self.tick = int((now or time.time()) / self.resolution)
+        # no bucket before this tick has items, None when unknown
+        self.next_tick = None
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def schedule(self, item, deadline):
+        """Have advance() return `item` once `deadline` has passed."""
+        self.cancel(item)
+        count = len(self.buckets)
+        tick = int(math.ceil(deadline / self.resolution))
+        tick = min(max(tick, self.tick + 1), self.tick + count - 1)
+        bucket = self.buckets[tick % count]
+        bucket.add(item)
+        self.scheduled[item] = bucket
+        if len(self.scheduled) == 1:
+            self.next_tick = tick
+        elif self.next_tick is not None and tick < self.next_tick:
+            self.next_tick = tick
+
+    def cancel(self, item):
+        bucket = self.scheduled.pop(item, None)
+        if bucket is not None:
+            bucket.discard(item)
+
+    def deadline(self):
+        """When advance() next has anything to return."""
+        if not self.scheduled:
+            return None
+        count = len(self.buckets)
+        if self.next_tick is None:
+            for tick in range(self.tick + 1, self.tick + count):
+                if self.buckets[tick % count]:
+                    self.next_tick = tick
+                    break
+        return self.next_tick * self.resolution
+
+    def advance(self, now):
+        """Return the items whose deadline passed, unscheduling them."""
+        tick = int(now / self.resolution)
+        count = len(self.buckets)
+        expired = []
+        for t in range(max(self.tick + 1, tick - count + 1), tick + 1):
+            bucket = self.buckets[t % count]
+            if bucket:
+                for item in bucket:
+                    del self.scheduled[item]
+                expired.extend(bucket)
+                bucket.clear()
+        self.tick = max(self.tick, tick)
+        if self.next_tick is not None and self.next_tick <= self.tick:
+            self.next_tick = None
+        return expired
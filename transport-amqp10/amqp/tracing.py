@@ -0,0 +1,60 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sampled debug tracing of the delivery path.
+
+Call sites test `enabled` before anything else, so with tracing off a
+delivery pays one attribute lookup and no formatting:
+
+    if TRACER.enabled and TRACER.sample():
+        TRACER.log("Message received on %s: %r", name, message)
+
+Arguments are formatted by the logger, only for the sampled events.
+"""
+
+import logging as std_logging
+
+import zaqar.openstack.common.log as logging
+
+
+class Tracer(object):
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.enabled = False
+        self.every = 0
+        self._countdown = 0
+
+    def configure(self, every):
+        """Trace one in `every` events, 0 turns tracing off.
+
+        Tracing also stays off unless the logger is at debug level.
+        """
+        self.every = max(every, 0)
+        self.enabled = bool(self.every and
+                            self.logger.isEnabledFor(std_logging.DEBUG))
+        self._countdown = 1
+
+    def sample(self):
+        """True for one call in `every`."""
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.every
+        return True
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+
+TRACER = Tracer(logging.getLogger('zaqar.queues.transport.amqp.trace'))
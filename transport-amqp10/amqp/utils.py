@@ -33,81 +33,121 @@ def get_host_port(server_address):
     return host, port
 
 
-def server_socket(host, port, backlog=10):
-    """Create a TCP listening socket for a server."""
+def server_socket(host, port, backlog=128, reuse_port=False):
+    """Create a TCP listening socket for a server.
+
+    `backlog` bounds the connections waiting to be accepted, the kernel
+    caps it at net.core.somaxconn.
+
+    With reuse_port several processes can bind the same address and the
+    kernel spreads incoming connections across their listening sockets.
+    """
     addr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
     if not addr:
         raise Exception("Could not translate address '%s:%s'"
                         % (host, str(port)))
     s = socket.socket(addr[0][0], addr[0][1], addr[0][2])
     s.setblocking(0)  # 0 = non-blocking
+    if reuse_port:
+        # py2 doesn't export the constant, 15 is its value on Linux
+        option = getattr(socket, 'SO_REUSEPORT', 15)
+        s.setsockopt(socket.SOL_SOCKET, option, 1)
     try:
         s.bind(addr[0][4])
         s.listen(backlog)
-    except socket.error, e:
-        if e[0] != errno.EINPROGRESS:
+    except socket.error as e:
+        if e.errno != errno.EINPROGRESS:
             raise
     return s
 
 
+# AMQP 1.0 properties kept in the 'amqp10' field of stored messages
+_AMQP10_FIELDS = ('priority', 'first_acquirer', 'delivery_count', 'id',
+                  'user_id', 'address', 'subject', 'reply_to',
+                  'correlation_id', 'content_type', 'content_encoding',
+                  'expiry_time', 'creation_time', 'group_id',
+                  'group_sequence', 'reply_to_group_id', 'format')
+
+_default_message = Message()
+_AMQP10_DEFAULTS = dict((field, getattr(_default_message, field))
+                        for field in _AMQP10_FIELDS)
+_AMQP10_DEFAULT_ITEMS = tuple(_AMQP10_DEFAULTS.items())
+del _default_message
+
+
 def proton_to_zaqar(message):
-    """Convert a Proton Message into a storage compatible message"""
-    default_ttl = 100 if message.ttl == 0 else message.ttl
+    """Convert a Proton Message into a storage compatible message
 
-    # NOTE(vkmc) For now this only parses one single message
-    # it should receive a list of messages
+    Only the AMQP properties that differ from their defaults are kept, and
+    the 'amqp10' field is left out entirely when none do.
+    """
+    default_ttl = 100 if message.ttl == 0 else message.ttl
 
     # NOTE(vkmc) The Proton Message body is a sequence of bytes
     # (at least, it should be in py3). We store the message with
     # garbage (string terminators used by Proton for the repr)
+    zaqar_message = {'ttl': default_ttl, 'body': message.body}
 
     # NOTE(vkmc) The extra field is not stored automagically by
     # the storage backend. The feature has been discussed for future
     # development
-    return [{'ttl': default_ttl, 'body': message.body, 'amqp10': {'priority': message.priority,
-                                                                  'first_acquirer': message.first_acquirer,
-                                                                  'delivery_count': message.delivery_count,
-                                                                  'id': message.id,
-                                                                  'user_id': message.user_id,
-                                                                  'address': message.address,
-                                                                  'subject': message.subject,
-                                                                  'reply_to': message.reply_to,
-                                                                  'correlation_id': message.correlation_id,
-                                                                  'content_type': message.content_type,
-                                                                  'content_encoding': message.content_encoding,
-                                                                  'expiry_time': message.expiry_time,
-                                                                  'creation_time': message.creation_time,
-                                                                  'group_id': message.group_id,
-                                                                  'group_sequence': message.group_sequence,
-                                                                  'reply_to_group_id': message.reply_to_group_id,
-                                                                  'format': message.format}}]
+    properties = {}
+    for field, default in _AMQP10_DEFAULT_ITEMS:
+        value = getattr(message, field)
+        if value != default:
+            properties[field] = value
+    if properties:
+        zaqar_message['amqp10'] = properties
+
+    return zaqar_message
+
+
+class Envelope(object):
+    """A stored message on its way to an AMQP consumer.
+
+    Holds the stored body as is and only the non-default AMQP properties.
+    The Proton Message is built the first time it's needed, which for most
+    messages is when pyngus encodes it for the wire. It isn't kept after
+    encoding, pyngus holds on to the envelope until the delivery settles
+    and the engine already has the encoded copy.
+    """
+
+    __slots__ = ('ttl', 'body', 'properties', '_message')
+
+    def __init__(self, ttl, body, properties=None):
+        self.ttl = ttl
+        self.body = body
+        self.properties = properties
+        self._message = None
+
+    def get(self, field):
+        """Return an AMQP property without building the Message."""
+        if self.properties:
+            return self.properties.get(field, _AMQP10_DEFAULTS[field])
+        return _AMQP10_DEFAULTS[field]
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = self._build()
+        return self._message
+
+    def _build(self):
+        msg = Message()
+        msg.ttl = self.ttl
+        msg.body = self.body
+        if self.properties:
+            for field, value in self.properties.items():
+                if _AMQP10_DEFAULTS.get(field, value) != value:
+                    setattr(msg, field, value)
+        return msg
+
+    def encode(self):
+        """Called by pyngus when the message is sent."""
+        return (self._message or self._build()).encode()
 
 
 def zaqar_to_proton(message):
-    """Convert a message retrieved from storage to a Proton message"""
-    msg = Message()
-
-    msg.ttl = message.get('ttl')
-    msg.body = message.get('body')
-
-    # NOTE(vkmc) This won't work for now - there is no 'amqp10' field yet
-    if message.get('amqp10'):
-        msg.priority = message.get('amqp10').get('priority')
-        msg.first_acquirer = message.get('amqp10').get('first_acquirer')
-        msg.delivery_count = message.get('amqp10').get('delivery_count')
-        msg.id = message.get('amqp10').get('id'),
-        msg.user_id = message.get('amqp10').get('user_id')
-        msg.address = message.get('amqp10').get('address')
-        msg.subject = message.get('amqp10').get('subject')
-        msg.reply_to = message.get('amqp10').get('reply_to')
-        msg.correlation_id = message.get('amqp10').get('correlation_id')
-        msg.content_type = message.get('amqp10').get('content_type')
-        msg.content_encoding = message.get('amqp10').get('content_encoding')
-        msg.expiry_time = message.get('amqp10').get('expiry_time')
-        msg.creation_time = message.get('amqp10').get('creation_time'),
-        msg.group_id = message.get('amqp10').get('group_id')
-        msg.group_sequence = message.get('amqp10').get('group_sequence')
-        msg.reply_to_group_id = message.get('amqp10').get('reply_to_group_id')
-        msg.format = message.get('amqp10').get('format')
-
-    return msg
\ No newline at end of file
+    """Wrap a message retrieved from storage for delivery over AMQP"""
+    return Envelope(message.get('ttl'), message.get('body'),
+                    message.get('amqp10'))
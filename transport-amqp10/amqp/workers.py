@@ -0,0 +1,116 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-forking supervisor for multi-process event loops."""
+
+import errno
+import os
+import signal
+import time
+
+import zaqar.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class _Stopped(Exception):
+    """Raised from the signal handler to leave the supervisor loop."""
+
+
+class Supervisor(object):
+    """Run `target` in `workers` child processes and keep them alive.
+
+    Each child calls target() and is expected to never return. Children
+    that die are respawned, but no faster than once every
+    `respawn_interval` seconds per slot so a worker that crashes on start
+    doesn't turn into a fork loop.
+    """
+
+    def __init__(self, workers, target, respawn_interval=1.0):
+        self.workers = workers
+        self.target = target
+        self.respawn_interval = respawn_interval
+        self._children = {}
+        self._spawned_at = {}
+        self._stopping = False
+
+    def _spawn(self, slot):
+        last = self._spawned_at.get(slot)
+        if last is not None:
+            delay = last + self.respawn_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        pid = os.fork()
+        if pid == 0:
+            # Child: forget the supervisor's signal handlers and serve.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                self.target()
+            except Exception as ex:
+                LOG.exception(ex)
+                status = 1
+            finally:
+                os._exit(status)
+
+        LOG.info("Started worker %(slot)d, pid %(pid)d",
+                 {'slot': slot, 'pid': pid})
+        self._children[pid] = slot
+        self._spawned_at[slot] = time.time()
+
+    def _stop(self, signum, frame):
+        # The exception is lost when the signal lands in an os.fork()
+        # hook (logging registers some), the flag isn't.
+        self._stopping = True
+        raise _Stopped()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        try:
+            for slot in range(self.workers):
+                if self._stopping:
+                    break
+                self._spawn(slot)
+
+            while not self._stopping:
+                pid, status = os.wait()
+                slot = self._children.pop(pid, None)
+                if slot is None:
+                    continue
+                LOG.warning("Worker %(slot)d (pid %(pid)d) exited with "
+                            "status %(status)d",
+                            {'slot': slot, 'pid': pid, 'status': status})
+                self._spawn(slot)
+        except _Stopped:
+            LOG.info("Stopping workers")
+        finally:
+            self.stop()
+
+    def stop(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+            del self._children[pid]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-message cost of converting between Proton and storage messages.
+
+Compares utils.proton_to_zaqar/zaqar_to_proton with the eager versions
+they replaced (reproduced below). Delivery is measured with and without
+encoding, since the envelope defers the work to encode().
+
+    $ python benchmarks/conversion.py --count 100000
+"""
+
+import optparse
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from proton import Message
+
+from zaqar.queues.transport.amqp import utils
+
+
+def legacy_proton_to_zaqar(message):
+    default_ttl = 100 if message.ttl == 0 else message.ttl
+    return {'ttl': default_ttl, 'body': message.body, 'amqp10': {
+        'priority': message.priority,
+        'first_acquirer': message.first_acquirer,
+        'delivery_count': message.delivery_count,
+        'id': message.id,
+        'user_id': message.user_id,
+        'address': message.address,
+        'subject': message.subject,
+        'reply_to': message.reply_to,
+        'correlation_id': message.correlation_id,
+        'content_type': message.content_type,
+        'content_encoding': message.content_encoding,
+        'expiry_time': message.expiry_time,
+        'creation_time': message.creation_time,
+        'group_id': message.group_id,
+        'group_sequence': message.group_sequence,
+        'reply_to_group_id': message.reply_to_group_id,
+        'format': message.format}}
+
+
+def legacy_zaqar_to_proton(message):
+    msg = Message()
+    msg.ttl = message.get('ttl')
+    msg.body = message.get('body')
+    if message.get('amqp10'):
+        msg.priority = message.get('amqp10').get('priority')
+        msg.first_acquirer = message.get('amqp10').get('first_acquirer')
+        msg.delivery_count = message.get('amqp10').get('delivery_count')
+        msg.id = message.get('amqp10').get('id')
+        msg.user_id = message.get('amqp10').get('user_id')
+        msg.address = message.get('amqp10').get('address')
+        msg.subject = message.get('amqp10').get('subject')
+        msg.reply_to = message.get('amqp10').get('reply_to')
+        msg.correlation_id = message.get('amqp10').get('correlation_id')
+        msg.content_type = message.get('amqp10').get('content_type')
+        msg.content_encoding = message.get('amqp10').get('content_encoding')
+        msg.expiry_time = message.get('amqp10').get('expiry_time')
+        msg.creation_time = message.get('amqp10').get('creation_time')
+        msg.group_id = message.get('amqp10').get('group_id')
+        msg.group_sequence = message.get('amqp10').get('group_sequence')
+        msg.reply_to_group_id = message.get('amqp10').get('reply_to_group_id')
+        msg.format = message.get('amqp10').get('format')
+    return msg
+
+
+def sample_message(size):
+    msg = Message()
+    msg.body = b'x' * size
+    msg.subject = 'bench'
+    msg.priority = 7
+    return msg
+
+
+def measure(func, args, count):
+    """Return (microseconds, bytes allocated) per call."""
+    started = time.time()
+    for i in range(count):
+        func(*args)
+    elapsed = time.time() - started
+
+    allocated = None
+    if tracemalloc is not None:
+        calls = min(count, 1000)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        # the results stay referenced until the second snapshot
+        results = [func(*args) for i in range(calls)]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        allocated = sum(s.size_diff for s in stats) / float(len(results))
+
+    return elapsed / count * 1e6, allocated
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--count", dest="count", type="int", default=100000,
+                      help="Conversions per measurement [%default]")
+    parser.add_option("--size", dest="size", type="int", default=256,
+                      help="Body size in bytes [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    message = sample_message(opts.size)
+    legacy_stored = legacy_proton_to_zaqar(message)
+    stored = utils.proton_to_zaqar(message)
+
+    cases = (
+        ("ingest", legacy_proton_to_zaqar, utils.proton_to_zaqar,
+         (message,)),
+        ("deliver", legacy_zaqar_to_proton,
+         lambda m: utils.zaqar_to_proton(m), None),
+        ("deliver+encode",
+         lambda m: legacy_zaqar_to_proton(m).encode(),
+         lambda m: utils.zaqar_to_proton(m).encode(), None),
+    )
+
+    print("%-16s %14s %14s %14s %14s" % ("conversion", "legacy us",
+                                         "new us", "legacy B", "new B"))
+    for name, legacy, new, args in cases:
+        legacy_time, legacy_alloc = measure(legacy, args or (legacy_stored,),
+                                            opts.count)
+        new_time, new_alloc = measure(new, args or (stored,), opts.count)
+        print("%-16s %14.2f %14.2f %14s %14s" % (
+            name, legacy_time, new_time,
+            '-' if legacy_alloc is None else '%.0f' % legacy_alloc,
+            '-' if new_alloc is None else '%.0f' % new_alloc))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
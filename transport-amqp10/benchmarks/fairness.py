@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Delivery latency of quiet queues next to a busy one.
+
+Runs the event loop in a child process. --bulk consumers, in another
+process, drain a queue that never runs out of messages with --credit
+each, while --interactive clients each send a message to their own
+queue every --interval seconds and consume it. The latency from send to
+receipt of those messages and the bulk throughput are reported for:
+
+* unscheduled: dispatch_quantum 0, a queue delivers all its consumers
+  have credit for at once.
+* fair: the default dispatch_quantum.
+* fair, weighted: the bulk queue weighs 0.25.
+
+    $ python benchmarks/fairness.py --bulk 4 --credit 1000
+"""
+
+import multiprocessing
+import optparse
+import select
+import sys
+import time
+import uuid
+
+from oslo.config import cfg
+from proton import Message
+import pyngus
+
+import helpers
+import settlement
+from zaqar.queues.transport.amqp import driver
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import messages
+
+BULK_QUEUE = 'bulk'
+
+
+CONFIGS = (
+    ("unscheduled", {'dispatch_quantum': 0}),
+    ("fair", {}),
+    ("fair, weighted", {'queue_weights': {BULK_QUEUE: '0.25'}}),
+)
+
+
+class EndlessStorage(settlement.MemoryStorage):
+    """MemoryStorage whose bulk queue always has messages to claim."""
+
+    def __init__(self, size):
+        super(EndlessStorage, self).__init__()
+        self.body = 'x' * size
+
+    def claim(self, queue, metadata, project=None, limit=10):
+        if queue != BULK_QUEUE:
+            return super(EndlessStorage, self).claim(queue, metadata,
+                                                     project, limit)
+        return uuid.uuid4().hex, [
+            {'id': str(next(self.ids)), 'ttl': 60, 'body': self.body}
+            for i in range(limit)]
+
+    def bulk_delete(self, queue, message_ids, project=None):
+        if queue != BULK_QUEUE:
+            super(EndlessStorage, self).bulk_delete(queue, message_ids,
+                                                    project)
+
+    def release(self, queue, claim_id, project=None):
+        if queue != BULK_QUEUE:
+            super(EndlessStorage, self).release(queue, claim_id, project)
+
+
+def serve(port, size, overrides):
+    conf = cfg.ConfigOpts()
+    conf([])
+    conf.register_opts(driver._AMQP_OPTIONS, group=driver._AMQP_GROUP)
+    conf.set_override('storage_pool_size', 0, group=driver._AMQP_GROUP)
+    for name, value in overrides.items():
+        conf.set_override(name, value, group=driver._AMQP_GROUP)
+    amqp_conf = conf[driver._AMQP_GROUP]
+
+    storage = EndlessStorage(size)
+    controllers = messages.CollectionResource(
+        storage, storage, settlement.ClaimController(storage),
+        batch_size=amqp_conf.ingest_batch_size,
+        batch_window=amqp_conf.ingest_window_ms / 1000.0,
+        prefetch_size=amqp_conf.prefetch_size,
+        prefetch_bytes=amqp_conf.prefetch_bytes,
+        dispatch_quantum=amqp_conf.dispatch_quantum,
+        queue_weights=amqp_conf.queue_weights)
+    eventloop.run("amqp://127.0.0.1:%d" % port, controllers, amqp_conf)
+
+
+class Consumer(pyngus.ReceiverEventHandler):
+    """Accept everything, granting credit back in bulk."""
+
+    def __init__(self, credit, received):
+        self.credit = credit
+        self.received = received
+        self.count = 0
+
+    def message_received(self, link, message, handle):
+        link.message_accepted(handle)
+        self.received(message)
+        self.count += 1
+        if link.capacity <= self.credit // 2:
+            link.add_capacity(self.credit - link.capacity)
+
+
+def loop(clients, running, tick=None):
+    """Pump the (socket, connection) clients until running() is False."""
+    while running():
+        now = time.time()
+        if tick is not None:
+            tick(now)
+        readers = [s for s, c in clients if c.needs_input > 0]
+        writers = [s for s, c in clients if c.has_output > 0]
+        readable, writable, ignore = select.select(readers, writers, [],
+                                                   0.001)
+        readable = set(readable)
+        writable = set(writable)
+        now = time.time()
+        for sock, conn in clients:
+            if sock in readable:
+                pyngus.read_socket_input(conn, sock)
+            conn.process(now)
+            if sock in writable or conn.has_output > 0:
+                pyngus.write_socket_output(conn, sock)
+
+
+def drain(port, count, credit, seconds, channel):
+    """Consume the bulk queue with `count` connections."""
+    clients = []
+    handlers = []
+    for i in range(count):
+        sock, conn = settlement.connect(port)
+        handler = Consumer(credit, lambda message: None)
+        receiver = conn.create_receiver(uuid.uuid4().hex, BULK_QUEUE,
+                                        handler)
+        receiver.add_capacity(credit)
+        receiver.open()
+        clients.append((sock, conn))
+        handlers.append(handler)
+    channel.send('ready')
+    channel.recv()
+    # count from the start of the measurement only
+    base = sum(h.count for h in handlers)
+    deadline = time.time() + seconds
+    loop(clients, lambda: time.time() < deadline)
+    channel.send(sum(h.count for h in handlers) - base)
+
+
+def ping(port, count, interval, seconds):
+    """Send to and consume from `count` queues, return the latencies."""
+    clients = []
+    senders = []
+    latencies = []
+
+    def received(message):
+        latencies.append(time.time() - float(message.body))
+
+    for i in range(count):
+        sock, conn = settlement.connect(port)
+        queue = 'ping-%d' % i
+        sender = conn.create_sender(uuid.uuid4().hex, queue)
+        sender.open()
+        receiver = conn.create_receiver(uuid.uuid4().hex, queue,
+                                        Consumer(10, received))
+        receiver.add_capacity(10)
+        receiver.open()
+        clients.append((sock, conn))
+        senders.append(sender)
+
+    state = {'next': time.time()}
+
+    def tick(now):
+        if now < state['next']:
+            return
+        state['next'] = now + interval
+        for sender in senders:
+            if sender.active:
+                message = Message()
+                message.body = repr(time.time())
+                sender.send(message)
+
+    deadline = time.time() + seconds
+    loop(clients, lambda: time.time() < deadline, tick)
+    return latencies
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--bulk", dest="bulk", type="int", default=4,
+                      help="Consumers of the bulk queue [%default]")
+    parser.add_option("--credit", dest="credit", type="int", default=1000,
+                      help="Credit of each bulk consumer [%default]")
+    parser.add_option("--size", dest="size", type="int", default=1024,
+                      help="Body size of the bulk messages [%default]")
+    parser.add_option("--interactive", dest="interactive", type="int",
+                      default=8,
+                      help="Interactive clients, one queue each "
+                           "[%default]")
+    parser.add_option("--interval", dest="interval", type="float",
+                      default=0.01,
+                      help="Seconds between interactive messages "
+                           "[%default]")
+    parser.add_option("--seconds", dest="seconds", type="float",
+                      default=10,
+                      help="Duration of each run [%default]")
+    parser.add_option("--port", dest="port", type="int", default=25800,
+                      help="First port of the benchmark servers "
+                           "[%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    print("%-16s %10s %10s %10s %10s %12s" % (
+        "config", "messages", "p50 ms", "p99 ms", "max ms", "bulk msg/s"))
+    for offset, (name, overrides) in enumerate(CONFIGS):
+        port = opts.port + offset
+        server = multiprocessing.Process(target=serve,
+                                         args=(port, opts.size, overrides))
+        server.daemon = True
+        server.start()
+        time.sleep(0.5)
+
+        channel, child_channel = multiprocessing.Pipe()
+        bulk = multiprocessing.Process(
+            target=drain, args=(port, opts.bulk, opts.credit,
+                                opts.seconds, child_channel))
+        bulk.start()
+        channel.recv()
+        # let the bulk consumers get going
+        time.sleep(1)
+        channel.send('go')
+        latencies = ping(port, opts.interactive, opts.interval,
+                         opts.seconds)
+        drained = channel.recv()
+        bulk.join()
+        server.terminate()
+        server.join()
+
+        if not latencies:
+            print("%-16s no interactive message received" % name)
+            continue
+        print("%-16s %10d %10.1f %10.1f %10.1f %12.0f" % (
+            name, len(latencies), helpers.percentile(latencies, 0.5) * 1000,
+            helpers.percentile(latencies, 0.99) * 1000, max(latencies) * 1000,
+            drained / opts.seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers shared by the benchmarks."""
+
+import resource
+import time
+
+import pyngus
+
+
+def raise_fd_limit(count):
+    """Allow a socketpair per connection, plus some slack."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * count + 64
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+
+def handshake(pairs):
+    """Open (server SocketConnection, client, client socket) triples."""
+    pending = pairs
+    for attempt in range(20):
+        now = time.time()
+        for sconn, client, client_socket in pending:
+            client.process(now)
+            if client.has_output > 0:
+                pyngus.write_socket_output(client, client_socket)
+            sconn.process_input(now)
+            if sconn.connection.has_output > 0:
+                sconn.send_output(now)
+            if client.needs_input > 0:
+                pyngus.read_socket_input(client, client_socket)
+            client.process(now)
+        pending = [p for p in pending
+                   if not (p[0].connection.active and p[1].active)]
+        if not pending:
+            return
+    raise RuntimeError("%d connections didn't open" % len(pending))
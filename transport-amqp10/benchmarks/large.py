@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Server memory while large messages are being received.
+
+Runs the event loop in a child process against a storage that drops the
+bodies it is given, and has --producers connections send one --size
+message each at the same time, so all of them are in flight at once.
+The growth of the peak RSS of the server is reported for:
+
+* engine: incomplete messages are buffered by the AMQP engine
+  (spool_threshold 0) and complete ones wait for the ingest window
+  (ingest_batch_bytes 0), as before spooling.
+* spooled: incomplete messages are spooled, complete ones still wait.
+* spooled, flushed: the defaults, large messages are written right away.
+
+    $ python benchmarks/large.py --producers 10 --size 10485760
+"""
+
+import multiprocessing
+import optparse
+import resource
+import sys
+import threading
+import time
+import uuid
+
+from oslo.config import cfg
+from proton import Message
+import pyngus
+
+import settlement
+from zaqar.queues.transport.amqp import driver
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import messages
+
+
+CONFIGS = (
+    ("engine", {'spool_threshold': 0, 'ingest_batch_bytes': 0}),
+    ("spooled", {'ingest_batch_bytes': 0}),
+    ("spooled, flushed", {}),
+)
+
+
+class DroppingStorage(settlement.MemoryStorage):
+    """Counts the messages posted, without keeping them."""
+
+    def post(self, queue, messages, client_uuid, project=None):
+        with self.lock:
+            self.queues[queue].extend(None for m in messages)
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def serve(port, overrides, channel):
+    conf = cfg.ConfigOpts()
+    conf([])
+    conf.register_opts(driver._AMQP_OPTIONS, group=driver._AMQP_GROUP)
+    conf.set_override('storage_pool_size', 0, group=driver._AMQP_GROUP)
+    conf.set_override('max_message_size', 0, group=driver._AMQP_GROUP)
+    for name, value in overrides.items():
+        conf.set_override(name, value, group=driver._AMQP_GROUP)
+    amqp_conf = conf[driver._AMQP_GROUP]
+
+    storage = DroppingStorage()
+    controllers = messages.CollectionResource(
+        storage, storage, settlement.ClaimController(storage),
+        batch_size=amqp_conf.ingest_batch_size,
+        batch_window=amqp_conf.ingest_window_ms / 1000.0,
+        batch_bytes=amqp_conf.ingest_batch_bytes)
+    baseline = peak_rss()
+    thread = threading.Thread(
+        target=eventloop.run,
+        args=("amqp://127.0.0.1:%d" % port, controllers, amqp_conf))
+    thread.daemon = True
+    thread.start()
+    channel.send('ready')
+    channel.recv()
+    channel.send(peak_rss() - baseline)
+
+
+def produce(port, producers, size):
+    """Send one message per producer, all at once."""
+    clients = []
+    outcomes = []
+
+    def sent(link, handle, status, error):
+        outcomes.append(status)
+
+    for i in range(producers):
+        sock, conn = settlement.connect(port)
+        sender = conn.create_sender(uuid.uuid4().hex, 'large')
+        sender.open()
+        settlement.pump(sock, conn, lambda: sender.active)
+        message = Message()
+        message.body = 'x' * size
+        sender.send(message, sent)
+        clients.append((sock, conn))
+
+    started = time.time()
+    while len(outcomes) < producers and time.time() - started < 120:
+        for sock, conn in clients:
+            # one socket write per connection and round
+            if conn.needs_input > 0:
+                pyngus.read_socket_input(conn, sock)
+            conn.process(time.time())
+            if conn.has_output > 0:
+                pyngus.write_socket_output(conn, sock)
+        time.sleep(0.001)
+    elapsed = time.time() - started
+    for sock, conn in clients:
+        sock.close()
+    return outcomes, elapsed
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--producers", dest="producers", type="int",
+                      default=10,
+                      help="Messages in flight at once [%default]")
+    parser.add_option("--size", dest="size", type="int",
+                      default=10 * 1024 * 1024,
+                      help="Body size in bytes [%default]")
+    parser.add_option("--port", dest="port", type="int", default=25700,
+                      help="First port of the benchmark servers "
+                           "[%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    print("%-18s %10s %14s %10s" % ("config", "stored", "peak RSS +MB",
+                                    "seconds"))
+    for offset, (name, overrides) in enumerate(CONFIGS):
+        channel, child_channel = multiprocessing.Pipe()
+        server = multiprocessing.Process(
+            target=serve, args=(opts.port + offset, overrides,
+                                child_channel))
+        server.start()
+        channel.recv()
+        time.sleep(0.5)
+        outcomes, elapsed = produce(opts.port + offset, opts.producers,
+                                    opts.size)
+        channel.send('done')
+        growth = channel.recv() / 1024.0
+        server.terminate()
+        server.join()
+        stored = len([o for o in outcomes
+                      if o == pyngus.SenderLink.ACCEPTED])
+        print("%-18s %10s %14.1f %10.2f" % (
+            name, "%d/%d" % (stored, opts.producers), growth, elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
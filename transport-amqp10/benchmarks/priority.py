@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cost of delivering claimed messages by priority.
+
+Feeds a QueueBuffer claims of --batch messages and has it hand them to
+--links consumer links holding just enough credit, --rounds times. The
+time per message covers buffering and dispatching it, the conversion
+and encoding of the messages aren't included. Compared are:
+
+* fifo: the buffer's entries in a plain deque, queue order as before.
+* priority: PriorityEntries, with every message at the default
+  priority or with priorities spread over the 10 levels.
+
+The order the messages came out in is checked for each. For scale, the
+time to encode one of the messages for the wire, which every delivery
+pays on top, is reported too.
+
+    $ python benchmarks/priority.py --batch 100 --rounds 2000
+"""
+
+import collections
+import optparse
+import random
+import sys
+import time
+
+from zaqar.queues.transport.amqp import notify
+from zaqar.queues.transport.amqp import prefetch
+from zaqar.queues.transport.amqp import utils
+
+
+class Controllers(object):
+    """Storage requests of the buffer, all ignored."""
+
+    def __init__(self):
+        self.bus = notify.Bus(0)
+
+    def on_claim(self, queue_name, limit, callback):
+        pass
+
+    def on_delete(self, queue_name, message_id, claim_id):
+        pass
+
+    def on_bulk_delete(self, queue_name, message_ids):
+        pass
+
+    def on_release(self, queue_name, claim_id):
+        pass
+
+
+class Link(object):
+    """A consumer link recording the priorities it was sent."""
+
+    def __init__(self, delivered):
+        self.credit = 0
+        self.presettled = False
+        self.queued = False
+        self.delivered = delivered
+
+    def deliver(self, claim, message_id, message):
+        self.credit -= 1
+        self.delivered.append(message.get('priority'))
+
+
+def claims(batch, rounds, spread):
+    """The messages of every claim, with their priorities."""
+    result = []
+    for r in range(rounds):
+        messages = []
+        for i in range(batch):
+            properties = None
+            if spread:
+                properties = {'priority': random.randint(0, 9)}
+            messages.append((str(i), utils.Envelope(60, 'x' * 64,
+                                                    properties)))
+        result.append(messages)
+    return result
+
+
+def bench(entries, batch, links, rounds, spread):
+    prefetcher = prefetch.Prefetch(Controllers(), batch, 1 << 30, 60)
+    buf = prefetcher.buffer('bench')
+    buf.entries = entries
+    delivered = []
+    consumers = [Link(delivered) for i in range(links)]
+    for link in consumers:
+        buf.attach()
+    batches = claims(batch, rounds, spread)
+
+    ordered = 0
+    started = time.time()
+    for messages in batches:
+        for i, link in enumerate(consumers):
+            link.credit = batch // links + (i < batch % links)
+            buf.want(link)
+        del delivered[:]
+        buf.claimed('claim', messages)
+        if delivered == sorted(delivered, reverse=True):
+            ordered += 1
+    elapsed = time.time() - started
+    return elapsed / (batch * rounds) * 1e9, ordered
+
+
+def encoding(count):
+    """Time to encode one of the benchmark's messages, in ns."""
+    messages = [utils.Envelope(60, 'x' * 64, {'priority': 7})
+                for i in range(count)]
+    started = time.time()
+    for message in messages:
+        message.encode()
+    return (time.time() - started) / count * 1e9
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--batch", dest="batch", type="int", default=100,
+                      help="Messages per claim [%default]")
+    parser.add_option("--links", dest="links", type="int", default=4,
+                      help="Consumer links of the queue [%default]")
+    parser.add_option("--rounds", dest="rounds", type="int", default=2000,
+                      help="Claims per run [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    runs = (
+        ("fifo", collections.deque, False),
+        ("fifo", collections.deque, True),
+        ("priority", prefetch.PriorityEntries, False),
+        ("priority", prefetch.PriorityEntries, True),
+    )
+    print("%-10s %-12s %10s %20s" % ("entries", "priorities", "ns/msg",
+                                     "claims in order"))
+    for name, entries, spread in runs:
+        ns, ordered = bench(entries(), opts.batch, opts.links,
+                            opts.rounds, spread)
+        print("%-10s %-12s %10.0f %20s" % (
+            name, "0-9" if spread else "default", ns,
+            "%d/%d" % (ordered, opts.rounds)))
+    print("\nencoding a message: %.0f ns" % encoding(opts.batch * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare tick latency of the select() and selectors reactors.
+
+Every connection is a server side SocketConnection on one end of a
+socketpair. A fraction of them is kept active by writing a byte from the
+client end before every tick; the rest stay idle. The loop body drains the
+readable sockets and resyncs the poller, which is the reactor overhead the
+event loop pays per iteration.
+
+    $ python benchmarks/reactor.py --connections 100,1000,10000
+"""
+
+import optparse
+import socket
+import sys
+import time
+
+import pyngus
+
+import helpers
+from zaqar.queues.transport.amqp import eventloop
+
+
+def bench(reactor, count, active, ticks):
+    listener, listener_peer = socket.socketpair()
+    container = pyngus.Container("bench")
+    poller = eventloop.get_poller(reactor, container, listener)
+
+    connections = []
+    clients = []
+    try:
+        for i in range(count):
+            server, client = socket.socketpair()
+            server.setblocking(0)
+            sconn = eventloop.SocketConnection(container, server,
+                                               "conn-%d" % i, {}, None)
+            # flush the protocol header so the connection goes idle:
+            sconn.send_output()
+            poller.register(sconn)
+            connections.append(sconn)
+            clients.append(client)
+
+        active_clients = clients[:max(1, int(count * active))]
+        samples = []
+        events = 0
+        started = time.time()
+        for tick in range(ticks):
+            for client in active_clients:
+                client.send(b'x')
+
+            begin = time.time()
+            poller.prepare()
+            readable, writable = poller.poll(0)
+            for r in readable:
+                r.socket.recv(4096)
+                poller.update(r)
+            samples.append(time.time() - begin)
+            events += len(readable)
+        elapsed = time.time() - started
+    finally:
+        for sconn in connections:
+            poller.unregister(sconn)
+            sconn.destroy()
+        for client in clients:
+            client.close()
+        container.destroy()
+        listener.close()
+        listener_peer.close()
+
+    return {'p50': helpers.percentile(samples, 0.50) * 1e6,
+            'p99': helpers.percentile(samples, 0.99) * 1e6,
+            'events': events / elapsed}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--connections", dest="connections", type="string",
+                      default="100,1000,10000",
+                      help="Comma separated connection counts [%default]")
+    parser.add_option("--active", dest="active", type="float", default=0.1,
+                      help="Fraction of connections with traffic "
+                           "[%default]")
+    parser.add_option("--ticks", dest="ticks", type="int", default=200,
+                      help="Loop iterations per run [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    counts = [int(c) for c in opts.connections.split(',')]
+    helpers.raise_fd_limit(max(counts))
+
+    print("%-10s %8s %12s %12s %14s" % ("reactor", "conns", "p50 (us)",
+                                        "p99 (us)", "events/s"))
+    for count in counts:
+        for reactor in ('select', 'selectors'):
+            try:
+                result = bench(reactor, count, opts.active, opts.ticks)
+            except ValueError as e:
+                # select() can't watch descriptors above FD_SETSIZE
+                print("%-10s %8d %s" % (reactor, count, e))
+                continue
+            print("%-10s %8d %12.1f %12.1f %14.0f" % (reactor, count,
+                                                      result['p50'],
+                                                      result['p99'],
+                                                      result['events']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
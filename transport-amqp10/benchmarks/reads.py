@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cost of reading client connections, with and without a reused buffer.
+
+Every connection is a server side SocketConnection on one end of a
+socketpair, opened by a pyngus client on the other end. On every tick
+--size bytes of empty AMQP frames are written to each connection, then
+the server side reads them all.
+
+"recv" is the read path before the read buffer, pyngus'
+read_socket_input(), which allocates a bytes object for every read.
+"recv_into" is SocketConnection.read_input() reading into a ReadBuffer
+shared by all the connections. The time per read, the objects allocated
+by the reads and the peak of memory they allocated (tracemalloc, Python 3)
+are reported.
+
+    $ python benchmarks/reads.py --connections 1000 --sizes 64,4096,65536
+"""
+
+import optparse
+import socket
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pyngus
+
+import helpers
+from zaqar.queues.transport.amqp import buffers
+from zaqar.queues.transport.amqp import eventloop
+
+# an AMQP frame without body, i.e. a heartbeat
+EMPTY_FRAME = b'\x00\x00\x00\x08\x02\x00\x00\x00'
+
+
+def legacy_read(sconn, now):
+    """SocketConnection.read_input() before the read buffer."""
+    count = pyngus.read_socket_input(sconn.connection, sconn.socket)
+    if count > 0:
+        eventloop._BYTES_READ.inc(amount=count)
+        sconn.last_input = now or time.time()
+    return count
+
+
+def read_all(method, pairs):
+    """Read every connection until its input is drained."""
+    if method == 'recv':
+        read = legacy_read
+    else:
+        read = eventloop.SocketConnection.read_input
+    reads = 0
+    for sconn, client, client_socket in pairs:
+        while read(sconn, None) > 0:
+            reads += 1
+    return reads
+
+
+def bench(method, count, size, ticks):
+    container = pyngus.Container("bench")
+    clients = pyngus.Container("bench-clients")
+    read_buffer = buffers.ReadBuffer()
+    data = EMPTY_FRAME * max(1, size // len(EMPTY_FRAME))
+
+    pairs = []
+    try:
+        for i in range(count):
+            server_socket, client_socket = socket.socketpair()
+            server_socket.setblocking(0)
+            client_socket.setblocking(0)
+            sconn = eventloop.SocketConnection(container, server_socket,
+                                               "conn-%d" % i, {}, None,
+                                               read_buffer=read_buffer)
+            client = clients.create_connection("client-%d" % i)
+            client.pn_sasl.mechanisms("ANONYMOUS")
+            client.pn_sasl.client()
+            client.open()
+            pairs.append((sconn, client, client_socket))
+        helpers.handshake(pairs)
+
+        allocations = buffers._ALLOCATIONS.values.get((), 0)
+        elapsed = 0
+        reads = 0
+        peak = None
+        for tick in range(ticks + 1):
+            for sconn, client, client_socket in pairs:
+                client_socket.sendall(data)
+            if tick == ticks:
+                # one more, traced
+                if tracemalloc is None:
+                    break
+                tracemalloc.start()
+                read_all(method, pairs)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                break
+            begin = time.time()
+            reads += read_all(method, pairs)
+            elapsed += time.time() - begin
+            now = time.time()
+            for sconn, client, client_socket in pairs:
+                sconn.connection.process(now)
+        allocations = buffers._ALLOCATIONS.values.get((), 0) - allocations
+    finally:
+        for sconn, client, client_socket in pairs:
+            sconn.destroy()
+            client.destroy()
+            client_socket.close()
+        container.destroy()
+        clients.destroy()
+
+    if method == 'recv':
+        # a bytes object per read
+        allocations = reads
+    return {'reads': reads / float(ticks),
+            'us': elapsed / reads * 1e6,
+            'allocations': allocations / float(ticks),
+            'peak': peak}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--connections", dest="connections", type="int",
+                      default=1000,
+                      help="Number of connections [%default]")
+    parser.add_option("--sizes", dest="sizes", type="string",
+                      default="64,4096,65536",
+                      help="Comma separated bytes written to each connection "
+                           "per tick [%default]")
+    parser.add_option("--ticks", dest="ticks", type="int", default=50,
+                      help="Ticks per run [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    helpers.raise_fd_limit(opts.connections)
+
+    print("%-10s %8s %10s %10s %14s %14s" % (
+        "read", "size", "reads", "us/read", "allocs/tick", "peak (KB)"))
+    for size in [int(s) for s in opts.sizes.split(',')]:
+        for method in ('recv', 'recv_into'):
+            result = bench(method, opts.connections, size, opts.ticks)
+            peak = '-'
+            if result['peak'] is not None:
+                peak = '%.0f' % (result['peak'] / 1024.0)
+            print("%-10s %8d %10.0f %10.2f %14.1f %14s" % (
+                method, size, result['reads'], result['us'],
+                result['allocations'], peak))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput of the delivery guarantees a client can negotiate.
+
+Runs the event loop in a thread against an in-memory storage and, for
+each mode, sends --count messages to a queue and then consumes them:
+
+* at-most-once: links attached with snd-settle-mode "settled", nothing
+  is acknowledged and consumed messages are deleted in bulk.
+* at-least-once: the default, every message is accepted by the server
+  once stored and deleted once the consumer accepts it.
+* rcv-settle second: the client asks for the receiver to settle second,
+  which the transport declines; it is served as at-least-once.
+
+    $ python benchmarks/settlement.py --count 20000
+"""
+
+import itertools
+import optparse
+import select
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from oslo.config import cfg
+from proton import Message
+import pyngus
+
+from zaqar.queues.transport.amqp import driver
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import messages
+
+MODES = (
+    ("at-most-once", {'snd-settle-mode': 'settled'}),
+    ("at-least-once", {}),
+    ("rcv-settle second", {'rcv-settle-mode': 'second'}),
+)
+
+
+class MemoryStorage(object):
+    """Just enough of the storage controllers for the transport."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.ids = itertools.count()
+
+    # QueueController
+
+    def create(self, name, project=None):
+        with self.lock:
+            return self.queues.setdefault(name, []) is not None
+
+    # MessageController
+
+    def post(self, queue, messages, client_uuid, project=None):
+        with self.lock:
+            stored = self.queues[queue]
+            for message in messages:
+                stored.append({'id': str(next(self.ids)), 'claim': None,
+                               'ttl': message['ttl'],
+                               'body': message['body']})
+
+    def delete(self, queue, message_id, project=None, claim=None):
+        self.bulk_delete(queue, [message_id])
+
+    def bulk_delete(self, queue, message_ids, project=None):
+        ids = set(message_ids)
+        with self.lock:
+            self.queues[queue] = [m for m in self.queues[queue]
+                                  if m['id'] not in ids]
+
+    # ClaimController (create and delete clash with the above)
+
+    def claim(self, queue, metadata, project=None, limit=10):
+        claim_id = uuid.uuid4().hex
+        with self.lock:
+            claimed = [m for m in self.queues.get(queue, [])
+                       if m['claim'] is None][:limit]
+            for m in claimed:
+                m['claim'] = claim_id
+            return claim_id, [dict(m) for m in claimed]
+
+    def release(self, queue, claim_id, project=None):
+        with self.lock:
+            for m in self.queues.get(queue, []):
+                if m['claim'] == claim_id:
+                    m['claim'] = None
+
+
+class ClaimController(object):
+
+    def __init__(self, storage):
+        self.create = storage.claim
+        self.delete = storage.release
+
+
+def start_server(port, opts):
+    conf = cfg.ConfigOpts()
+    conf([])
+    conf.register_opts(driver._AMQP_OPTIONS, group=driver._AMQP_GROUP)
+    conf.set_override('storage_pool_size', opts.pool,
+                      group=driver._AMQP_GROUP)
+    amqp_conf = conf[driver._AMQP_GROUP]
+
+    storage = MemoryStorage()
+    controllers = messages.CollectionResource(
+        storage, storage, ClaimController(storage),
+        batch_size=amqp_conf.ingest_batch_size,
+        batch_window=amqp_conf.ingest_window_ms / 1000.0,
+        prefetch_size=amqp_conf.prefetch_size)
+    t = threading.Thread(target=eventloop.run,
+                         args=("amqp://127.0.0.1:%d" % port, controllers,
+                               amqp_conf))
+    t.daemon = True
+    t.start()
+    time.sleep(0.5)
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setblocking(0)
+    container = pyngus.Container(uuid.uuid4().hex)
+    conn = container.create_connection("bench", None,
+                                       {'hostname': '127.0.0.1'})
+    conn.pn_sasl.mechanisms("ANONYMOUS")
+    conn.pn_sasl.client()
+    conn.open()
+    return sock, conn
+
+
+def pump(sock, conn, done, timeout=60):
+    deadline = time.time() + timeout
+    while not done() and time.time() < deadline:
+        readers = [sock] if conn.needs_input > 0 else []
+        writers = [sock] if conn.has_output > 0 else []
+        readable, writable, ignore = select.select(readers, writers, [],
+                                                   0.01)
+        if readable:
+            pyngus.read_socket_input(conn, sock)
+        conn.process(time.time())
+        if writable:
+            pyngus.write_socket_output(conn, sock)
+        conn.process(time.time())
+    return done()
+
+
+def close(sock, conn):
+    """Close the AMQP connection, then the socket.
+
+    Closing the socket with input still unread resets the connection,
+    which can discard what the server has yet to read of the messages
+    sent presettled.
+    """
+    conn.close()
+    pump(sock, conn, lambda: conn.closed, 10)
+    conn.destroy()
+    sock.close()
+
+
+def produce(port, queue, count, size, properties):
+    sock, conn = connect(port)
+    sender = conn.create_sender(uuid.uuid4().hex, queue,
+                                properties=properties or None)
+    sender.open()
+    pump(sock, conn, lambda: sender.active)
+
+    presettled = properties.get('snd-settle-mode') == 'settled'
+    outcomes = []
+
+    def sent(link, handle, status, error):
+        outcomes.append(status)
+
+    body = 'x' * size
+    started = time.time()
+    for i in range(count):
+        message = Message()
+        message.body = body
+        sender.send(message, None if presettled else sent)
+    if presettled:
+        pump(sock, conn, lambda: not conn.has_output and not sender.pending)
+    else:
+        pump(sock, conn, lambda: len(outcomes) == count)
+    elapsed = time.time() - started
+    close(sock, conn)
+    return elapsed
+
+
+def consume(port, queue, count, properties):
+    sock, conn = connect(port)
+    received = []
+
+    class Handler(pyngus.ReceiverEventHandler):
+        def message_received(self, link, message, handle):
+            received.append(handle)
+            link.message_accepted(handle)
+            link.add_capacity(1)
+
+    receiver = conn.create_receiver(uuid.uuid4().hex, queue, Handler(),
+                                    properties=properties or None)
+    receiver.add_capacity(100)
+    receiver.open()
+
+    started = time.time()
+    pump(sock, conn, lambda: len(received) >= count)
+    elapsed = time.time() - started
+    # let the last outcomes reach the server
+    pump(sock, conn, lambda: not conn.has_output, 1)
+    close(sock, conn)
+    return elapsed, len(received)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--count", dest="count", type="int", default=20000,
+                      help="Messages per mode [%default]")
+    parser.add_option("--size", dest="size", type="int", default=256,
+                      help="Body size in bytes [%default]")
+    parser.add_option("--port", dest="port", type="int", default=25672,
+                      help="Port of the benchmark server [%default]")
+    parser.add_option("--pool", dest="pool", type="int", default=0,
+                      help="storage_pool_size of the server [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    start_server(opts.port, opts)
+
+    print("%-20s %14s %14s" % ("mode", "produce msg/s", "consume msg/s"))
+    for name, properties in MODES:
+        queue = 'bench-' + uuid.uuid4().hex
+        produced = produce(opts.port, queue, opts.count, opts.size,
+                           properties)
+        consumed, received = consume(opts.port, queue, opts.count,
+                                     properties)
+        if received < opts.count:
+            print("%-20s only %d of %d messages consumed" %
+                  (name, received, opts.count))
+            continue
+        print("%-20s %14.0f %14.0f" % (name, opts.count / produced,
+                                       opts.count / consumed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Socket calls and loop iterations of the server per 10k messages.
+
+Runs the event loop in a thread against the in-memory storage of
+benchmarks/settlement.py, with the sockets it accepts wrapped to count
+the recv and send calls made on them. --count messages are sent to a
+queue and then consumed, with tcp_nodelay on and off.
+
+    $ python benchmarks/syscalls.py --count 10000
+"""
+
+import collections
+import optparse
+import sys
+import threading
+import time
+import uuid
+
+from oslo.config import cfg
+
+import settlement
+from zaqar.queues.transport.amqp import driver
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import messages
+
+COUNTS = collections.Counter()
+
+
+class CountingSocket(object):
+    """Counts the I/O calls made on a socket."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def recv(self, *args):
+        COUNTS['recv'] += 1
+        return self._sock.recv(*args)
+
+    def send(self, *args):
+        COUNTS['send'] += 1
+        return self._sock.send(*args)
+
+    def sendmsg(self, *args):
+        COUNTS['send'] += 1
+        return self._sock.sendmsg(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class CountingListener(object):
+    """Hands out the sockets it accepts as CountingSockets."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def accept(self):
+        sock, address = self._sock.accept()
+        return CountingSocket(sock), address
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def iterations():
+    counts = eventloop._ITERATION.values.get((), [0, 0])
+    return sum(counts[:-1])
+
+
+def start_server(port, nodelay, pool):
+    conf = cfg.ConfigOpts()
+    conf([])
+    conf.register_opts(driver._AMQP_OPTIONS, group=driver._AMQP_GROUP)
+    conf.set_override('storage_pool_size', pool, group=driver._AMQP_GROUP)
+    conf.set_override('tcp_nodelay', nodelay, group=driver._AMQP_GROUP)
+    amqp_conf = conf[driver._AMQP_GROUP]
+
+    storage = settlement.MemoryStorage()
+    controllers = messages.CollectionResource(
+        storage, storage, settlement.ClaimController(storage),
+        batch_size=amqp_conf.ingest_batch_size,
+        batch_window=amqp_conf.ingest_window_ms / 1000.0,
+        prefetch_size=amqp_conf.prefetch_size)
+    t = threading.Thread(target=eventloop.run,
+                         args=("amqp://127.0.0.1:%d" % port, controllers,
+                               amqp_conf))
+    t.daemon = True
+    t.start()
+    time.sleep(0.5)
+
+
+def measure(func, count):
+    """Run func, return its counts scaled to 10k messages."""
+    COUNTS.clear()
+    before = iterations()
+    func()
+    scale = 10000.0 / count
+    return (COUNTS['recv'] * scale, COUNTS['send'] * scale,
+            (iterations() - before) * scale)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--count", dest="count", type="int", default=10000,
+                      help="Messages per run [%default]")
+    parser.add_option("--size", dest="size", type="int", default=64,
+                      help="Body size in bytes [%default]")
+    parser.add_option("--port", dest="port", type="int", default=25680,
+                      help="First port of the benchmark servers "
+                           "[%default]")
+    parser.add_option("--pool", dest="pool", type="int", default=0,
+                      help="storage_pool_size of the servers [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    server_socket = eventloop.utils.server_socket
+    eventloop.utils.server_socket = \
+        lambda *args, **kwargs: CountingListener(server_socket(*args,
+                                                               **kwargs))
+
+    print("%-10s %-8s %10s %10s %12s" % ("nodelay", "phase", "recv",
+                                         "send", "iterations"))
+    for offset, nodelay in enumerate((True, False)):
+        port = opts.port + offset
+        start_server(port, nodelay, opts.pool)
+        queue = 'bench-' + uuid.uuid4().hex
+        results = [
+            ("produce", measure(lambda: settlement.produce(
+                port, queue, opts.count, opts.size, {}), opts.count)),
+            ("consume", measure(lambda: settlement.consume(
+                port, queue, opts.count, {}), opts.count)),
+        ]
+        for phase, (recv, send, loops) in results:
+            print("%-10s %-8s %10.0f %10.0f %12.0f" % (nodelay, phase, recv,
+                                                       send, loops))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-tick cost of the connection timers with heartbeats running.
+
+Every connection is a server side SocketConnection on one end of a
+socketpair, opened by a pyngus client on the other end that advertises an
+idle timeout of twice --heartbeat, so the server owes it an empty frame
+every --heartbeat seconds. The loop sleeps until the next deadline, then
+sends the heartbeats that are due; the time spent finding the next
+deadline, the expired connections and rescheduling them is measured per
+tick.
+
+"before" is the scan the loop used to do: need_processing() sorts the
+deadlines of all the connections on every tick, and the clock is read for
+every timer.
+
+    $ python benchmarks/timers.py --connections 1000,10000
+"""
+
+import optparse
+import socket
+import sys
+import time
+
+import pyngus
+
+import helpers
+from zaqar.queues.transport.amqp import eventloop
+
+
+class Legacy(object):
+    """The connection timers as handled before the timer wheel."""
+
+    def __init__(self, container, listener):
+        self.container = container
+        self._timers = []
+
+    def register(self, sconn):
+        pass
+
+    def unregister(self, sconn):
+        pass
+
+    def update(self, sconn):
+        pass
+
+    def prepare(self):
+        readers, writers, self._timers = self.container.need_processing()
+        if self._timers:
+            return self._timers[0].next_tick
+        return None
+
+    def expired(self, now):
+        for t in self._timers:
+            if t.next_tick > time.time():
+                break
+            yield t.user_context
+
+
+def open_connections(container, clients, count, heartbeat, groups=20):
+    """Return the (server, client, socket) of `count` open connections.
+
+    They are opened in `groups` spread over a heartbeat interval, so their
+    deadlines don't all come up at once.
+    """
+    pairs = []
+    for i in range(count):
+        server_socket, client_socket = socket.socketpair()
+        server_socket.setblocking(0)
+        client_socket.setblocking(0)
+        sconn = eventloop.SocketConnection(container, server_socket,
+                                           "conn-%d" % i, {}, None)
+        client = clients.create_connection("client-%d" % i, None,
+                                           {'idle-time-out': 2 * heartbeat})
+        client.pn_sasl.mechanisms("ANONYMOUS")
+        client.pn_sasl.client()
+        client.open()
+        pairs.append((sconn, client, client_socket))
+
+    size = max(1, count // groups)
+    started = time.time()
+    for i in range(0, count, size):
+        time.sleep(max(0, started + heartbeat * i / count - time.time()))
+        helpers.handshake(pairs[i:i + size])
+    return pairs
+
+
+def bench(scheduler, count, heartbeat, duration):
+    container = pyngus.Container("bench")
+    clients = pyngus.Container("bench-clients")
+    listener, listener_peer = socket.socketpair()
+    if scheduler == 'before':
+        poller = Legacy(container, listener)
+    else:
+        poller = eventloop.get_poller(scheduler, container, listener)
+
+    pairs = []
+    try:
+        pairs = open_connections(container, clients, count, heartbeat)
+        for sconn, client, client_socket in pairs:
+            poller.register(sconn)
+
+        samples = []
+        sent = 0
+        started = time.time()
+        while time.time() - started < duration:
+            begin = time.time()
+            deadline = poller.prepare()
+            elapsed = time.time() - begin
+
+            if deadline:
+                time.sleep(max(0, deadline - time.time()))
+            now = time.time()
+            begin = now
+            due = list(poller.expired(now))
+            elapsed += time.time() - begin
+
+            for sconn in due:
+                sconn.connection.process(now)
+                if sconn.connection.has_output > 0:
+                    sconn.send_output(now)
+
+            begin = time.time()
+            for sconn in due:
+                poller.update(sconn)
+            elapsed += time.time() - begin
+
+            samples.append(elapsed)
+            sent += len(due)
+        elapsed = time.time() - started
+    finally:
+        for sconn, client, client_socket in pairs:
+            poller.unregister(sconn)
+            sconn.destroy()
+            client.destroy()
+            client_socket.close()
+        container.destroy()
+        clients.destroy()
+        listener.close()
+        listener_peer.close()
+
+    return {'ticks': len(samples),
+            'p50': helpers.percentile(samples, 0.50) * 1e6,
+            'p99': helpers.percentile(samples, 0.99) * 1e6,
+            'cpu': sum(samples) / elapsed * 100,
+            'heartbeats': sent / elapsed}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--connections", dest="connections", type="string",
+                      default="1000,10000",
+                      help="Comma separated connection counts [%default]")
+    parser.add_option("--heartbeat", dest="heartbeat", type="float",
+                      default=5.0,
+                      help="Seconds between heartbeats of a connection "
+                           "[%default]")
+    parser.add_option("--duration", dest="duration", type="float",
+                      default=10.0,
+                      help="Seconds measured per run [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    counts = [int(c) for c in opts.connections.split(',')]
+    helpers.raise_fd_limit(max(counts))
+
+    print("%-10s %8s %8s %12s %12s %8s %12s" % (
+        "timers", "conns", "ticks", "p50 (us)", "p99 (us)", "cpu %",
+        "heartbeat/s"))
+    for count in counts:
+        for scheduler in ('before', 'select', 'selectors'):
+            try:
+                result = bench(scheduler, count, opts.heartbeat,
+                               opts.duration)
+            except ValueError as e:
+                # select() can't watch descriptors above FD_SETSIZE
+                print("%-10s %8d %s" % (scheduler, count, e))
+                continue
+            print("%-10s %8d %8d %12.1f %12.1f %8.1f %12.0f" % (
+                scheduler, count, result['ticks'], result['p50'],
+                result['p99'], result['cpu'], result['heartbeats']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-delivery cost of the delivery path logging.
+
+Compares the print() the links used to do for every message (written to
+/dev/null here, a terminal or a log pipe is slower) with the sampled
+tracer, off and at a few sampling rates.
+
+    $ python benchmarks/tracing.py --count 100000
+"""
+
+import logging
+import optparse
+import os
+import sys
+import time
+
+from proton import Message
+
+from zaqar.queues.transport.amqp import tracing
+
+
+def sample_message(size):
+    msg = Message()
+    msg.body = b'x' * size
+    msg.subject = 'bench'
+    return msg
+
+
+def legacy(name, message):
+    print("Message received on receiver link %s, message = %s"
+          % (name, str(message)))
+
+
+def make_traced(tracer):
+    def traced(name, message):
+        if tracer.enabled and tracer.sample():
+            tracer.log("Message received on receiver link %s, message = %s",
+                       name, message)
+    return traced
+
+
+def measure(func, args, count):
+    """Return microseconds per call."""
+    started = time.time()
+    for i in range(count):
+        func(*args)
+    return (time.time() - started) / count * 1e6
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--count", dest="count", type="int", default=100000,
+                      help="Deliveries per measurement [%default]")
+    parser.add_option("--size", dest="size", type="int", default=256,
+                      help="Body size in bytes [%default]")
+    opts, extra = parser.parse_args(args=argv)
+
+    devnull = open(os.devnull, 'w')
+    logger = logging.getLogger('benchmarks.tracing')
+    logger.propagate = False
+    logger.addHandler(logging.StreamHandler(devnull))
+    logger.setLevel(logging.DEBUG)
+    tracer = tracing.Tracer(logger)
+
+    args = ('bench-link', sample_message(opts.size))
+    results = []
+
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        results.append(("print (before)", measure(legacy, args, opts.count)))
+        for every in (0, 1000, 100, 1):
+            tracer.configure(every)
+            name = "tracer off" if not every else "tracer 1/%d" % every
+            results.append((name, measure(make_traced(tracer), args,
+                                          opts.count)))
+    finally:
+        sys.stdout = stdout
+
+    print("%-16s %14s" % ("logging", "us/delivery"))
+    for name, elapsed in results:
+        print("%-16s %14.3f" % (name, elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import admission
+
+
+class TestAdmission(base.TestBase):
+
+    def test_no_limits(self):
+        limits = admission.Admission()
+        self.assertEqual(100, limits.available(0, 100))
+        for i in range(100):
+            self.assertIsNone(limits.admit('h', 0))
+        self.assertIsNone(limits.deadline())
+
+    def test_max_connections(self):
+        limits = admission.Admission(max_connections=2)
+        self.assertEqual(2, limits.available(0, 10))
+        self.assertIsNone(limits.admit('a', 0))
+        self.assertIsNone(limits.admit('b', 0))
+        self.assertEqual(0, limits.available(0, 10))
+        self.assertEqual('total', limits.admit('c', 0))
+        # accepting resumes as connections close, not with time
+        self.assertIsNone(limits.deadline())
+
+        limits.release('a')
+        self.assertEqual(1, limits.available(0, 10))
+        self.assertEqual({'b': 1}, limits.hosts)
+
+    def test_max_per_host(self):
+        limits = admission.Admission(max_per_host=2)
+        self.assertIsNone(limits.admit('a', 0))
+        self.assertIsNone(limits.admit('a', 0))
+        self.assertEqual('host', limits.admit('a', 0))
+        self.assertIsNone(limits.admit('b', 0))
+        self.assertEqual(3, limits.open)
+
+        limits.release('a')
+        self.assertIsNone(limits.admit('a', 0))
+
+    def test_rate_allows_bursts(self):
+        limits = admission.Admission(rate=10, burst=3)
+        self.assertEqual(3, limits.available(0, 10))
+        for i in range(3):
+            self.assertIsNone(limits.admit('a', 0))
+        self.assertEqual(0, limits.available(0, 10))
+        self.assertEqual('rate', limits.admit('a', 0))
+        self.assertAlmostEqual(0.1, limits.deadline())
+
+        # a token every 1/rate seconds, up to the burst
+        self.assertEqual(1, limits.available(0.15, 10))
+        self.assertEqual(3, limits.available(10, 10))
+
+    def test_backoff(self):
+        limits = admission.Admission()
+        limits.backoff(5, 1)
+        self.assertEqual(6, limits.deadline())
+        self.assertEqual(0, limits.available(5.5, 10))
+        self.assertEqual(10, limits.available(6, 10))
+        self.assertIsNone(limits.deadline())
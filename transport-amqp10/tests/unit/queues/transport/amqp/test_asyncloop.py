@@ -0,0 +1,133 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import select
+import socket
+import time
+
+import pyngus
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import messages
+
+try:
+    import asyncio
+
+    from zaqar.queues.transport.amqp import asyncloop
+except ImportError:
+    asyncio = None
+
+TIMEOUT = 10
+
+
+class Conf(object):
+    """The options asyncloop.Server reads, with their defaults."""
+
+    workers = 1
+    accept_batch = 64
+    max_connections = 0
+    max_connections_per_host = 0
+    accept_rate = 0
+    tcp_nodelay = True
+    idle_timeout = 60
+    receiver_credit = 10
+    receiver_credit_min = 1
+    receiver_credit_max = 100
+    receiver_credit_budget = 0
+    max_message_size = 0
+    max_frame_size = 65536
+    spool_threshold = 0
+    storage_pool_size = 0
+    notifier_url = ''
+    stats_file = ''
+    stats_interval = 10
+
+
+class Client(pyngus.ConnectionEventHandler):
+    """An AMQP client on a blocking socket, run off the event loop."""
+
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        container = pyngus.Container('client')
+        self.connection = container.create_connection(
+            'client', self, {'x-sasl-mechs': 'ANONYMOUS'})
+        self.connection.open()
+
+    def pump(self, until):
+        connection = self.connection
+        deadline = time.time() + TIMEOUT
+        while not until() and time.time() < deadline:
+            connection.process(time.time())
+            if connection.has_output > 0:
+                pyngus.write_socket_output(connection, self.socket)
+            if select.select([self.socket], [], [], 0.05)[0]:
+                pyngus.read_socket_input(connection, self.socket)
+        connection.process(time.time())
+        return until()
+
+    def close(self):
+        self.connection.close()
+        self.pump(lambda: self.connection.closed)
+        self.connection.destroy()
+        self.socket.close()
+
+
+class TestServer(base.TestBase):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        if asyncio is None:
+            self.skipTest('needs asyncio')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        controllers = messages.CollectionResource(None, None, None)
+        self.server = asyncloop.Server(self.loop, controllers, Conf())
+        # newer proton has no pn_sasl.server(), pyngus configures it
+        self.server.conn_properties.update({'x-server': True,
+                                            'x-sasl-mechs': 'ANONYMOUS'})
+        listener = self.loop.run_until_complete(self.loop.create_server(
+            self.server.protocol, '127.0.0.1', 0))
+        self.addCleanup(self.loop.run_until_complete,
+                        listener.wait_closed())
+        self.addCleanup(listener.close)
+        self.address = listener.sockets[0].getsockname()
+
+    def run_client(self, func):
+        """Run func(client) on a thread while the loop serves it."""
+        def run():
+            client = Client(self.address)
+            try:
+                return func(client)
+            finally:
+                client.close()
+        return self.loop.run_until_complete(
+            self.loop.run_in_executor(None, run))
+
+    def test_handshake(self):
+        def handshake(client):
+            return client.pump(lambda: client.connection.active)
+
+        self.assertTrue(self.run_client(handshake))
+        # the server let go of the connection once the client closed it
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(set(), self.server.connections)
+
+    def test_links(self):
+        def attach(client):
+            sender = client.connection.create_sender('sender', 'q')
+            sender.open()
+            client.pump(lambda: sender.credit > 0)
+            return sender.credit
+
+        self.assertEqual(10, self.run_client(attach))
@@ -0,0 +1,69 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import buffers
+
+
+class TestReadBuffer(base.TestBase):
+
+    def setUp(self):
+        super(TestReadBuffer, self).setUp()
+        self.buffer = buffers.ReadBuffer(minimum=16, maximum=64, window=4)
+
+    def test_views_are_bounded_by_the_wanted_bytes(self):
+        self.assertEqual(10, len(self.buffer.get(10)))
+        self.assertEqual(16, len(self.buffer.get(1000)))
+
+    def test_reused_between_reads(self):
+        view = self.buffer.get(16)
+        view[:3] = b'abc'
+        self.buffer.update(16, 3)
+        # the next read overwrites the same memory
+        self.buffer.get(16)[:2] = b'xy'
+        self.assertEqual(b'xyc', bytes(view[:3]))
+
+    def test_grows_while_reads_fill_it(self):
+        self.buffer.update(1000, 16)
+        self.assertEqual(32, self.buffer.size)
+        self.buffer.update(1000, 32)
+        self.buffer.update(1000, 64)
+        self.assertEqual(64, self.buffer.size)
+
+    def test_full_read_of_what_was_wanted_does_not_grow(self):
+        self.buffer.update(16, 16)
+        self.assertEqual(16, self.buffer.size)
+
+    def test_shrinks_after_a_window_of_small_reads(self):
+        self.buffer.update(1000, 16)
+        self.buffer.update(1000, 32)
+        for i in range(3):
+            self.buffer.update(1000, 1)
+        self.assertEqual(64, self.buffer.size)
+        # a larger read starts the window over
+        self.buffer.update(1000, 40)
+        for i in range(3):
+            self.buffer.update(1000, 1)
+        self.assertEqual(64, self.buffer.size)
+        self.buffer.update(1000, 1)
+        self.assertEqual(32, self.buffer.size)
+
+        for i in range(8):
+            self.buffer.update(1000, 1)
+        self.assertEqual(16, self.buffer.size)
+
+    def test_release(self):
+        self.buffer.release()
+        self.assertEqual(0, self.buffer.size)
+        self.assertIsNone(self.buffer.view)
@@ -0,0 +1,566 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import time
+
+import proton
+import pyngus
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import buffers
+from zaqar.queues.transport.amqp import eventloop
+from zaqar.queues.transport.amqp import flow
+
+FRAME_SIZE = 512
+SERVER_PROPERTIES = {'max-frame-size': FRAME_SIZE, 'x-server': True,
+                     'x-sasl-mechs': 'ANONYMOUS'}
+CLIENT_PROPERTIES = {'max-frame-size': FRAME_SIZE,
+                     'x-sasl-mechs': 'ANONYMOUS'}
+
+
+class PyngusState(object):
+
+    def __init__(self):
+        self.needs_input = 0
+        self.next_tick = 0
+
+
+class PolledConnection(object):
+    """The parts of a SocketConnection the pollers look at."""
+
+    def __init__(self, socket_):
+        self.socket = socket_
+        self.connection = PyngusState()
+        self.output_pending = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+class TestSelectorsPoller(base.TestBase):
+
+    def setUp(self):
+        super(TestSelectorsPoller, self).setUp()
+        if eventloop.selectors is None:
+            self.skipTest('needs the selectors module')
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.addCleanup(self.listener.close)
+        self.poller = eventloop.SelectorsPoller(None, self.listener)
+
+    def socketpair(self):
+        ours, peer = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(peer.close)
+        return PolledConnection(ours), peer
+
+    def test_idle_connections_are_not_registered(self):
+        sconn, peer = self.socketpair()
+        self.poller.register(sconn)
+        peer.send(b'x')
+        self.assertEqual(([], []), self.poller.poll(0))
+        self.assertIsNone(self.poller.prepare())
+        self.poller.unregister(sconn)
+
+    def test_readable(self):
+        sconn, peer = self.socketpair()
+        sconn.connection.needs_input = 1024
+        self.poller.register(sconn)
+        self.assertEqual(([], []), self.poller.poll(0))
+
+        peer.send(b'x')
+        self.assertEqual(([sconn], []), self.poller.poll(0))
+
+    def test_modify_interest(self):
+        sconn, peer = self.socketpair()
+        sconn.connection.needs_input = 1024
+        self.poller.register(sconn)
+
+        sconn.output_pending = True
+        self.poller.update(sconn)
+        self.assertEqual(([], [sconn]), self.poller.poll(0))
+        peer.send(b'x')
+        self.assertEqual(([sconn], [sconn]), self.poller.poll(0))
+
+        sconn.connection.needs_input = 0
+        self.poller.update(sconn)
+        self.assertEqual(([], [sconn]), self.poller.poll(0))
+
+        # no interest left, taken out of the selector
+        sconn.output_pending = False
+        self.poller.update(sconn)
+        self.assertEqual(([], []), self.poller.poll(0))
+        self.poller.unregister(sconn)
+
+    def test_unregister(self):
+        sconn, peer = self.socketpair()
+        sconn.connection.needs_input = 1024
+        self.poller.register(sconn)
+        self.poller.unregister(sconn)
+        peer.send(b'x')
+        self.assertEqual(([], []), self.poller.poll(0))
+
+        # updates of unregistered connections are ignored
+        self.poller.update(sconn)
+        self.assertEqual(([], []), self.poller.poll(0))
+
+    def test_listener_and_extra_readers(self):
+        client = socket.create_connection(self.listener.getsockname())
+        self.addCleanup(client.close)
+        self.assertEqual(([self.listener], []), self.poller.poll(1))
+
+        self.poller.remove_reader(self.listener)
+        self.assertEqual(([], []), self.poller.poll(0))
+
+        ours, peer = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(peer.close)
+        self.poller.add_reader(ours)
+        peer.send(b'x')
+        self.assertEqual(([ours], []), self.poller.poll(0))
+
+    def test_deadlines(self):
+        sconn, peer = self.socketpair()
+        deadline = time.time() + 5
+        sconn.connection.next_tick = deadline
+        self.poller.register(sconn)
+        self.assertAlmostEqual(deadline, self.poller.prepare(), delta=0.02)
+
+        self.assertEqual([], list(self.poller.expired(deadline - 1)))
+        self.assertEqual([sconn], list(self.poller.expired(deadline + 1)))
+        self.assertIsNone(self.poller.prepare())
+
+
+class Controllers(object):
+    """Records the posts of the receiver links."""
+
+    def __init__(self):
+        self.posts = []
+
+    def on_post(self, message, queue_name, callback, size=0):
+        self.posts.append((queue_name, message, callback))
+
+
+class Peer(object):
+    """A client pyngus Connection wired to `server` in memory."""
+
+    def __init__(self, server, properties=CLIENT_PROPERTIES):
+        self.server = server
+        container = pyngus.Container('client')
+        self.connection = container.create_connection(
+            'client', pyngus.ConnectionEventHandler(), properties)
+        self.connection.open()
+
+    def pump(self, limit=None, now=None):
+        """Exchange frames until both sides are quiet.
+
+        At most `limit` bytes of the client's output reach the server.
+        """
+        client = self.connection
+        while True:
+            now = now or time.time()
+            client.process(now)
+            self.server.process(now)
+            moved = 0
+            for source, sink in ((client, self.server.connection),
+                                 (self.server.connection, client)):
+                while source.has_output > 0 and sink.needs_input > 0:
+                    count = min(source.has_output, sink.needs_input)
+                    if source is client and limit is not None:
+                        count = min(count, limit)
+                        limit -= count
+                        if not count:
+                            break
+                    data = source.output_data()[:count]
+                    sink.process_input(data)
+                    source.output_written(count)
+                    moved += count
+            if not moved:
+                return
+
+
+class Sender(pyngus.SenderEventHandler):
+
+    def __init__(self):
+        self.error = None
+
+    def sender_remote_closed(self, sender_link, error):
+        self.error = error
+        sender_link.close()
+
+
+class TestReceiverLink(base.TestBase):
+
+    def setUp(self):
+        super(TestReceiverLink, self).setUp()
+        self.controllers = Controllers()
+        policy = flow.CreditPolicy(initial=10, maximum=10,
+                                   max_message_size=2000,
+                                   spool_threshold=600)
+        self.server = eventloop.Connection(
+            pyngus.Container('server'), 'client', SERVER_PROPERTIES,
+            self.controllers, set(), policy)
+        self.addCleanup(self.server.destroy)
+        self.peer = Peer(self.server)
+
+        self.sender = Sender()
+        self.sender_link = self.peer.connection.create_sender(
+            'sender', 'q', self.sender)
+        self.sender_link.open()
+        self.peer.pump()
+        self.link, = self.server.receiver_links
+
+    def send(self, size, fill=u'x'):
+        message = proton.Message()
+        message.body = fill * size
+        self.sender_link.send(message)
+
+    def bodies(self):
+        return [message.body for q, message, c in self.controllers.posts]
+
+    def test_single_frame_deliveries(self):
+        self.send(100)
+        self.peer.pump()
+        self.assertEqual([u'x' * 100], self.bodies())
+        self.assertIsNone(self.link.spool)
+
+    def test_multi_frame_deliveries_are_spooled(self):
+        body = u''.join(u'%d' % (i % 10) for i in range(1500))
+        self.send(len(body))
+        self.send(len(body), fill=u'y')
+        self.peer.pump(limit=1300)
+        self.assertIsNotNone(self.link.spool)
+        self.assertTrue(self.link.spool._file._rolled)
+        self.assertEqual([], self.controllers.posts)
+
+        message = proton.Message()
+        message.body = body
+        self.sender_link.send(message)
+        self.peer.pump()
+        # the frames were put back together in order
+        self.assertEqual([u'x' * 1500, u'y' * 1500, body], self.bodies())
+        self.assertIsNone(self.link.spool)
+
+    def test_spool_closed_with_the_link(self):
+        self.send(1500)
+        self.peer.pump(limit=1000)
+        delivery = self.link.spool
+        self.assertIsNotNone(delivery)
+
+        self.server.destroy()
+        self.assertTrue(delivery._file.closed)
+        self.assertIsNone(self.link.spool)
+
+    def test_refused_once_max_message_size_is_crossed(self):
+        self.send(100)
+        self.send(5000)
+        self.send(100)
+        self.peer.pump(limit=1500)
+        # the first frames of the large message were taken in
+        self.assertIsNotNone(self.link.spool)
+        delivery = self.link.spool
+
+        self.peer.pump()
+        self.assertTrue(self.link.oversized)
+        self.assertTrue(delivery._file.closed)
+        self.assertIsNone(self.link.spool)
+        self.assertEqual('amqp:link:message-size-exceeded',
+                         self.sender.error.name)
+        self.assertEqual([u'x' * 100], self.bodies())
+
+
+class ShortWrites(object):
+    """A socket that takes at most `limit` bytes per write."""
+
+    def __init__(self, socket_, limit):
+        self.socket = socket_
+        self.limit = limit
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sendmsg(self, buffers):
+        return self.send(b''.join(bytes(b) for b in buffers))
+
+    def send(self, data):
+        return self.socket.send(data[:self.limit])
+
+    def close(self):
+        self.socket.close()
+
+
+class TestWriteOutput(base.TestBase):
+
+    def setUp(self):
+        super(TestWriteOutput, self).setUp()
+        ours, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        self.socket = ShortWrites(ours, 5)
+        self.sconn = eventloop.SocketConnection(
+            pyngus.Container('server'), self.socket, 'client',
+            SERVER_PROPERTIES, None)
+        self.addCleanup(self.sconn.destroy)
+
+        self.client = pyngus.Container('client').create_connection(
+            'client', pyngus.ConnectionEventHandler(), CLIENT_PROPERTIES)
+        self.client.open()
+
+    def exchange(self, data=None):
+        """Hand `data` to the client and its answer to the server.
+
+        Returns what the server has to send then.
+        """
+        client = self.client
+        if data:
+            client.process_input(data)
+        client.process(time.time())
+        data = bytes(client.output_data())
+        client.output_written(len(data))
+        self.sconn.connection.process_input(data)
+        self.sconn.process(time.time())
+        return bytes(self.sconn.connection.output_data())
+
+    def check_short_writes(self):
+        first = self.exchange()
+        self.sconn.write_output()
+        self.assertEqual(first[:5], self.peer.recv(1000))
+        self.assertEqual(0, self.sconn.connection.has_output)
+        self.assertEqual(len(first) - 5, self.sconn._unsent_bytes)
+        self.assertTrue(self.sconn.output_pending)
+
+        # more output is queued behind the rest of the first
+        second = self.exchange(first)
+        self.assertTrue(second)
+        self.socket.limit = 10 ** 6
+        self.sconn.write_output()
+        self.assertEqual(first[5:] + second, self.peer.recv(10 ** 6))
+        self.assertEqual(0, self.sconn._unsent_bytes)
+        self.assertFalse(self.sconn.output_pending)
+
+    def test_short_writes(self):
+        if not hasattr(socket.socket, 'sendmsg'):
+            self.skipTest('needs sendmsg')
+        self.check_short_writes()
+
+    def test_short_writes_without_sendmsg(self):
+        send_buffers = eventloop._send_buffers
+        self.addCleanup(setattr, eventloop, '_send_buffers', send_buffers)
+        eventloop._send_buffers = eventloop._send_joined
+        self.check_short_writes()
+
+
+class TestReadInput(base.TestBase):
+
+    def setUp(self):
+        super(TestReadInput, self).setUp()
+        self.read_buffer = buffers.ReadBuffer(minimum=8, maximum=64)
+        self.controllers = Controllers()
+
+    def connect(self):
+        ours, peer = socket.socketpair()
+        ours.setblocking(0)
+        self.addCleanup(peer.close)
+        policy = flow.CreditPolicy(initial=100, maximum=100)
+        sconn = eventloop.SocketConnection(
+            pyngus.Container('server'), ours, 'client', SERVER_PROPERTIES,
+            self.controllers, credit_policy=policy,
+            read_buffer=self.read_buffer)
+        self.addCleanup(sconn.destroy)
+        client = pyngus.Container('client').create_connection(
+            'client', pyngus.ConnectionEventHandler(), CLIENT_PROPERTIES)
+        client.open()
+        return sconn, peer, client
+
+    def send(self, peer, client):
+        """Write the client's output to the server's socket."""
+        client.process(time.time())
+        sent = 0
+        while client.has_output > 0:
+            data = bytes(client.output_data())
+            client.output_written(len(data))
+            peer.sendall(data)
+            sent += len(data)
+        return sent
+
+    def answer(self, sconn, client):
+        """Hand what the server has to send to the client."""
+        sconn.process(time.time())
+        data = sconn.connection.output_data()
+        if data:
+            client.process_input(bytes(data))
+            sconn.connection.output_written(len(data))
+
+    def read_all(self, sconn):
+        reads = []
+        while True:
+            count = sconn.read_input()
+            if not count:
+                return reads
+            reads.append(count)
+
+    def exchange(self, sconn, peer, client):
+        for i in range(10):
+            if not self.send(peer, client):
+                break
+            self.read_all(sconn)
+            self.answer(sconn, client)
+
+    def test_input_read_over_several_calls(self):
+        sconn, peer, client = self.connect()
+        self.send(peer, client)
+        self.assertEqual([8], self.read_all(sconn))
+        self.answer(sconn, client)
+
+        # the buffer doubled when the read filled it
+        self.assertEqual(16, self.read_buffer.size)
+        self.send(peer, client)
+        self.assertEqual(16, self.read_all(sconn)[0])
+        self.assertEqual(32, self.read_buffer.size)
+        self.answer(sconn, client)
+
+        self.exchange(sconn, peer, client)
+        self.assertTrue(client.active)
+        self.assertTrue(sconn.connection.active)
+        self.assertEqual(64, self.read_buffer.size)
+
+    def test_engine_takes_part_of_the_input(self):
+        self.read_buffer = buffers.ReadBuffer(minimum=64 * 1024,
+                                              maximum=64 * 1024)
+        sconn, peer, client = self.connect()
+        self.exchange(sconn, peer, client)
+        sender = client.create_sender('sender', 'q')
+        sender.open()
+        self.exchange(sconn, peer, client)
+
+        for i in range(40):
+            message = proton.Message()
+            message.body = u'%03d' % i + u'x' * 500
+            sender.send(message)
+        sent = self.send(peer, client)
+        wanted = sconn.connection.needs_input
+        self.assertTrue(0 < wanted < sent)
+
+        # the rest waits in the socket for the next reads
+        self.assertEqual(wanted, sconn.read_input())
+        sconn.process(time.time())
+        self.assertEqual(sent - wanted, sum(self.read_all(sconn)))
+        sconn.process(time.time())
+        self.assertEqual([u'%03d' % i for i in range(40)],
+                         [message.body[:3] for q, message, c
+                          in self.controllers.posts])
+
+    def test_connections_share_the_buffer(self):
+        first, first_peer, first_client = self.connect()
+        second, second_peer, second_client = self.connect()
+        for i in range(10):
+            sent = (self.send(first_peer, first_client) +
+                    self.send(second_peer, second_client))
+            if not sent:
+                break
+            # reads of both connections alternate in the same buffer
+            while first.read_input() + second.read_input():
+                pass
+            self.answer(first, first_client)
+            self.answer(second, second_client)
+        self.assertTrue(first_client.active)
+        self.assertTrue(second_client.active)
+
+    def test_peer_closed(self):
+        sconn, peer, client = self.connect()
+        peer.close()
+        self.assertEqual(0, sconn.read_input())
+        self.assertEqual(pyngus.Connection.EOS, sconn.connection.needs_input)
+
+    def test_nothing_to_read(self):
+        sconn, peer, client = self.connect()
+        self.assertEqual(0, sconn.read_input())
+        self.assertTrue(sconn.connection.needs_input > 0)
+
+
+class TestConnectionTimers(base.TestBase):
+
+    def setUp(self):
+        super(TestConnectionTimers, self).setUp()
+        self.timers = eventloop.ConnectionTimers()
+
+    def connect(self, idle_timeout=0, client_idle_timeout=0):
+        properties = dict(SERVER_PROPERTIES)
+        if idle_timeout:
+            properties['idle-time-out'] = idle_timeout
+        server = eventloop.Connection(pyngus.Container('server'), 'client',
+                                      properties, Controllers(), set())
+        self.addCleanup(server.destroy)
+        properties = dict(CLIENT_PROPERTIES)
+        if client_idle_timeout:
+            properties['idle-time-out'] = client_idle_timeout
+        peer = Peer(server, properties)
+        peer.pump()
+        self.assertTrue(server.connection.active)
+        self.timers.update(server)
+        return server, peer
+
+    def test_no_deadline_without_timeouts(self):
+        server, peer = self.connect()
+        self.assertIsNone(self.timers.deadline())
+
+    def test_deadline_follows_the_idle_timeout(self):
+        now = time.time()
+        server, peer = self.connect(idle_timeout=2)
+        self.assertAlmostEqual(now + 2, self.timers.deadline(), delta=0.1)
+
+    def test_rearmed_on_input(self):
+        server, peer = self.connect(idle_timeout=2)
+        deadline = self.timers.deadline()
+
+        # the client's heartbeat
+        peer.pump(now=deadline - 1)
+        self.timers.update(server)
+        self.assertAlmostEqual(deadline + 1, self.timers.deadline(),
+                               delta=0.1)
+        self.assertEqual([], list(self.timers.expired(deadline)))
+        self.assertFalse(server.closed)
+
+    def test_closed_once_idle_timeout_passes(self):
+        server, peer = self.connect(idle_timeout=2)
+        deadline = self.timers.deadline()
+        self.assertEqual([], list(self.timers.expired(deadline - 1)))
+
+        reaped = eventloop._REAPED.values.get(('heartbeat',), 0)
+        self.assertEqual([server], list(self.timers.expired(deadline)))
+        server.process(deadline)
+        self.assertTrue(server.closed)
+        self.assertEqual(reaped + 1,
+                         eventloop._REAPED.values[('heartbeat',)])
+        self.assertIsNone(self.timers.deadline())
+
+    def test_heartbeats_for_the_client(self):
+        now = time.time()
+        server, peer = self.connect(client_idle_timeout=4)
+        # a frame is due well within the client's idle timeout
+        deadline = self.timers.deadline()
+        self.assertTrue(now < deadline <= now + 2)
+
+        self.assertEqual([server], list(self.timers.expired(deadline)))
+        server.process(deadline)
+        self.assertTrue(server.connection.has_output > 0)
+        self.assertFalse(server.closed)
+        self.timers.update(server)
+        self.assertTrue(deadline < self.timers.deadline())
+
+    def test_remove(self):
+        server, peer = self.connect(idle_timeout=2)
+        self.timers.remove(server)
+        self.assertIsNone(self.timers.deadline())
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import select
+import threading
+import time
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import executor
+
+TIMEOUT = 10
+
+
+class TestInlineExecutor(base.TestBase):
+
+    def test_calls_back_right_away(self):
+        results = []
+        executor.InlineExecutor().submit(
+            'q', lambda a, b: a + b, (1, 2),
+            lambda result, error: results.append((result, error)))
+        self.assertEqual([(3, None)], results)
+
+    def test_passes_errors_to_the_callback(self):
+        results = []
+
+        def fail():
+            raise KeyError('boom')
+
+        executor.InlineExecutor().submit(
+            'q', fail, (), lambda result, error: results.append(error))
+        self.assertIsInstance(results[0], KeyError)
+
+
+class TestStoragePool(base.TestBase):
+
+    def setUp(self):
+        super(TestStoragePool, self).setUp()
+        self.pool = executor.StoragePool(4)
+        self.completed = []
+
+    def callback(self, result, error):
+        self.completed.append((result, error))
+
+    def run_completions(self, count):
+        """Run the pool's callbacks until `count` of them ran."""
+        deadline = time.time() + TIMEOUT
+        while len(self.completed) < count and time.time() < deadline:
+            select.select([self.pool.fileno()], [], [], 0.1)
+            self.pool.run_completions()
+        self.assertEqual(count, len(self.completed))
+
+    def test_calls_of_a_lane_run_in_order_one_at_a_time(self):
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0}
+        overlaps = []
+        calls = []
+
+        def call(key, i):
+            with lock:
+                running[key] += 1
+                if running[key] > 1:
+                    overlaps.append((key, i))
+            time.sleep(0.001)
+            with lock:
+                running[key] -= 1
+                calls.append((key, i))
+            return i
+
+        for i in range(20):
+            for key in ('a', 'b'):
+                self.pool.submit(key, call, (key, i), self.callback)
+        self.run_completions(40)
+
+        self.assertEqual([], overlaps)
+        for key in ('a', 'b'):
+            self.assertEqual(list(range(20)),
+                             [i for k, i in calls if k == key])
+
+    def test_busy_lane_does_not_hold_up_others(self):
+        release = threading.Event()
+        done = threading.Event()
+        self.pool.submit('slow', release.wait, (TIMEOUT,), self.callback)
+        self.pool.submit('slow', lambda: 'after', (), self.callback)
+        self.pool.submit('fast', done.set, ())
+
+        self.assertTrue(done.wait(TIMEOUT))
+        self.assertEqual([], self.completed)
+        release.set()
+        self.run_completions(2)
+        self.assertEqual([(True, None), ('after', None)], self.completed)
+
+    def test_callbacks_run_on_the_calling_thread(self):
+        threads = []
+        self.pool.submit(
+            'q', threading.current_thread, (),
+            lambda result, error: threads.append(
+                (result, threading.current_thread())))
+        deadline = time.time() + TIMEOUT
+        while not threads and time.time() < deadline:
+            select.select([self.pool.fileno()], [], [], 0.1)
+            self.pool.run_completions()
+
+        worker, caller = threads[0]
+        self.assertIsNot(worker, caller)
+        self.assertIs(threading.current_thread(), caller)
+
+    def test_errors_and_failing_callbacks(self):
+        def fail():
+            raise ValueError('boom')
+
+        def bad_callback(result, error):
+            raise RuntimeError('callback')
+
+        self.pool.submit('q', fail, (), self.callback)
+        self.pool.submit('q', lambda: 1, (), bad_callback)
+        self.pool.submit('q', lambda: 2, (), self.callback)
+        self.run_completions(2)
+
+        self.assertIsNone(self.completed[0][0])
+        self.assertIsInstance(self.completed[0][1], ValueError)
+        self.assertEqual((2, None), self.completed[1])
+
+
+class TestWakeup(base.TestBase):
+
+    def test_set_and_clear(self):
+        wakeup = executor.Wakeup()
+        self.addCleanup(wakeup.close)
+        fd = wakeup.fileno()
+
+        self.assertEqual([], select.select([fd], [], [], 0)[0])
+        for i in range(100000):
+            # a full pipe isn't an error
+            wakeup.set()
+        self.assertEqual([fd], select.select([fd], [], [], 0)[0])
+        wakeup.clear()
+        self.assertEqual([], select.select([fd], [], [], 0)[0])
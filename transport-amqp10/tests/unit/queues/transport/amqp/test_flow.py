@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from proton import Message
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import flow
+
+
+class TestLinkCredit(base.TestBase):
+
+    def setUp(self):
+        super(TestLinkCredit, self).setUp()
+        self.policy = flow.CreditPolicy(initial=10, minimum=2, maximum=16)
+        self.top_ups = []
+        self.credit = self.policy.link(lambda: self.top_ups.append(1))
+
+    def test_grants_the_window_once_half_used(self):
+        self.assertEqual(10, self.credit.grant(0))
+        # more than half the window still held
+        self.assertEqual(0, self.credit.grant(6))
+        self.assertEqual(5, self.credit.grant(5))
+
+    def test_unsettled_deliveries_count_against_the_window(self):
+        for i in range(4):
+            self.credit.received(100)
+        self.assertEqual(6, self.credit.grant(0))
+        self.assertEqual(400, self.policy.used)
+
+    def test_window_grows_additively(self):
+        for i in range(10):
+            self.credit.received(1)
+            self.credit.settled(1, True)
+        self.assertEqual(16, self.credit.window)
+        self.assertEqual(0, self.credit.unsettled)
+        self.assertEqual(0, self.policy.used)
+
+    def test_window_halves_on_failure(self):
+        self.credit.received(1)
+        self.credit.settled(1, False)
+        self.assertEqual(5, self.credit.window)
+        for i in range(3):
+            self.credit.received(1)
+            self.credit.settled(1, False)
+        self.assertEqual(2, self.credit.window)
+
+
+class TestCreditPolicy(base.TestBase):
+
+    def setUp(self):
+        super(TestCreditPolicy, self).setUp()
+        self.policy = flow.CreditPolicy(initial=10, minimum=1, maximum=20,
+                                        budget=1000)
+        self.top_ups = []
+
+    def link(self, name):
+        return self.policy.link(lambda: self.top_ups.append(name))
+
+    def test_window_halves_under_pressure(self):
+        credit = self.link('a')
+        credit.received(700)
+        credit.received(100)
+        self.assertTrue(self.policy.pressure)
+        credit.settled(100, True)
+        self.assertEqual(5, credit.window)
+        self.assertFalse(self.policy.pressure)
+        credit.settled(700, True)
+        self.assertEqual(6, credit.window)
+
+    def test_exhausted_budget_starves_links_until_released(self):
+        a = self.link('a')
+        b = self.link('b')
+        a.received(1000)
+        self.assertTrue(self.policy.exhausted)
+        self.assertEqual(0, a.grant(0))
+        self.assertEqual(0, b.grant(0))
+
+        a.settled(1000, True)
+        self.assertEqual(['a', 'b'], sorted(self.top_ups))
+        self.assertEqual(set(), self.policy.starved)
+        self.assertEqual(10, b.grant(0))
+
+    def test_discarded_links_are_not_topped_up(self):
+        a = self.link('a')
+        b = self.link('b')
+        a.received(1000)
+        b.grant(0)
+        b.discard()
+        a.settled(1000, True)
+        self.assertEqual([], self.top_ups)
+
+    def test_no_budget(self):
+        policy = flow.CreditPolicy(initial=10, maximum=10)
+        credit = policy.link(None)
+        credit.received(10 ** 9)
+        self.assertFalse(policy.exhausted)
+        self.assertFalse(policy.pressure)
+        self.assertEqual(9, credit.grant(0))
+
+
+class TestMessageSize(base.TestBase):
+
+    def test_body_size(self):
+        message = Message()
+        message.body = u'x' * 10
+        self.assertEqual(10, flow.message_size(message))
+
+    def test_body_without_size(self):
+        message = Message()
+        message.body = 42
+        self.assertEqual(0, flow.message_size(message))
@@ -0,0 +1,240 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import proton
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import messages
+
+
+class MessageController(object):
+    """Lists messages the way Zaqar's storage drivers do.
+
+    The first item is the page, the second the marker of the next page,
+    which is only known once the page yielded a message.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.posts = []
+        self.fail = False
+
+    def add(self, count):
+        for i in range(count):
+            self.messages.append({'k': len(self.messages)})
+
+    def list(self, queue_name, marker=None, limit=10):
+        if self.fail:
+            raise RuntimeError('storage is down')
+        start = 0 if marker is None else int(marker) + 1
+        page = self.messages[start:start + limit]
+        marker_id = {}
+
+        def hooked(page):
+            for message in page:
+                marker_id['next'] = message['k']
+                yield message
+
+        yield hooked(page)
+        yield str(marker_id['next'])
+
+    def post(self, queue_name, messages, client_uuid):
+        if self.fail:
+            raise RuntimeError('storage is down')
+        self.posts.append((queue_name, [m['body'] for m in messages]))
+
+
+class QueueController(object):
+
+    def create(self, queue_name):
+        return True
+
+
+class TestQueueCache(base.TestBase):
+
+    def setUp(self):
+        super(TestQueueCache, self).setUp()
+        self.cache = messages.QueueCache(60, 3)
+
+    def test_add_and_invalidate(self):
+        self.assertNotIn('q', self.cache)
+        self.cache.add('q')
+        self.assertIn('q', self.cache)
+        self.cache.invalidate('q')
+        self.assertNotIn('q', self.cache)
+        # unknown names are fine
+        self.cache.invalidate('q')
+
+    def test_expired_entries_are_dropped(self):
+        self.cache.add('q')
+        self.cache.entries['q'] = time.time() - 1
+        self.assertNotIn('q', self.cache)
+        self.assertEqual(0, len(self.cache.entries))
+
+    def test_add_renews_the_ttl(self):
+        self.cache.add('q')
+        self.cache.entries['q'] = time.time() - 1
+        self.cache.add('q')
+        self.assertIn('q', self.cache)
+
+    def test_evicts_the_least_recently_used(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.add(name)
+        # a lookup counts as a use
+        self.assertIn('a', self.cache)
+        self.cache.add('d')
+
+        self.assertNotIn('b', self.cache)
+        for name in ('a', 'c', 'd'):
+            self.assertIn(name, self.cache)
+        self.assertEqual(3, len(self.cache.entries))
+
+    def test_misses_do_not_count_as_uses(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.add(name)
+        self.assertNotIn('x', self.cache)
+        self.cache.add('d')
+        self.assertEqual(['b', 'c', 'd'], list(self.cache.entries))
+
+
+class TestQueueCursor(base.TestBase):
+
+    def setUp(self):
+        super(TestQueueCursor, self).setUp()
+        self.controller = MessageController()
+        self.cursor = messages.QueueCursor(self.controller, 'q')
+
+    def read(self, limit):
+        return [m['k'] for m in self.cursor.read(limit)]
+
+    def test_empty_queue(self):
+        self.assertEqual([], self.read(5))
+        self.assertEqual([], self.read(5))
+        self.assertIsNone(self.cursor.marker)
+
+        self.controller.add(2)
+        self.assertEqual([0, 1], self.read(5))
+
+    def test_reads_resume_where_the_last_one_stopped(self):
+        self.controller.add(5)
+        self.assertEqual([0, 1], self.read(2))
+        self.assertEqual([2, 3], self.read(2))
+        self.assertEqual([4], self.read(2))
+        self.assertEqual('4', self.cursor.marker)
+
+    def test_end_of_queue(self):
+        self.controller.add(4)
+        self.assertEqual([0, 1, 2, 3], self.read(4))
+        # the next page is empty
+        self.assertEqual([], self.read(4))
+        self.assertEqual([], self.read(4))
+        self.assertEqual('3', self.cursor.marker)
+
+    def test_messages_posted_after_the_end(self):
+        self.controller.add(3)
+        self.assertEqual([0, 1, 2], self.read(5))
+        self.assertEqual([], self.read(5))
+
+        self.controller.add(2)
+        self.assertEqual([3, 4], self.read(5))
+
+    def test_storage_failure_leaves_the_cursor_usable(self):
+        self.controller.add(3)
+        self.assertEqual([0, 1], self.read(2))
+        self.controller.fail = True
+        self.assertRaises(RuntimeError, self.read, 2)
+
+        self.controller.fail = False
+        self.assertEqual([2], self.read(2))
+
+
+class TestPostWindows(base.TestBase):
+
+    def setUp(self):
+        super(TestPostWindows, self).setUp()
+        self.controller = MessageController()
+        self.results = []
+
+    def resource(self, **kwargs):
+        return messages.CollectionResource(self.controller,
+                                           QueueController(), None,
+                                           **kwargs)
+
+    def post(self, resource, body, queue_name='q'):
+        resource.on_post(proton.Message(body=body), queue_name,
+                         self.results.append, len(body))
+
+    def test_unbatched_posts_are_written_right_away(self):
+        resource = self.resource()
+        self.post(resource, 'a')
+        self.post(resource, 'b')
+        self.assertEqual([('q', ['a']), ('q', ['b'])],
+                         self.controller.posts)
+        self.assertEqual([True, True], self.results)
+        self.assertIsNone(resource.post_deadline())
+
+    def test_flushed_once_batch_size_messages_wait(self):
+        resource = self.resource(batch_size=3, batch_window=60)
+        self.post(resource, 'a')
+        self.post(resource, 'b')
+        self.post(resource, 'c', 'other')
+        self.assertEqual([], self.controller.posts)
+
+        self.post(resource, 'd')
+        self.assertEqual([('q', ['a', 'b', 'd'])], self.controller.posts)
+        self.assertEqual([True] * 3, self.results)
+        self.assertEqual(['other'], list(resource.windows))
+
+    def test_flushed_once_batch_bytes_wait(self):
+        resource = self.resource(batch_size=100, batch_window=60,
+                                 batch_bytes=10)
+        self.post(resource, 'x' * 4)
+        self.post(resource, 'y' * 4)
+        self.assertEqual([], self.controller.posts)
+
+        self.post(resource, 'z' * 2)
+        self.assertEqual([('q', ['xxxx', 'yyyy', 'zz'])],
+                         self.controller.posts)
+        self.assertEqual({}, resource.windows)
+
+    def test_flushed_at_the_window_deadline(self):
+        resource = self.resource(batch_size=100, batch_window=0.5)
+        before = time.time()
+        self.post(resource, 'a')
+        self.post(resource, 'b', 'other')
+        deadline = resource.post_deadline()
+        self.assertTrue(before + 0.5 <= deadline <= time.time() + 0.5)
+
+        resource.flush_posts(deadline - 0.1)
+        self.assertEqual([], self.controller.posts)
+
+        resource.windows['other'].deadline = deadline + 1
+        resource.flush_posts(deadline)
+        self.assertEqual([('q', ['a'])], self.controller.posts)
+        self.assertEqual(deadline + 1, resource.post_deadline())
+
+        resource.flush_posts(deadline + 1)
+        self.assertEqual([('q', ['a']), ('other', ['b'])],
+                         self.controller.posts)
+        self.assertIsNone(resource.post_deadline())
+
+    def test_failed_writes_are_reported_to_every_sender(self):
+        resource = self.resource(batch_size=2, batch_window=60)
+        self.controller.fail = True
+        self.post(resource, 'a')
+        self.post(resource, 'b')
+        self.assertEqual([False, False], self.results)
+        self.assertEqual({}, resource.windows)
@@ -0,0 +1,198 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import select
+import socket
+import uuid
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import notify
+
+
+def readable(notifier):
+    return bool(select.select([notifier.fileno()], [], [], 0)[0])
+
+
+class TestBus(base.TestBase):
+
+    def setUp(self):
+        super(TestBus, self).setUp()
+        self.bus = notify.Bus()
+        self.woken = []
+
+    def waiter(self, name):
+        return lambda: self.woken.append(name)
+
+    def test_publish_wakes_waiters_once(self):
+        self.bus.subscribe('q', self.waiter('a'))
+        self.bus.subscribe('q', self.waiter('b'))
+        self.bus.subscribe('other', self.waiter('c'))
+
+        self.bus.publish('q')
+        self.assertEqual(['a', 'b'], sorted(self.woken))
+        self.bus.publish('q')
+        self.assertEqual(2, len(self.woken))
+        self.assertEqual(['other'], list(self.bus.waiters))
+
+    def test_unsubscribe(self):
+        callback = self.waiter('a')
+        self.bus.subscribe('q', callback)
+        self.bus.unsubscribe('q', callback)
+        self.bus.unsubscribe('q', callback)
+
+        self.bus.publish('q')
+        self.assertEqual([], self.woken)
+        self.assertEqual({}, self.bus.waiters)
+
+    def test_expire_without_poll_interval(self):
+        self.bus.subscribe('q', self.waiter('a'))
+        self.assertIsNone(self.bus.poll_deadline())
+
+        self.bus.expire(float('inf'))
+        self.assertEqual([], self.woken)
+
+    def test_expire_wakes_every_waiter_at_the_deadline(self):
+        bus = notify.Bus(poll_interval=5)
+        self.assertIsNone(bus.poll_deadline())
+        bus.subscribe('q1', self.waiter('a'))
+        bus.subscribe('q2', self.waiter('b'))
+        deadline = bus.poll_deadline()
+        self.assertIsNotNone(deadline)
+
+        bus.expire(deadline - 1)
+        self.assertEqual([], self.woken)
+
+        bus.expire(deadline)
+        self.assertEqual(['a', 'b'], sorted(self.woken))
+        self.assertEqual({}, bus.waiters)
+        self.assertIsNone(bus.poll_deadline())
+
+    def test_poll_deadline_starts_with_the_first_waiter(self):
+        bus = notify.Bus(poll_interval=5)
+        bus.subscribe('q1', self.waiter('a'))
+        deadline = bus.poll_deadline()
+        bus.subscribe('q2', self.waiter('b'))
+        self.assertEqual(deadline, bus.poll_deadline())
+
+
+class TestNotifier(base.TestBase):
+
+    def test_is_abstract(self):
+        self.assertRaises(TypeError, notify.Notifier)
+
+
+class TestMemoryNotifier(base.TestBase):
+
+    def setUp(self):
+        super(TestMemoryNotifier, self).setUp()
+        self.hub = uuid.uuid4().hex
+
+    def notifier(self, hub=None):
+        notifier = notify.MemoryNotifier(hub or self.hub)
+        self.addCleanup(notifier.close)
+        return notifier
+
+    def test_wakes_up_the_other_loops(self):
+        buses = []
+        woken = []
+        for i in range(3):
+            bus = notify.Bus()
+            bus.notifier = self.notifier()
+            bus.subscribe('q', lambda i=i: woken.append(i))
+            buses.append(bus)
+
+        buses[0].publish('q')
+        # local waiters right away, the others once their loop polls
+        self.assertEqual([0], woken)
+        self.assertFalse(readable(buses[0].notifier))
+        for bus in buses[1:]:
+            self.assertTrue(readable(bus.notifier))
+            bus.receive()
+            self.assertFalse(readable(bus.notifier))
+        self.assertEqual([0, 1, 2], woken)
+
+    def test_own_announcements_are_not_received(self):
+        notifier = self.notifier()
+        other = self.notifier()
+
+        notifier.publish('q')
+        self.assertFalse(readable(notifier))
+        self.assertEqual([], list(notifier.receive()))
+        self.assertEqual(['q'], list(other.receive()))
+
+    def test_hubs_are_separate(self):
+        notifier = self.notifier()
+        elsewhere = self.notifier(uuid.uuid4().hex)
+
+        notifier.publish('q')
+        self.assertFalse(readable(elsewhere))
+        self.assertEqual([], list(elsewhere.receive()))
+
+    def test_closed_notifier_leaves_the_hub(self):
+        notifier = self.notifier()
+        closed = notify.MemoryNotifier(self.hub)
+        closed.close()
+
+        notifier.publish('q')
+        self.assertEqual(0, len(closed._inbox))
+
+    def test_decode_ignores_own_origin(self):
+        notifier = self.notifier()
+        other = self.notifier()
+
+        self.assertIsNone(notifier._decode(notifier._encode(u'q')))
+        self.assertEqual(u'q', other._decode(notifier._encode(u'q')))
+        self.assertIsNone(other._decode(b'garbage'))
+
+    def test_get_notifier(self):
+        self.assertIsNone(notify.get_notifier(''))
+        notifier = notify.get_notifier('memory://' + self.hub)
+        self.addCleanup(notifier.close)
+        self.assertIsInstance(notifier, notify.MemoryNotifier)
+        self.assertRaises(ValueError, notify.get_notifier, 'bogus://x')
+
+
+class TestMulticastNotifier(base.TestBase):
+
+    def setUp(self):
+        super(TestMulticastNotifier, self).setUp()
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('', 0))
+        self.port = s.getsockname()[1]
+        s.close()
+
+    def notifier(self):
+        try:
+            notifier = notify.MulticastNotifier('239.255.11.12', self.port)
+        except socket.error as e:
+            self.skipTest('no multicast here: %s' % e)
+        self.addCleanup(notifier.close)
+        return notifier
+
+    def test_announcements_reach_the_other_notifiers(self):
+        notifier = self.notifier()
+        other = self.notifier()
+
+        notifier.publish('q')
+        self.assertTrue(select.select([other.fileno()], [], [], 5)[0])
+        self.assertEqual(['q'], list(other.receive()))
+        self.assertEqual([], list(notifier.receive()))
+
+    def test_close_releases_every_descriptor(self):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('needs /proc/self/fd')
+        before = len(os.listdir('/proc/self/fd'))
+        self.notifier().close()
+        self.assertEqual(before, len(os.listdir('/proc/self/fd')))
@@ -0,0 +1,304 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+
+import pyngus
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import notify
+from zaqar.queues.transport.amqp import prefetch
+from zaqar.queues.transport.amqp import schedule
+from zaqar.queues.transport.amqp import utils
+
+ACCEPTED = pyngus.SenderLink.ACCEPTED
+RELEASED = pyngus.SenderLink.RELEASED
+
+
+class Controllers(object):
+    """Records the storage requests of the buffers.
+
+    Claims are answered by the test unless `inline` is set, then they
+    get their messages right away.
+    """
+
+    def __init__(self, inline=False, size=10):
+        self.bus = notify.Bus(0)
+        self.inline = inline
+        self.body = 'x' * size
+        self.ids = itertools.count()
+        self.claims = []
+        self.deleted = []
+        self.released = []
+
+    def messages(self, count, priority=None):
+        properties = None
+        if priority is not None:
+            properties = {'priority': priority}
+        return [(str(next(self.ids)),
+                 utils.Envelope(60, self.body, properties))
+                for i in range(count)]
+
+    def on_claim(self, queue_name, limit, callback):
+        if self.inline:
+            callback('c%d' % len(self.claims), self.messages(limit))
+        self.claims.append((limit, callback))
+
+    def answer(self, messages, claim_id=None):
+        limit, callback = self.claims[-1]
+        callback(claim_id or 'c%d' % len(self.claims), messages)
+
+    def on_delete(self, queue_name, message_id, claim_id):
+        self.deleted.append(message_id)
+
+    def on_bulk_delete(self, queue_name, message_ids):
+        self.deleted.extend(message_ids)
+
+    def on_release(self, queue_name, claim_id):
+        self.released.append(claim_id)
+
+
+class Link(object):
+
+    def __init__(self, credit, presettled=False):
+        self.credit = credit
+        self.presettled = presettled
+        self.queued = False
+        self.delivered = []
+
+    def deliver(self, claim, message_id, message):
+        self.credit -= 1
+        self.delivered.append((claim, message_id, message))
+
+
+class TestQueueBuffer(base.TestBase):
+
+    def setUp(self):
+        super(TestQueueBuffer, self).setUp()
+        self.controllers = Controllers()
+
+    def buffer(self, size=10, max_bytes=10 ** 6, max_age=60,
+               controllers=None, scheduler=None):
+        controllers = controllers or self.controllers
+        prefetcher = prefetch.Prefetch(controllers, size, max_bytes,
+                                       max_age, scheduler)
+        return prefetcher.buffer('q')
+
+    def attach(self, buf, credit, presettled=False):
+        link = Link(credit, presettled)
+        buf.attach()
+        buf.want(link)
+        return link
+
+    def settle(self, buf, link, status=ACCEPTED):
+        for claim, message_id, message in link.delivered:
+            buf.settle(claim, message_id, status)
+
+    def test_claims_are_bounded_by_the_prefetch_size(self):
+        buf = self.buffer(size=10)
+        link = self.attach(buf, 100)
+        self.assertEqual(10, self.controllers.claims[0][0])
+
+        self.controllers.answer(self.controllers.messages(10))
+        self.assertEqual(10, len(link.delivered))
+        # drained, claim the next batch
+        self.assertEqual(2, len(self.controllers.claims))
+        self.assertEqual(10, self.controllers.claims[1][0])
+
+    def test_claims_are_bounded_by_the_prefetch_bytes(self):
+        buf = self.buffer(size=100, max_bytes=100)
+        link = self.attach(buf, 5)
+        self.assertEqual(100, self.controllers.claims[0][0])
+
+        self.controllers.answer(self.controllers.messages(20))
+        # 10 bytes each, what's over prefetch_bytes was given back
+        self.assertEqual(5, len(link.delivered))
+        self.assertEqual(5, len(buf.entries))
+        self.assertEqual(50, buf.bytes)
+
+        link.credit = 10
+        buf.want(link)
+        self.assertEqual(10, len(link.delivered))
+        # the room left at the size of the last messages
+        self.assertEqual(10, self.controllers.claims[-1][0])
+
+    def test_refill_once_down_to_half(self):
+        # three 10 bytes messages per turn
+        scheduler = schedule.Scheduler((10 + schedule.MESSAGE_COST) * 3)
+        buf = self.buffer(size=10, scheduler=scheduler)
+        self.attach(buf, 100)
+        self.controllers.answer(self.controllers.messages(10))
+        self.assertEqual(7, len(buf.entries))
+        self.assertEqual(1, len(self.controllers.claims))
+
+        buf.prefetch.run()
+        self.assertEqual(4, len(buf.entries))
+        self.assertEqual(2, len(self.controllers.claims))
+        self.assertEqual(6, self.controllers.claims[1][0])
+
+    def test_single_message_over_prefetch_bytes(self):
+        controllers = Controllers(size=1000)
+        buf = self.buffer(size=10, max_bytes=100, controllers=controllers)
+        link = self.attach(buf, 3)
+        controllers.answer(controllers.messages(1))
+        self.assertEqual(1, len(link.delivered))
+        # claimed one at a time from then on
+        self.assertEqual(1, controllers.claims[-1][0])
+
+    def test_inline_claims_with_large_credit(self):
+        controllers = Controllers(inline=True)
+        buf = self.buffer(size=10, controllers=controllers)
+        link = self.attach(buf, 100000)
+        self.assertEqual(100000, len(link.delivered))
+        self.assertEqual(10, max(limit for limit, callback
+                                 in controllers.claims))
+
+    def test_claim_released_once_every_message_settled(self):
+        buf = self.buffer(size=3)
+        link = self.attach(buf, 3)
+        self.controllers.answer(self.controllers.messages(3))
+        (claim, first, m), (c, second, m), (c, third, m) = link.delivered
+
+        buf.settle(claim, first, ACCEPTED)
+        buf.settle(claim, second, RELEASED)
+        self.assertEqual([], self.controllers.released)
+        buf.settle(claim, third, ACCEPTED)
+        self.assertEqual([first, third], self.controllers.deleted)
+        self.assertEqual(['c1'], self.controllers.released)
+
+    def test_accepted_claims_are_not_released(self):
+        buf = self.buffer(size=3)
+        link = self.attach(buf, 3)
+        self.controllers.answer(self.controllers.messages(3))
+        self.settle(buf, link)
+        self.assertEqual(3, len(self.controllers.deleted))
+        self.assertEqual([], self.controllers.released)
+
+    def test_presettled_links_delete_in_bulk(self):
+        buf = self.buffer(size=3)
+        link = self.attach(buf, 3, presettled=True)
+        self.controllers.answer(self.controllers.messages(3))
+        self.assertEqual(['0', '1', '2'],
+                         [message_id for c, message_id, m in link.delivered])
+        self.assertEqual(['0', '1', '2'], self.controllers.deleted)
+        self.assertEqual([], self.controllers.released)
+
+    def test_detach_gives_back_in_flight_and_buffered(self):
+        buf = self.buffer(size=4)
+        link = self.attach(buf, 2)
+        self.controllers.answer(self.controllers.messages(4))
+        self.assertEqual(2, len(buf.entries))
+
+        in_flight = [(claim, message_id)
+                     for claim, message_id, m in link.delivered]
+        buf.detach(link, in_flight)
+        self.assertEqual(['c1'], self.controllers.released)
+        self.assertEqual(0, len(buf.entries))
+        self.assertEqual(0, buf.bytes)
+        self.assertEqual({}, buf.prefetch.buffers)
+
+    def test_claim_answered_after_every_link_left(self):
+        buf = self.buffer()
+        link = self.attach(buf, 5)
+        buf.detach(link, [])
+        self.controllers.answer(self.controllers.messages(5))
+        self.assertEqual(['c1'], self.controllers.released)
+
+    def test_expired_claims_are_given_back(self):
+        buf = self.buffer(size=2, max_age=-1)
+        link = self.attach(buf, 2)
+        self.controllers.answer(self.controllers.messages(2))
+        self.assertEqual([], link.delivered)
+        self.assertEqual(['c1'], self.controllers.released)
+
+    def test_empty_queue_waits_for_a_post(self):
+        buf = self.buffer()
+        link = self.attach(buf, 5)
+        self.controllers.answer([])
+        self.assertTrue(buf.waiting)
+        # more credit doesn't poll storage
+        buf.want(link)
+        self.assertEqual(1, len(self.controllers.claims))
+
+        self.controllers.bus.publish('q')
+        self.assertFalse(buf.waiting)
+        self.assertEqual(2, len(self.controllers.claims))
+
+    def test_delivers_by_priority(self):
+        buf = self.buffer(size=6)
+        link = self.attach(buf, 0)
+        messages = (self.controllers.messages(2, priority=1) +
+                    self.controllers.messages(2, priority=7) +
+                    self.controllers.messages(2))
+        self.controllers.answer(messages)
+
+        link.credit = 6
+        buf.want(link)
+        self.assertEqual(['2', '3', '4', '5', '0', '1'],
+                         [message_id for c, message_id, m in link.delivered])
+
+
+class TestPriorityEntries(base.TestBase):
+
+    def setUp(self):
+        super(TestPriorityEntries, self).setUp()
+        self.entries = prefetch.PriorityEntries()
+
+    def test_popleft_highest_priority_oldest_first(self):
+        for name, level in (('a', 4), ('b', 9), ('c', 0), ('d', 9),
+                            ('e', 4)):
+            self.entries.append((name, level))
+        self.assertEqual(5, len(self.entries))
+        self.assertEqual(['b', 'd', 'a', 'e', 'c'],
+                         [self.entries.popleft()[0] for i in range(5)])
+        self.assertEqual(0, len(self.entries))
+
+    def test_pop_lowest_priority_newest_first(self):
+        for name, level in (('a', 4), ('b', 9), ('c', 0), ('d', 0)):
+            self.entries.append((name, level))
+        self.assertEqual(['d', 'c', 'a', 'b'],
+                         [self.entries.pop()[0] for i in range(4)])
+
+    def test_appendleft_puts_back_at_the_head_of_its_level(self):
+        self.entries.append(('a', 4))
+        self.entries.append(('b', 4))
+        first = self.entries.popleft()
+        self.entries.append(('c', 2))
+        self.entries.appendleft(first)
+        self.assertEqual(['a', 'b', 'c'],
+                         [self.entries.popleft()[0] for i in range(3)])
+
+    def test_higher_priority_after_draining(self):
+        self.entries.append(('a', 9))
+        self.entries.popleft()
+        self.entries.append(('b', 2))
+        self.entries.append(('c', 5))
+        self.assertEqual('c', self.entries.popleft()[0])
+        self.assertEqual('b', self.entries.popleft()[0])
+
+    def test_empty(self):
+        self.assertFalse(self.entries)
+        self.assertRaises(IndexError, self.entries.popleft)
+        self.assertRaises(IndexError, self.entries.pop)
+
+
+class TestPriorityLevel(base.TestBase):
+
+    def test_levels(self):
+        self.assertEqual(4, prefetch.priority_level(
+            utils.Envelope(60, 'x', None)))
+        self.assertEqual(0, prefetch.priority_level(
+            utils.Envelope(60, 'x', {'priority': 0})))
+        self.assertEqual(9, prefetch.priority_level(
+            utils.Envelope(60, 'x', {'priority': 200})))
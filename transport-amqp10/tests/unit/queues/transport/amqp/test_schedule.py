@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import schedule
+
+
+class Buffer(object):
+    """A queue with deliveries of the given costs."""
+
+    def __init__(self, queue_name, costs, sent):
+        self.queue_name = queue_name
+        self.costs = list(costs)
+        self.sent = sent
+        self.budgets = []
+        self.deficit = 0
+        self.scheduled = False
+
+    @property
+    def backlogged(self):
+        return bool(self.costs)
+
+    def dispatch(self, budget=None):
+        self.budgets.append(budget)
+        while self.costs and self.costs[0] <= budget:
+            budget -= self.costs.pop(0)
+            self.sent.append(self.queue_name)
+        return budget
+
+
+class TestScheduler(base.TestBase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.sent = []
+
+    def buffer(self, name, count, cost=100):
+        return Buffer(name, [cost] * count, self.sent)
+
+    def test_queue_within_its_quantum_delivers_at_once(self):
+        scheduler = schedule.Scheduler(1000)
+        buf = self.buffer('a', 5)
+        scheduler.dispatch(buf)
+
+        self.assertEqual(['a'] * 5, self.sent)
+        self.assertFalse(scheduler.backlogged)
+        self.assertFalse(buf.scheduled)
+        self.assertEqual(0, buf.deficit)
+
+    def test_rest_waits_for_the_next_rounds(self):
+        scheduler = schedule.Scheduler(250)
+        buf = self.buffer('a', 5)
+        scheduler.dispatch(buf)
+        self.assertEqual(2, len(self.sent))
+        self.assertTrue(scheduler.backlogged)
+        self.assertTrue(buf.scheduled)
+        self.assertEqual(50, buf.deficit)
+
+        # while waiting, more work doesn't start another turn
+        scheduler.dispatch(buf)
+        self.assertEqual(2, len(self.sent))
+
+        # the unused budget carries over: 300 this round
+        scheduler.run()
+        self.assertEqual(300, buf.budgets[-1])
+        self.assertEqual(5, len(self.sent))
+        self.assertFalse(scheduler.backlogged)
+        self.assertFalse(buf.scheduled)
+        self.assertEqual(0, buf.deficit)
+
+    def test_quiet_queue_delivers_while_a_busy_one_waits(self):
+        scheduler = schedule.Scheduler(200)
+        busy = self.buffer('busy', 10)
+        quiet = self.buffer('quiet', 1)
+        scheduler.dispatch(busy)
+        scheduler.dispatch(quiet)
+        self.assertEqual(['busy', 'busy', 'quiet'], self.sent)
+
+    def test_rounds_alternate_between_backlogged_queues(self):
+        scheduler = schedule.Scheduler(100)
+        scheduler.dispatch(self.buffer('a', 3))
+        scheduler.dispatch(self.buffer('b', 3))
+        while scheduler.backlogged:
+            scheduler.run()
+        self.assertEqual(['a', 'b'] * 3, self.sent)
+
+    def test_weights(self):
+        scheduler = schedule.Scheduler(100, {'a': '2', 'b': 0.5})
+        self.assertEqual(2.0, scheduler.weight('a'))
+        self.assertEqual(0.5, scheduler.weight('b'))
+        self.assertEqual(1, scheduler.weight('c'))
+
+        scheduler.dispatch(self.buffer('a', 6))
+        scheduler.dispatch(self.buffer('b', 6))
+        scheduler.dispatch(self.buffer('c', 6))
+        self.assertEqual(['a', 'a', 'c'], self.sent)
+        for i in range(3):
+            scheduler.run()
+        self.assertEqual(6, self.sent.count('a'))
+        # 50 per turn, a delivery every other turn
+        self.assertEqual(2, self.sent.count('b'))
+        self.assertEqual(4, self.sent.count('c'))
+
+    def test_invalid_weights(self):
+        for weight in (0, -1, '0', 'heavy', None, float('nan')):
+            self.assertRaises(ValueError, schedule.Scheduler, 100,
+                              {'q': weight})
@@ -0,0 +1,56 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import spool
+
+
+class TestDeliverySpool(base.TestBase):
+
+    def frames(self, count, size):
+        return [(b'%d' % (i % 10)) * size for i in range(count)]
+
+    def test_small_deliveries_stay_in_memory(self):
+        delivery = spool.DeliverySpool(100)
+        for frame in self.frames(3, 30):
+            delivery.write(frame)
+        self.assertEqual(90, delivery.size)
+        self.assertFalse(delivery._file._rolled)
+        self.assertEqual(b''.join(self.frames(3, 30)), delivery.read())
+
+    def test_rolls_over_to_a_file_past_the_threshold(self):
+        delivery = spool.DeliverySpool(100)
+        frames = self.frames(12, 10)
+        for frame in frames[:10]:
+            delivery.write(frame)
+        self.assertFalse(delivery._file._rolled)
+        delivery.write(frames[10])
+        self.assertTrue(delivery._file._rolled)
+        delivery.write(frames[11])
+
+        # the frames come back whole and in order
+        self.assertEqual(b''.join(frames), delivery.read())
+        self.assertEqual(120, delivery.size)
+
+    def test_read_frees_the_spool(self):
+        delivery = spool.DeliverySpool(10)
+        delivery.write(b'x' * 100)
+        delivery.read()
+        self.assertTrue(delivery._file.closed)
+
+    def test_close(self):
+        delivery = spool.DeliverySpool(10)
+        delivery.write(b'x' * 100)
+        delivery.close()
+        self.assertTrue(delivery._file.closed)
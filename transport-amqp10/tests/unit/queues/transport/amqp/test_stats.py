@@ -0,0 +1,149 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import stats
+
+
+class TestRegistry(base.TestBase):
+
+    def setUp(self):
+        super(TestRegistry, self).setUp()
+        self.registry = stats.Registry()
+
+    def lines(self):
+        return self.registry.render().split('\n')
+
+    def test_empty(self):
+        self.assertEqual('', self.registry.render())
+
+    def test_counters_and_gauges(self):
+        counter = stats.Counter('amqp_posts_total', 'Messages posted.',
+                                labels=('queue',), registry=self.registry)
+        gauge = stats.Gauge('amqp_connections', 'Open connections.',
+                            registry=self.registry)
+        counter.inc(('b',))
+        counter.inc(('a',), 3)
+        counter.inc(('b',))
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual(['# HELP amqp_posts_total Messages posted.',
+                          '# TYPE amqp_posts_total counter',
+                          'amqp_posts_total{queue="a"} 3',
+                          'amqp_posts_total{queue="b"} 2',
+                          '# HELP amqp_connections Open connections.',
+                          '# TYPE amqp_connections gauge',
+                          'amqp_connections 1',
+                          ''], self.lines())
+
+    def test_histograms(self):
+        histogram = stats.Histogram('amqp_seconds', 'Durations.',
+                                    buckets=(0.5, 1.0), labels=('op',),
+                                    registry=self.registry)
+        for value in (0.25, 0.5, 0.75, 2.0):
+            histogram.observe(value, ('post',))
+
+        self.assertEqual(['# HELP amqp_seconds Durations.',
+                          '# TYPE amqp_seconds histogram',
+                          'amqp_seconds_bucket{op="post",le="0.5"} 2',
+                          'amqp_seconds_bucket{op="post",le="1.0"} 3',
+                          'amqp_seconds_bucket{op="post",le="+Inf"} 4',
+                          'amqp_seconds_sum{op="post"} 3.5',
+                          'amqp_seconds_count{op="post"} 4',
+                          ''], self.lines())
+
+    def test_label_values_are_escaped(self):
+        counter = stats.Counter('amqp_posts_total', 'Messages posted.',
+                                labels=('queue',), registry=self.registry)
+        counter.inc(('a\\b "c"\nd',))
+        self.assertEqual('amqp_posts_total{queue="a\\\\b \\"c\\"\\nd"} 1',
+                         self.lines()[2])
+
+    def test_constant_labels_come_first(self):
+        counter = stats.Counter('amqp_posts_total', 'Messages posted.',
+                                labels=('queue',), registry=self.registry)
+        histogram = stats.Histogram('amqp_seconds', 'Durations.',
+                                    buckets=(1.0,), registry=self.registry)
+        self.registry.constant_labels['pid'] = '42'
+        counter.inc(('q',))
+        histogram.observe(0.5)
+
+        lines = self.lines()
+        self.assertEqual('amqp_posts_total{pid="42",queue="q"} 1', lines[2])
+        self.assertEqual('amqp_seconds_bucket{pid="42",le="1.0"} 1',
+                         lines[5])
+        self.assertEqual('amqp_seconds_sum{pid="42"} 0.5', lines[7])
+
+    def test_collectors_run_before_rendering(self):
+        gauge = stats.Gauge('amqp_buffered', 'Buffered messages.',
+                            registry=self.registry)
+
+        def collect():
+            gauge.set(7)
+
+        def broken():
+            raise RuntimeError('broken collector')
+
+        self.registry.on_collect(broken)
+        self.registry.on_collect(collect)
+        self.assertEqual('amqp_buffered 7', self.lines()[2])
+
+
+class TestStatsFile(base.TestBase):
+
+    def setUp(self):
+        super(TestStatsFile, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.registry = stats.Registry()
+        self.counter = stats.Counter('amqp_posts_total', 'Messages posted.',
+                                     registry=self.registry)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_written_every_interval(self):
+        path = os.path.join(self.directory, 'amqp.prom')
+        stats_file = stats.StatsFile(path, 10, registry=self.registry)
+        now = stats_file.deadline()
+        self.counter.inc()
+        stats_file.write(now)
+        self.assertEqual(self.registry.render(), self.read(path))
+        self.assertEqual(now + 10, stats_file.deadline())
+
+        self.counter.inc()
+        stats_file.write(now + 5)
+        self.assertIn('amqp_posts_total 1\n', self.read(path))
+        stats_file.write(now + 10)
+        self.assertIn('amqp_posts_total 2\n', self.read(path))
+        self.assertEqual(['amqp.prom'], os.listdir(self.directory))
+
+    def test_workers_write_their_own_file(self):
+        path = os.path.join(self.directory, 'amqp.prom')
+        stats_file = stats.StatsFile(path, 10, worker=True,
+                                     registry=self.registry)
+        pid = str(os.getpid())
+        self.assertEqual(os.path.join(self.directory, 'amqp.%s.prom' % pid),
+                         stats_file.path)
+        self.counter.inc()
+        stats_file.write(stats_file.deadline())
+        self.assertIn('amqp_posts_total{pid="%s"} 1\n' % pid,
+                      self.read(stats_file.path))
@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import timers
+
+
+class TestTimerWheel(base.TestBase):
+
+    def setUp(self):
+        super(TestTimerWheel, self).setUp()
+        self.wheel = timers.TimerWheel(1, 10, now=100)
+
+    def test_items_come_out_once_due(self):
+        self.wheel.schedule('a', 102.5)
+        self.wheel.schedule('b', 104)
+        self.assertEqual(2, len(self.wheel))
+
+        # deadlines are rounded up to the resolution
+        self.assertEqual([], self.wheel.advance(102.5))
+        self.assertEqual(['a'], self.wheel.advance(103))
+        self.assertEqual([], self.wheel.advance(103.5))
+        self.assertEqual(['b'], self.wheel.advance(104))
+        self.assertEqual(0, len(self.wheel))
+
+    def test_advance_past_several_buckets(self):
+        for i, name in enumerate('abc'):
+            self.wheel.schedule(name, 101 + i)
+        self.assertEqual(['a', 'b', 'c'], sorted(self.wheel.advance(109)))
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', 102)
+        self.wheel.schedule('a', 105)
+        self.assertEqual(1, len(self.wheel))
+        self.assertEqual([], self.wheel.advance(104))
+        self.wheel.cancel('a')
+        self.wheel.cancel('a')
+        self.assertEqual([], self.wheel.advance(110))
+        self.assertEqual(0, len(self.wheel))
+
+    def test_past_deadlines_come_out_next_tick(self):
+        self.wheel.schedule('a', 50)
+        self.assertEqual(101, self.wheel.deadline())
+        self.assertEqual(['a'], self.wheel.advance(101))
+
+    def test_far_deadlines_come_out_early(self):
+        self.wheel.schedule('a', 1000)
+        self.assertEqual(110, self.wheel.deadline())
+        self.assertEqual(['a'], self.wheel.advance(110))
+
+    def test_deadline(self):
+        self.assertIsNone(self.wheel.deadline())
+        self.wheel.schedule('b', 105)
+        self.assertEqual(105, self.wheel.deadline())
+        self.wheel.schedule('a', 103)
+        self.assertEqual(103, self.wheel.deadline())
+
+        self.assertEqual(['a'], self.wheel.advance(103))
+        self.assertEqual(105, self.wheel.deadline())
+        self.wheel.cancel('b')
+        self.assertIsNone(self.wheel.deadline())
+
+    def test_wraps_around_the_ring(self):
+        now = 100
+        for i in range(30):
+            self.wheel.schedule(i, now + 5)
+            now += 5
+            self.assertEqual([i], self.wheel.advance(now))
+        self.assertEqual(0, len(self.wheel))
@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import tracing
+
+
+class Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestTracer(base.TestBase):
+
+    def setUp(self):
+        super(TestTracer, self).setUp()
+        self.logger = logging.getLogger('tests.amqp.trace')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.records = Records()
+        self.logger.addHandler(self.records)
+        self.addCleanup(self.logger.removeHandler, self.records)
+        self.tracer = tracing.Tracer(self.logger)
+
+    def samples(self, count):
+        return [self.tracer.sample() for i in range(count)]
+
+    def test_off_by_default(self):
+        self.assertFalse(self.tracer.enabled)
+
+    def test_one_in_every(self):
+        self.tracer.configure(3)
+        self.assertTrue(self.tracer.enabled)
+        # the first event is traced, then every third one
+        self.assertEqual([True, False, False, True, False, False, True],
+                         self.samples(7))
+
+    def test_every_event(self):
+        self.tracer.configure(1)
+        self.assertEqual([True] * 4, self.samples(4))
+
+    def test_reconfigure_restarts_the_count(self):
+        self.tracer.configure(4)
+        self.samples(2)
+        self.tracer.configure(2)
+        self.assertEqual([True, False, True], self.samples(3))
+
+    def test_zero_or_negative_turns_it_off(self):
+        self.tracer.configure(0)
+        self.assertFalse(self.tracer.enabled)
+        self.tracer.configure(-5)
+        self.assertFalse(self.tracer.enabled)
+        self.assertEqual(0, self.tracer.every)
+
+    def test_off_unless_logging_at_debug_level(self):
+        self.logger.setLevel(logging.INFO)
+        self.tracer.configure(1)
+        self.assertFalse(self.tracer.enabled)
+
+    def test_log_formats_lazily(self):
+        self.tracer.configure(2)
+        for i in range(4):
+            if self.tracer.enabled and self.tracer.sample():
+                self.tracer.log("event %d of %s", i, 'q')
+        self.assertEqual(['event 0 of q', 'event 2 of q'],
+                         self.records.messages)
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from proton import Message
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import utils
+
+
+def message(body=u'hello', **properties):
+    msg = Message()
+    msg.body = body
+    for field, value in properties.items():
+        setattr(msg, field, value)
+    return msg
+
+
+class TestProtonToZaqar(base.TestBase):
+
+    def test_default_properties_are_left_out(self):
+        stored = utils.proton_to_zaqar(message())
+        self.assertEqual({'ttl': 100, 'body': u'hello'}, stored)
+
+    def test_only_set_properties_are_kept(self):
+        stored = utils.proton_to_zaqar(
+            message(ttl=30, priority=9, subject=u'greeting'))
+        self.assertEqual(30, stored['ttl'])
+        self.assertEqual({'priority': 9, 'subject': u'greeting'},
+                         stored['amqp10'])
+
+
+class TestEnvelope(base.TestBase):
+
+    def test_defaults(self):
+        envelope = utils.zaqar_to_proton({'ttl': 60, 'body': u'x'})
+        self.assertIsNone(envelope.properties)
+        self.assertEqual(4, envelope.get('priority'))
+        self.assertIsNone(envelope.get('subject'))
+        self.assertEqual(60, envelope.message.ttl)
+        self.assertEqual(4, envelope.message.priority)
+
+    def test_present_properties(self):
+        envelope = utils.Envelope(60, u'x', {'priority': 1})
+        self.assertEqual(1, envelope.get('priority'))
+        self.assertIsNone(envelope.get('subject'))
+        self.assertEqual(1, envelope.message.priority)
+
+    def test_message_is_built_once_and_only_when_needed(self):
+        envelope = utils.Envelope(60, u'x')
+        self.assertIsNone(envelope._message)
+        self.assertIs(envelope.message, envelope.message)
+
+    def test_encode_does_not_keep_the_message(self):
+        envelope = utils.Envelope(60, u'x')
+        envelope.encode()
+        self.assertIsNone(envelope._message)
+
+    def test_round_trip(self):
+        sent = message(body=u'payload', ttl=30, priority=8,
+                       subject=u'greeting', correlation_id=u'c-1')
+        envelope = utils.zaqar_to_proton(utils.proton_to_zaqar(sent))
+
+        received = Message()
+        received.decode(envelope.encode())
+        self.assertEqual(u'payload', received.body)
+        for field in ('ttl', 'priority', 'subject', 'correlation_id'):
+            self.assertEqual(getattr(sent, field), getattr(received, field))
+        self.assertFalse(received.durable)
+
+    def test_round_trip_without_ttl(self):
+        envelope = utils.zaqar_to_proton(utils.proton_to_zaqar(message()))
+        received = Message()
+        received.decode(envelope.encode())
+        # stored messages need a ttl, a message without one gets 100
+        self.assertEqual(100, received.ttl)
+        self.assertEqual(4, received.priority)
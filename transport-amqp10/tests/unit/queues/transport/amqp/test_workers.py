@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import select
+import shutil
+import signal
+import tempfile
+import time
+
+from tests.unit.queues.transport.amqp import base
+from zaqar.queues.transport.amqp import workers
+
+TIMEOUT = 10
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+class TestSupervisor(base.TestBase):
+    """Forks a supervisor, whose workers report their pid on a pipe."""
+
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        self.reader, self.writer = os.pipe()
+        self.addCleanup(os.close, self.reader)
+        self.buffered = b''
+        self.pids = []
+
+    def serve(self):
+        os.write(self.writer, ('%d\n' % os.getpid()).encode('ascii'))
+        while True:
+            time.sleep(1)
+
+    def start(self, count):
+        supervisor = workers.Supervisor(count, self.serve,
+                                        respawn_interval=0.1)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(self.reader)
+                supervisor.run()
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(self.writer)
+        self.addCleanup(self.kill, pid)
+        return pid
+
+    def kill(self, pid):
+        for worker in self.pids + [pid]:
+            try:
+                os.kill(worker, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def started(self):
+        """Return the pid of the next worker that started."""
+        deadline = time.time() + TIMEOUT
+        while b'\n' not in self.buffered:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                self.fail('no worker started')
+            if not select.select([self.reader], [], [], timeout)[0]:
+                continue
+            data = os.read(self.reader, 4096)
+            if not data:
+                self.fail('the supervisor exited')
+            self.buffered += data
+        line, self.buffered = self.buffered.split(b'\n', 1)
+        pid = int(line)
+        self.pids.append(pid)
+        return pid
+
+    def stop(self, pid):
+        os.kill(pid, signal.SIGTERM)
+        pid, status = os.waitpid(pid, 0)
+        return status
+
+    def test_starts_the_workers(self):
+        supervisor = self.start(3)
+        pids = set(self.started() for i in range(3))
+        self.assertEqual(3, len(pids))
+        for pid in pids:
+            self.assertTrue(alive(pid))
+        self.assertEqual(0, self.stop(supervisor))
+
+    def test_restarts_a_dead_worker(self):
+        supervisor = self.start(2)
+        first = self.started()
+        second = self.started()
+
+        os.kill(first, signal.SIGKILL)
+        replacement = self.started()
+        self.assertNotIn(replacement, (first, second))
+        self.assertTrue(alive(replacement))
+        self.assertTrue(alive(second))
+        self.assertEqual(0, self.stop(supervisor))
+
+    def test_restarts_a_worker_that_failed(self):
+        def serve():
+            os.write(self.writer, ('%d\n' % os.getpid()).encode('ascii'))
+            # only the first worker finds no marker
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+                raise RuntimeError('crashed')
+            while True:
+                time.sleep(1)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        marker = os.path.join(directory, 'crashed')
+        self.serve = serve
+        supervisor = self.start(1)
+        crashed = self.started()
+        replacement = self.started()
+        self.assertNotEqual(crashed, replacement)
+        self.assertTrue(alive(replacement))
+        self.assertEqual(0, self.stop(supervisor))
+
+    def test_sigterm_stops_the_workers(self):
+        supervisor = self.start(2)
+        pids = [self.started(), self.started()]
+        self.assertEqual(0, self.stop(supervisor))
+        # reaped by the supervisor before it exited
+        for pid in pids:
+            self.assertFalse(alive(pid))